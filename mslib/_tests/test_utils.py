@@ -29,6 +29,7 @@ import pytest
 import os
 import fs
 import datetime
+import numpy as np
 from mslib import utils
 import multidict
 import werkzeug
@@ -208,6 +209,135 @@ class TestProjections(object):
             utils.get_projection_params('crs:84')
 
 
+class TestIndexWindow(object):
+    lats = np.arange(-90, 90.1, 1.)
+    # global grid stored from 0 to 360 and shifted to -180..180
+    lons = ((np.arange(0, 360, 1.) + 180) % 360) - 180
+
+    def test_global_grid(self):
+        lat_slice, lon_slices = utils.get_index_window(self.lats, self.lons, (20, 40, 30, 50))
+        assert lat_slice == slice(129, 142)
+        assert lon_slices == [slice(19, 32)]
+
+    def test_wrap_around(self):
+        lat_slice, lon_slices = utils.get_index_window(self.lats, self.lons, (-10, 40, 10, 50))
+        assert lon_slices == [slice(349, 360), slice(0, 12)]
+        lons = np.concatenate([self.lons[_x] for _x in lon_slices])
+        assert lons[0] == -11 and lons[-1] == 11 and len(lons) == 23
+
+    def test_small_region(self):
+        lat_slice, lon_slices = utils.get_index_window(self.lats, self.lons, (10.2, 40.1, 10.4, 40.3))
+        assert lat_slice == slice(129, 133)
+        assert lon_slices == [slice(9, 12)]
+
+    def test_full_grid(self):
+        lat_slice, lon_slices = utils.get_index_window(self.lats, self.lons, (-180, -90, 180, 90))
+        assert lat_slice == slice(0, len(self.lats))
+        assert lon_slices == [slice(0, len(self.lons))]
+
+    def test_regional_grid(self):
+        lons = np.arange(-50, 60, 1.5)
+        lat_slice, lon_slices = utils.get_index_window(self.lats, lons, (-55, 0, 0, 10))
+        assert lon_slices == [slice(0, 35)]
+
+
+class TestPointStencil(object):
+    lats = np.arange(-90, 90.1, 1.)
+    # global grid stored from 0 to 360 and shifted to -180..180
+    lons = ((np.arange(0, 360, 1.) + 180) % 360) - 180
+
+    def test_global_grid(self):
+        lat_indices, lon_indices, weights = utils.get_point_stencil(self.lats, self.lons, 40.25, 20.5)
+        assert lat_indices == (130, 131) and lon_indices == (20, 21)
+        assert np.allclose(weights, [[0.375, 0.375], [0.125, 0.125]])
+
+    def test_wrap_around(self):
+        lat_indices, lon_indices, weights = utils.get_point_stencil(self.lats, self.lons, 90, -0.25)
+        assert lat_indices == (179, 180) and lon_indices == (359, 0)
+        assert np.allclose(weights, [[0, 0], [0.25, 0.75]])
+
+    def test_regional_grid(self):
+        lons = np.arange(-50, 60, 1.5)
+        _, lon_indices, weights = utils.get_point_stencil(self.lats, lons, 0, lons[-1])
+        assert lon_indices == (len(lons) - 2, len(lons) - 1) and np.allclose(weights[0], [0, 1])
+        for lat, lon in [(0, 60), (0, -51), (91, 0)]:
+            with pytest.raises(ValueError):
+                utils.get_point_stencil(self.lats, lons, lat, lon)
+
+
+class TestInterpolateVertsec(object):
+    lats = np.arange(30, 70.1, 2.)
+    lons = np.arange(-20, 40.1, 2.)
+
+    def setup(self):
+        # bilinear interpolation reproduces fields linear in lat and lon
+        levels = np.arange(3.)[:, np.newaxis, np.newaxis]
+        self.data = levels + self.lats[np.newaxis, :, np.newaxis] - 2 * self.lons[np.newaxis, np.newaxis, :]
+
+    def test_linear_field(self):
+        lats, lons = np.array([30, 41.3, 55, 70]), np.array([-20, 13.7, 40, 0.5])
+        curtain = utils.interpolate_vertsec(self.data, self.lats, self.lons, lats, lons)
+        assert curtain.shape == (3, 4)
+        assert not np.ma.is_masked(curtain)
+        assert np.allclose(curtain, np.arange(3.)[:, np.newaxis] + lats - 2 * lons)
+
+    def test_decreasing_lats(self):
+        lats, lons = np.array([32.5, 61.1]), np.array([1.1, 7.9])
+        curtain = utils.interpolate_vertsec(self.data[:, ::-1], self.lats[::-1], self.lons, lats, lons)
+        assert np.allclose(curtain, np.arange(3.)[:, np.newaxis] + lats - 2 * lons)
+
+    def test_north_to_south_grid(self):
+        # global grids are often stored from north to south and from 0 to 360
+        lats, lons = np.arange(90, -90.1, -1.5), np.arange(0, 360, 1.5)
+        data = np.arange(3.)[:, np.newaxis, np.newaxis] + lats[np.newaxis, :, np.newaxis] + \
+            np.cos(np.radians(lons))[np.newaxis, np.newaxis, :]
+        path_lats, path_lons = np.array([89.2, 47.3, 0., -12.6, -90.]), np.array([0.4, 11.3, 200., 358.1, 10.])
+        curtain = utils.interpolate_vertsec(data, lats, lons, path_lats, path_lons)
+        assert not np.ma.is_masked(curtain)
+        assert np.allclose(curtain, np.arange(3.)[:, np.newaxis] + path_lats + np.cos(np.radians(path_lons)),
+                           atol=1e-3)
+
+    def test_unordered_lons(self):
+        order = np.roll(np.arange(len(self.lons)), 7)
+        lats, lons = np.array([32.5, 61.1]), np.array([1.1, 39.9])
+        curtain = utils.interpolate_vertsec(self.data[:, :, order], self.lats, self.lons[order], lats, lons)
+        assert np.allclose(curtain, np.arange(3.)[:, np.newaxis] + lats - 2 * lons)
+
+    def test_outside_and_masked(self):
+        data = np.ma.masked_array(self.data, np.zeros_like(self.data, dtype=bool))
+        data[1, 5, 5] = np.ma.masked
+        lats = np.array([20, self.lats[5] + 1, self.lats[5] + 1, 50])
+        lons = np.array([0, self.lons[5] + 1, self.lons[6], 50])
+        curtain = utils.interpolate_vertsec(data, self.lats, self.lons, lats, lons)
+        assert curtain.mask[:, 0].all() and curtain.mask[:, 3].all()
+        assert curtain.mask[:, 1].tolist() == [False, True, False]
+        # the masked value has no weight in the third point
+        assert not curtain.mask[:, 2].any()
+
+    def test_stencil_reuse(self):
+        lats, lons = np.array([35.3, 44.4]), np.array([-3.3, 27.1])
+        stencil = utils.get_vertsec_stencil(self.lats, self.lons, lats, lons)
+        for data in (self.data, 2 * self.data):
+            assert np.allclose(utils.apply_vertsec_stencil(data, stencil),
+                               utils.interpolate_vertsec(data, self.lats, self.lons, lats, lons))
+
+
+class TestBlockAverage(object):
+    def test_average(self):
+        data = np.arange(20.).reshape(4, 5)
+        result = utils.block_average(data, 2)
+        assert not isinstance(result, np.ma.MaskedArray)
+        assert np.allclose(result, [[3, 5, 6.5], [13, 15, 16.5]])
+
+    def test_masked(self):
+        data = np.ma.masked_array(np.ones((3, 3), dtype=np.float32), [[1, 1, 0], [1, 1, 0], [0, 0, 0]])
+        data[2, 2] = np.nan
+        result = utils.block_average(data * np.array([1, 1, 2], dtype=np.float32), 2)
+        assert result.dtype == np.float32
+        assert result.mask.tolist() == [[True, False], [False, True]]
+        assert np.allclose(result[0, 1], 2) and np.allclose(result[1, 0], 1)
+
+
 class TestTimes(object):
     """
     tests about times
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms._tests.test_cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides pytest functions to tests mswms.cache
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import concurrent.futures
+import os
+import threading
+from datetime import datetime
+import numpy as np
+import pytest
+
+import mss_wms_settings
+from mslib.mswms.cache import LRUCache, FieldCache, ImageCache, DatasetPool, GeometryStore, SingleFlight
+
+
+class Test_LRUCache(object):
+    def test_eviction(self):
+        cache = LRUCache(10)
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+        assert cache.get("a") == b"1234"
+        cache.put("c", b"1234")
+        assert "b" not in cache
+        assert "a" in cache and "c" in cache
+        assert cache.nbytes == 8
+        assert cache.hits == 1
+        assert cache.get("b") is None
+        assert cache.misses == 1
+
+    def test_oversized(self):
+        cache = LRUCache(10)
+        cache.put("a", np.zeros(10))
+        assert len(cache) == 0
+        assert cache.nbytes == 0
+
+    def test_pop(self):
+        cache = LRUCache(10)
+        cache.put("a", b"1234")
+        assert cache.pop("a") == b"1234"
+        assert cache.pop("a") is None
+        assert cache.nbytes == 0
+
+
+class Test_FieldCache(object):
+    def test_readonly(self):
+        cache = FieldCache(1000)
+        cache.put("a", np.zeros(10))
+        cache.put("b", np.ma.masked_less(np.arange(10.), 5))
+        for key in "ab":
+            with pytest.raises(ValueError):
+                cache.get(key)[0] = 1
+        assert cache.hits == 2
+
+
+class Test_ImageCache(object):
+    def test_memory(self):
+        cache = ImageCache()
+        assert cache.get("abcd") is None
+        cache.put("abcd", b"image", "image/png", 12.5)
+        assert cache.get("abcd") == (b"image", "image/png", 12.5)
+
+    def test_disk(self, tmpdir):
+        directory = str(tmpdir.join("cache"))
+        cache = ImageCache(directory=directory)
+        cache.put("abcd", b"image", "image/png", 12.5)
+        cache.put("efgh", b"xml", "text/xml")
+        assert os.path.exists(os.path.join(directory, "ab", "abcd"))
+
+        # a new instance, e.g. in another process, shares the files
+        cache = ImageCache(directory=directory)
+        assert cache.get("abcd") == (b"image", "image/png", 12.5)
+        assert cache.get("efgh") == (b"xml", "text/xml", None)
+        assert "abcd" in cache and "ijkl" not in cache
+
+    def test_disk_pruning(self, tmpdir):
+        directory = str(tmpdir.join("cache"))
+        cache = ImageCache(max_bytes=0, directory=directory, max_disk_bytes=200)
+        for index in range(10):
+            cache.put(f"{index:04d}", b"x" * 50, "image/png")
+            assert cache._disk_bytes <= 200
+        assert cache.get("0009") is not None
+        assert cache.get("0000") is None
+
+    def test_disk_bytes(self, tmpdir):
+        cache = ImageCache(directory=str(tmpdir.join("cache")))
+        cache.put("abcd", b"image", "image/png")
+        cache.put("efgh", b"image", "image/png")
+        disk_bytes = cache._disk_bytes
+        # re-storing a key replaces its file
+        cache.put("abcd", b"image", "image/png")
+        assert cache._disk_bytes == disk_bytes == sum(_x[1] for _x in cache._disk_entries())
+
+
+class Test_GeometryStore(object):
+    geometry = {
+        "coastsegs": [[(0., 1.), (2., 3.)], [(4., 5.), (6., 7.), (8., 9.)]],
+        "coastpolygons": [((0., 1., 2.), (3., 4., 5.)), ((6., 7., 8., 6.), (9., 10., 11., 9.))],
+        "coastpolygontypes": [1, 2],
+        "cntrysegs": [[(1., 1.), (2., 2.)]],
+    }
+
+    def check(self, geometry):
+        assert sorted(geometry) == sorted(self.geometry)
+        assert geometry["coastpolygontypes"] == [1, 2]
+        for name in ("coastsegs", "coastpolygons", "cntrysegs"):
+            assert len(geometry[name]) == len(self.geometry[name])
+            for part, expected in zip(geometry[name], self.geometry[name]):
+                assert np.array_equal(part, expected)
+
+    def test_memory(self):
+        store = GeometryStore(max_entries=1)
+        assert store.get("abcd") is None
+        store.put("abcd", self.geometry)
+        self.check(store.get("abcd"))
+        store.put("efgh", self.geometry)
+        assert store.get("abcd") is None
+
+    def test_disk(self, tmpdir):
+        directory = str(tmpdir.join("geometry"))
+        GeometryStore(directory=directory).put("abcd", self.geometry)
+        assert os.path.exists(os.path.join(directory, "abcd.npy"))
+
+        # a new instance, e.g. in another process, maps the same file
+        store = GeometryStore(directory=directory)
+        geometry = store.get("abcd")
+        self.check(geometry)
+        assert isinstance(geometry["coastsegs"][0].base, np.memmap)
+
+    def test_disk_pruning(self, tmpdir):
+        directory = str(tmpdir.join("geometry"))
+        store = GeometryStore(max_entries=1, directory=directory, max_disk_bytes=1000)
+        for index in range(10):
+            store.put(f"{index:04d}", self.geometry)
+            assert store._disk_bytes <= 1000
+        assert store.get("0009") is not None
+        assert store.get("0000") is None
+
+    def test_disk_bytes(self, tmpdir):
+        store = GeometryStore(directory=str(tmpdir.join("geometry")))
+        store.put("abcd", self.geometry)
+        store.put("efgh", self.geometry)
+        disk_bytes = store._disk_bytes
+        # re-storing a key replaces its file
+        store.put("abcd", self.geometry)
+        assert store._disk_bytes == disk_bytes == sum(_x[1] for _x in store._disk_entries())
+
+
+class Test_SingleFlight(object):
+    def setup(self):
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        self.started.set()
+        assert self.proceed.wait(10)
+        return self.calls
+
+    def test_coalesce(self):
+        single_flight = SingleFlight(timeout=10)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+            leader = executor.submit(single_flight.do, "key", self.compute)
+            assert self.started.wait(10)
+            followers = [executor.submit(single_flight.do, "key", self.compute) for _ in range(3)]
+            other = executor.submit(single_flight.do, "other", lambda: "other")
+            assert other.result() == "other"
+            while single_flight.waiting < 3:
+                threading.Event().wait(0.01)
+            self.proceed.set()
+            assert [_x.result() for _x in [leader] + followers] == [1] * 4
+        assert self.calls == 1
+        assert single_flight.get_stats() == {
+            "calls": 2, "coalesced": 3, "timeouts": 0, "coalesced_by_key": {"key": 3}}
+        # completed computations are not shared
+        assert single_flight.do("key", self.compute) == 2
+
+    def test_exception(self):
+        single_flight = SingleFlight(timeout=10)
+
+        def fail():
+            self.compute()
+            raise ValueError("failed")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(single_flight.do, "key", fail)
+            assert self.started.wait(10)
+            follower = executor.submit(single_flight.do, "key", fail)
+            while single_flight.waiting < 1:
+                threading.Event().wait(0.01)
+            self.proceed.set()
+            for future in (leader, follower):
+                with pytest.raises(ValueError):
+                    future.result()
+        assert self.calls == 1
+
+    def test_timeout(self):
+        single_flight = SingleFlight(timeout=0.01)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(single_flight.do, "key", self.compute)
+            assert self.started.wait(10)
+            follower = executor.submit(single_flight.do, "key", lambda: "again")
+            assert follower.result() == "again"
+            self.proceed.set()
+            assert leader.result() == 1
+        assert single_flight.timeouts == 1
+        # callers computing the result themselves are not coalesced
+        assert single_flight.get_stats() == {
+            "calls": 1, "coalesced": 0, "timeouts": 1, "coalesced_by_key": {}}
+
+    def test_max_keys(self):
+        single_flight = SingleFlight(max_keys=2)
+        single_flight.coalesced_by_key.update({"a": 1, "b": 1})
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(single_flight.do, "c", self.compute)
+            assert self.started.wait(10)
+            follower = executor.submit(single_flight.do, "c", self.compute)
+            while single_flight.waiting < 1:
+                threading.Event().wait(0.01)
+            self.proceed.set()
+            assert leader.result() == follower.result() == 1
+        assert single_flight.coalesced_by_key == {"b": 1, "c": 1}
+
+
+class Test_DatasetPool(object):
+    def setup(self):
+        data = mss_wms_settings.data["ecmwf_EUR_LL015"]
+        data.setup()
+        init_time = valid_time = datetime(2012, 10, 17, 12)
+        self.pl_file = data.get_filename("air_temperature", "pl", init_time, valid_time, fullpath=True)
+        self.sfc_file = data.get_filename(
+            "air_pressure_at_sea_level", "sfc", init_time, valid_time, fullpath=True)
+        self.kwargs = data.mfDatasetArgs()
+
+    def test_reuse(self):
+        pool = DatasetPool()
+        entry = pool.acquire([self.pl_file, self.sfc_file], **self.kwargs)
+        assert datetime(2012, 10, 17, 12) in entry.times
+        assert entry.lat_order in (-1, 1)
+        assert entry.vert_data is not None
+        assert pool.acquire([self.sfc_file, self.pl_file], **self.kwargs) is entry
+        assert (pool.hits, pool.misses) == (1, 1)
+        assert entry.users == 2
+        pool.release(entry)
+        pool.release(entry)
+        assert entry.users == 0
+        assert len(pool) == 1
+
+    def test_max_open_files(self):
+        pool = DatasetPool(max_open_files=2)
+        entry1 = pool.acquire([self.pl_file, self.sfc_file], **self.kwargs)
+        entry2 = pool.acquire([self.pl_file], **self.kwargs)
+        # entry1 is in use and must not be closed
+        assert len(pool) == 2
+        pool.release(entry1)
+        pool.release(entry2)
+        entry3 = pool.acquire([self.sfc_file], **self.kwargs)
+        assert len(pool) == 2
+        assert pool.acquire([self.pl_file], **self.kwargs) is entry2
+        pool.release(entry2)
+        pool.release(entry3)
+        pool.clear()
+        assert len(pool) == 0
+
+    def test_modified(self):
+        pool = DatasetPool()
+        entry = pool.acquire([self.pl_file], **self.kwargs)
+        pool.release(entry)
+        entry.mtimes[0] -= 1
+        assert pool.acquire([self.pl_file], **self.kwargs) is not entry
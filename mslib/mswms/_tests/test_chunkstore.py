@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms._tests.test_chunkstore
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides pytest functions to tests mswms.chunkstore
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import io
+import json
+import os
+from datetime import datetime
+
+import mock
+import netCDF4
+import numpy as np
+import PIL.Image
+import pytest
+
+from mslib.mswms import chunkstore
+from mslib.mswms.dataaccess import ChunkedDataAccess, DefaultDataAccess
+from mslib.mswms.mss_plot_driver import HorizontalSectionDriver, VerticalSectionDriver
+import mslib.mswms.mpl_hsec_styles as mpl_hsec_styles
+import mslib.mswms.mpl_vsec_styles as mpl_vsec_styles
+from mslib._tests.constants import DATA_DIR
+
+PL_FILE = "20121017_12_ecmwf_forecast.PRESSURE_LEVELS.EUR_LL015.036.pl.nc"
+
+
+@pytest.fixture(scope="module")
+def store_dir(tmpdir_factory):
+    """The demodata converted into chunk stores with chunks smaller than the
+       fields.
+    """
+    path = str(tmpdir_factory.mktemp("stores"))
+    filenames = [os.path.join(DATA_DIR, _x) for _x in sorted(os.listdir(DATA_DIR))]
+    assert chunkstore.convert_files(filenames, output_dir=path, chunks={"lat": 16, "lon": 32}) == []
+    return path
+
+
+def test_convert(store_dir):
+    store = os.path.join(store_dir, chunkstore.get_store_name(PL_FILE))
+    assert chunkstore.is_chunk_store(store) and not chunkstore.is_chunk_store(store_dir)
+    with netCDF4.Dataset(os.path.join(DATA_DIR, PL_FILE)) as expected, chunkstore.ChunkedDataset(store) as dataset:
+        assert sorted(dataset.variables) == sorted(expected.variables)
+        assert dict(dataset.dimensions) == {_x: len(_y) for _x, _y in expected.dimensions.items()}
+        for name in ["time", "isobaric", "lat", "lon", "air_temperature"]:
+            variable, expected_variable = dataset.variables[name], expected.variables[name]
+            assert variable.name == name and variable.dimensions == expected_variable.dimensions
+            assert variable.shape == expected_variable.shape
+            assert variable.units == expected_variable.units
+            assert getattr(variable, "standard_name", None) == getattr(expected_variable, "standard_name", None)
+        variable, expected_variable = dataset.variables["air_temperature"], expected.variables["air_temperature"]
+        assert variable.chunks == (1, 1, 16, 32)
+        for key in [slice(None), (2, 5), (slice(1, 6, 2), 3, slice(10, 30), slice(None, None, -1)),
+                    (-1, slice(None, None, -1), 7, [3, 50, 99]), ([0, 2, 3], Ellipsis, 4), (0, 0, 5, 5)]:
+            np.testing.assert_array_equal(variable[key], expected_variable[key])
+        with pytest.raises(IndexError):
+            variable[7]
+
+    # stores are replaced as a whole
+    chunkstore.convert(os.path.join(DATA_DIR, PL_FILE), store, chunks={"lat": 16, "lon": 32})
+    assert [_x for _x in os.listdir(store_dir) if _x.startswith(".")] == []
+
+
+def test_read_covering_chunks(store_dir):
+    store = os.path.join(store_dir, chunkstore.get_store_name(PL_FILE))
+    variable = chunkstore.ChunkedDataset(store).variables["air_temperature"]
+    with mock.patch.object(variable, "_read_chunk", wraps=variable._read_chunk) as read_chunk:
+        variable[2, 3, 10:20, 30:35]
+        assert sorted(_x[0][0] for _x in read_chunk.call_args_list) == [
+            (2, 3, 0, 0), (2, 3, 0, 1), (2, 3, 1, 0), (2, 3, 1, 1)]
+
+
+def test_masked_values(tmpdir):
+    filename = str(tmpdir.join("masked.nc"))
+    with netCDF4.Dataset(filename, "w") as dataset:
+        dataset.title = "masked values"
+        dataset.createDimension("x", 5)
+        dataset.createDimension("y", 4)
+        packed = dataset.createVariable("packed", "i2", ("x", "y"), fill_value=-1)
+        packed.scale_factor = 0.5
+        packed.units = "K"
+        packed[:] = np.ma.masked_array(np.arange(20).reshape(5, 4), mask=np.arange(20) % 3 == 0)
+        integer = dataset.createVariable("integer", "i4", ("x", "y"))
+        integer[:] = np.ma.masked_array(np.arange(20).reshape(5, 4), mask=np.arange(20) < 8)
+    chunkstore.convert(filename, str(tmpdir.join("masked.zarr")), chunks={"x": 2, "y": 4})
+    with netCDF4.Dataset(filename) as expected:
+        dataset = chunkstore.ChunkedDataset(str(tmpdir.join("masked.zarr")))
+        assert dataset.title == "masked values" and dataset.variables["packed"].ncattrs() == ["units"]
+        for name in ["packed", "integer"]:
+            values, expected_values = dataset.variables[name][:], expected.variables[name][:]
+            assert values.dtype.kind == expected_values.dtype.kind
+            assert (values.mask == expected_values.mask).all()
+            assert (values == expected_values).all()
+    # chunks of masked values only are not stored
+    assert sorted(os.listdir(str(tmpdir.join("masked.zarr", "integer")))) == [".zarray", ".zattrs", "1.0", "2.0"]
+    with open(str(tmpdir.join("masked.zarr", "integer", ".zarray"))) as fid:
+        assert json.load(fid)["compressor"] == {"id": "zlib", "level": 1}
+
+
+class Test_ChunkedDataAccess(object):
+    def setup(self):
+        self.data = DefaultDataAccess(DATA_DIR, "EUR_LL015")
+        self.data.setup()
+
+    def test_setup(self, store_dir):
+        data = ChunkedDataAccess(store_dir, "EUR_LL015")
+        data.setup()
+        assert data.get_all_datafiles() == [chunkstore.get_store_name(_x) for _x in self.data.get_all_datafiles()]
+        assert data.get_init_times() == self.data.get_init_times()
+        init_time = datetime(2012, 10, 17, 12)
+        for vartype, variable in [("pl", "air_temperature"), ("ml", "air_pressure"),
+                                  ("sfc", "air_pressure_at_sea_level")]:
+            assert data.get_valid_times(variable, vartype, init_time) == self.data.get_valid_times(
+                variable, vartype, init_time)
+            assert data.get_filename(variable, vartype, init_time, init_time) == chunkstore.get_store_name(
+                self.data.get_filename(variable, vartype, init_time, init_time))
+        assert list(data.get_elevations("pl")) == list(self.data.get_elevations("pl"))
+        assert [_x[0] for _x in data.get_data_state()] == data.get_all_datafiles()
+
+    def test_drivers(self, store_dir):
+        data = ChunkedDataAccess(store_dir, "EUR_LL015")
+        data.setup()
+        init_time = datetime(2012, 10, 17, 12)
+
+        def pixels(image):
+            return np.asarray(PIL.Image.open(io.BytesIO(image)))
+
+        images = []
+        for data_access in [self.data, data]:
+            driver = HorizontalSectionDriver(data_access)
+            driver.set_plot_parameters(
+                plot_object=mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=driver), bbox=[-15, 35, 30, 65],
+                level=500, crs="EPSG:4326", init_time=init_time, valid_time=init_time, noframe=False)
+            images.append(driver.plot())
+            driver = VerticalSectionDriver(data_access)
+            driver.set_plot_parameters(
+                plot_object=mpl_vsec_styles.VS_TemperatureStyle_01(driver=driver),
+                vsec_path=[[45., 8.], [50., 12.], [51., 15.]], vsec_numpoints=101, vsec_path_connection="linear",
+                init_time=init_time, valid_time=init_time, bbox=[101, 1050, 10, 180], noframe=False)
+            images.append(driver.plot())
+        assert (pixels(images[0]) == pixels(images[2])).all()
+        assert (pixels(images[1]) == pixels(images[3])).all()
+
+        values = [HorizontalSectionDriver(_x).get_point_values(
+            [("pl", "air_temperature", "K")], init_time, 50.5, 10.5, level=500) for _x in [self.data, data]]
+        np.testing.assert_array_equal(values[0]["pl"]["air_temperature"]["values"],
+                                      values[1]["pl"]["air_temperature"]["values"])
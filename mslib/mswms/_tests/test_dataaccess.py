@@ -26,10 +26,15 @@
     limitations under the License.
 """
 
+import json
 import os
+import shutil
+import sqlite3
 from datetime import datetime
 
 import mock
+import numpy as np
+import pytest
 
 from mslib.mswms.dataaccess import DefaultDataAccess, CachedDataAccess
 from mslib._tests.constants import DATA_DIR
@@ -52,6 +57,27 @@ class Test_DefaultDataAccess(object):
                                          fullpath=True)
         assert filename == os.path.join(DATA_DIR, filename)
 
+    def test_get_filename_unknown(self):
+        # unknown files are not searched for by requests
+        with mock.patch.object(self.dut, "setup") as setup:
+            with pytest.raises(ValueError):
+                self.dut.get_filename("air_pressure", "ml", datetime(2012, 10, 17, 12, 0), datetime(2012, 10, 20))
+            assert not setup.called
+
+    def test_build_filetree(self):
+        # concurrent requests see the complete tree until the new one is built
+        filetree = self.dut._filetree
+        add_to_filetree = self.dut._add_to_filetree
+
+        def check(*args):
+            assert self.dut._filetree is filetree
+            add_to_filetree(*args)
+
+        with mock.patch.object(self.dut, "_add_to_filetree", side_effect=check) as mocked:
+            self.dut.setup()
+        assert mocked.called
+        assert self.dut._filetree == filetree and self.dut._filetree is not filetree
+
     def test_get_datapath(self):
         assert self.dut.get_datapath() == DATA_DIR
 
@@ -63,6 +89,45 @@ class Test_DefaultDataAccess(object):
         all_init_times = self.dut.get_init_times()
         assert all_init_times == [datetime(2012, 10, 17, 12, 0)]
 
+    def test_get_data_state(self):
+        state = self.dut.get_data_state()
+        assert [_x[0] for _x in state] == sorted(os.listdir(DATA_DIR))
+        filename = os.path.join(DATA_DIR, state[0][0])
+        assert state[0][1:] == (os.path.getmtime(filename), os.path.getsize(filename))
+        assert DefaultDataAccess(DATA_DIR, "EUR_XYZ").get_data_state() == ()
+
+    def test_setup_parallel(self):
+        dut = type(self.dut)(DATA_DIR, "EUR_LL015", scan_processes=2)
+        dut.setup()
+        assert dut._filetree == self.dut._filetree
+        assert dut._elevations.keys() == self.dut._elevations.keys()
+        for vert_type in dut._elevations:
+            assert list(dut.get_elevations(vert_type)) == list(self.dut.get_elevations(vert_type))
+            assert dut._elevations[vert_type]["filename"] == self.dut._elevations[vert_type]["filename"]
+
+    def test_update_files(self, tmpdir):
+        filenames = sorted(self.dut.get_all_datafiles())
+        for filename in filenames[1:]:
+            shutil.copy2(os.path.join(DATA_DIR, filename), str(tmpdir))
+        dut = type(self.dut)(str(tmpdir), "EUR_LL015")
+        dut.setup()
+        filetree = dut._filetree
+        assert not dut.update_files(["unrelated.nc"], [])
+
+        shutil.copy2(os.path.join(DATA_DIR, filenames[0]), str(tmpdir))
+        dut._parse_file = mock.Mock(wraps=dut._parse_file)
+        assert dut.update_files([filenames[0]], [])
+        dut._parse_file.assert_called_once_with(filenames[0])
+        assert dut._filetree == self.dut._filetree
+        assert sorted(dut.get_all_datafiles()) == filenames
+        for vert_type in self.dut._elevations:
+            assert list(dut.get_elevations(vert_type)) == list(self.dut.get_elevations(vert_type))
+
+        os.remove(str(tmpdir.join(filenames[0])))
+        assert dut.update_files([], [filenames[0]])
+        assert dut._filetree == filetree
+        assert sorted(dut.get_all_datafiles()) == filenames[1:]
+
     def test_mfDatasetArgs(self):
         mfDatasetArgs = self.dut.mfDatasetArgs()
         assert mfDatasetArgs == {'skip_dim_check': []}
@@ -133,6 +198,42 @@ class Test_CachedDataAccess(Test_DefaultDataAccess):
         self.dut.setup()
         assert "nothere" not in self.dut._file_cache
 
+    def test_persistent_cache(self, tmpdir):
+        index_filename = str(tmpdir.join("index.sqlite"))
+        dut = CachedDataAccess(DATA_DIR, "EUR_LL015", index_filename=index_filename)
+        dut.setup()
+        assert os.path.exists(index_filename)
+
+        dut = CachedDataAccess(DATA_DIR, "EUR_LL015", index_filename=index_filename)
+        assert sorted(dut._file_cache) == sorted(self.dut._file_cache)
+        dut._parse_file = mock.MagicMock()
+        dut.setup()
+        assert dut._parse_file.call_count == 0
+        assert dut.get_init_times() == self.dut.get_init_times()
+        assert dut._filetree == self.dut._filetree
+        for vert_type in self.dut._elevations:
+            assert list(dut.get_elevations(vert_type)) == list(self.dut.get_elevations(vert_type))
+            assert np.asarray(dut.get_elevations(vert_type)).dtype == \
+                np.asarray(self.dut.get_elevations(vert_type)).dtype
+
+        # the contents are stored as JSON, not as pickles
+        connection = sqlite3.connect(index_filename)
+        try:
+            for content, in connection.execute("SELECT content FROM files"):
+                assert isinstance(json.loads(content), dict)
+        finally:
+            connection.close()
+
+        # entries of modified files are ignored
+        filename = os.path.join(DATA_DIR, self.dut.get_all_datafiles()[0])
+        mtime = os.path.getmtime(filename)
+        os.utime(filename, (mtime + 1, mtime + 1))
+        try:
+            dut = CachedDataAccess(DATA_DIR, "EUR_LL015", index_filename=index_filename)
+            assert len(dut._file_cache) == len(self.dut._file_cache) - 1
+        finally:
+            os.utime(filename, (mtime, mtime))
+
 
 class Test_DefaultDataAccessNoInit(object):
     def setup(self):
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms._tests.test_metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides pytest functions to tests mswms.metrics
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import time
+
+import mock
+
+from mslib.mswms import metrics
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter("test_total", "A counter.", ["name"]))
+    histogram = registry.register(metrics.Histogram("test_seconds", "A histogram.", ["name"], buckets=[1, 2]))
+    counter.inc(['a"b'], 2)
+    histogram.observe(0.5, ["x"])
+    histogram.observe(1.5, ["x"])
+    histogram.observe(5, ["x"])
+    assert registry.register(metrics.Counter("test_total", "Another counter.")) is counter
+    assert registry.render() == "\n".join([
+        "# HELP test_total A counter.",
+        "# TYPE test_total counter",
+        'test_total{name="a\\"b"} 2.0',
+        "# HELP test_seconds A histogram.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{name="x",le="1"} 1',
+        'test_seconds_bucket{name="x",le="2"} 2',
+        'test_seconds_bucket{name="x",le="+Inf"} 3',
+        'test_seconds_sum{name="x"} 7.0',
+        'test_seconds_count{name="x"} 3']) + "\n"
+
+
+def test_phases():
+    # phases outside of collected requests are ignored
+    with metrics.phase("outer"):
+        metrics.add_read_bytes(10)
+    assert metrics.current() is None
+
+    with metrics.collect() as request:
+        with metrics.phase("outer"):
+            time.sleep(0.02)
+            with metrics.phase("inner"):
+                time.sleep(0.05)
+                metrics.add_read_bytes(10)
+                metrics.observe_array_bytes(100)
+                metrics.observe_array_bytes(50)
+                metrics.count_cache("field", True)
+                metrics.count_cache("field", False)
+                metrics.count_cache("field", False)
+    assert metrics.current() is None
+    # the time of nested phases is not counted for the outer phase
+    assert 0.02 <= request.phases["outer"] < 0.05
+    assert request.phases["inner"] >= 0.05
+    assert request.to_dict() == {
+        "phases": dict(request.phases), "read_bytes": 10, "peak_array_bytes": 100,
+        "cache_events": {("field", "hit"): 1, ("field", "miss"): 2}}
+
+    with metrics.collect() as total:
+        total.update(request.to_dict())
+        total.update(request.to_dict())
+    assert total.read_bytes == 20 and total.peak_array_bytes == 100
+    assert total.cache_events[("field", "miss")] == 4
+
+    with mock.patch.object(metrics, "REQUESTS", metrics.Counter("requests", "")) as requests, \
+            mock.patch.object(metrics, "PHASE_SECONDS", metrics.Histogram("phases", "")) as phases:
+        total.record("getmap", "a.b")
+        assert requests.get(("getmap", "a.b", "ok")) == 1
+        assert phases.get_count(("getmap", "a.b", "inner")) == 1
+
+
+def test_record_composite():
+    with metrics.collect() as request:
+        with metrics.phase("plot"):
+            pass
+    with mock.patch.object(metrics, "REQUESTS", metrics.Counter("requests_total", "", ["mode", "layer", "status"])):
+        request.record("getmap", "ds.layer")
+        request.record("getmap", "ds.layer,ds.overlay")
+        request.record("getmap", "ds.layer,ds.other")
+        assert dict(metrics.REQUESTS._values) == {
+            ("getmap", "ds.layer", "ok"): 1, ("getmap", metrics.COMPOSITE_LAYER, "ok"): 2}
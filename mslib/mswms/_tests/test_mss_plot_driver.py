@@ -27,12 +27,22 @@
     limitations under the License.
 """
 
+import base64
 from datetime import datetime
+import io
+import json
+import mock
+import netCDF4
+import numpy as np
+import PIL.Image
 import pytest
+from mslib.mswms.cache import FieldCache, SectionCache, NETCDF_LOCK
 from mslib.mswms.mss_plot_driver import VerticalSectionDriver, HorizontalSectionDriver
 import mss_wms_settings
+from mslib import thermolib, utils
 import mslib.mswms.mpl_vsec_styles as mpl_vsec_styles
 import mslib.mswms.mpl_hsec_styles as mpl_hsec_styles
+from mslib.mswms import mpl_hsec, mss_plot_driver
 
 
 class Test_VSec(object):
@@ -50,7 +60,7 @@ class Test_VSec(object):
         self.valid_time = datetime(2012, 10, 17, 12)
         self.vsec = VerticalSectionDriver(data)
 
-    def plot(self, plot_object, style="default"):
+    def plot(self, plot_object, style="default", return_format="image/png"):
         self.vsec.set_plot_parameters(plot_object=plot_object,
                                       bbox=self.bbox,
                                       vsec_path=self.path,
@@ -60,7 +70,8 @@ class Test_VSec(object):
                                       valid_time=self.valid_time,
                                       style=style,
                                       noframe=False,
-                                      show=False)
+                                      show=False,
+                                      return_format=return_format)
         return self.vsec.plot()
 
     def test_repeated_locations(self):
@@ -76,6 +87,66 @@ class Test_VSec(object):
         img = self.plot(mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec))
         assert img is not None
 
+    def test_derived_field_cache(self):
+        self.vsec = VerticalSectionDriver(self.vsec.data_access, field_cache=FieldCache())
+        with mock.patch("mslib.thermolib.pot_temp", wraps=thermolib.pot_temp) as pot_temp:
+            self.plot(mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec))
+            self.plot(mpl_vsec_styles.VS_HorizontalVelocityStyle_01(driver=self.vsec))
+            assert pot_temp.call_count == 1
+            self.path = self.path[:2]
+            self.plot(mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec))
+            assert pot_temp.call_count == 2
+
+    def test_derived_field_units(self):
+        # the inputs of derived fields are converted to the units of the registry
+        class Style(mpl_vsec_styles.VS_TemperatureStyle_01):
+            required_datafields = [("ml", "air_pressure", "hPa"), ("ml", "air_temperature", "degC")]
+
+        with mock.patch("mslib.thermolib.pot_temp", wraps=thermolib.pot_temp) as pot_temp:
+            self.plot(mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec))
+            self.plot(Style(driver=self.vsec))
+        assert pot_temp.call_count == 2
+        for expected, value in zip(*[_x[0] for _x in pot_temp.call_args_list]):
+            np.testing.assert_allclose(value, expected, rtol=1e-5)
+
+    def test_section_cache(self):
+        self.vsec = VerticalSectionDriver(self.vsec.data_access, section_cache=SectionCache())
+        with mock.patch("mslib.utils.path_points", wraps=utils.path_points) as path_points, \
+                mock.patch("mslib.utils.get_vertsec_stencil", wraps=utils.get_vertsec_stencil) as stencil:
+            self.plot(mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec))
+            self.valid_time = datetime(2012, 10, 17, 18)
+            self.plot(mpl_vsec_styles.VS_HorizontalVelocityStyle_01(driver=self.vsec))
+            assert path_points.call_count == 1
+            assert stencil.call_count == 1
+            self.path = self.path[:2]
+            self.plot(mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec))
+            assert path_points.call_count == 2
+            assert stencil.call_count == 2
+
+    def test_data_formats(self):
+        style = mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec)
+        xml = self.plot(style, return_format="text/xml")
+        assert "<air_temperature num_levels=" in xml
+
+        npz = np.load(io.BytesIO(self.plot(style, return_format="application/x-npz")))
+        temperature = npz["air_temperature"]
+        assert temperature.dtype == np.float32
+        assert npz["lats"].shape == npz["lons"].shape == temperature.shape[1:]
+
+        result = json.loads(self.plot(style, return_format="application/json"))
+        data = result["data"]["air_temperature"]
+        values = np.frombuffer(base64.b64decode(data["data"]), dtype="<f4").reshape(data["shape"])
+        assert np.array_equal(values, temperature, equal_nan=True)
+        assert result["units"]["air_temperature"] == style.data_units["air_temperature"]
+
+        with netCDF4.Dataset("vsec.nc", memory=self.plot(style, return_format="application/x-netcdf")) as dataset:
+            assert dataset.variables["air_temperature"].standard_name == "air_temperature"
+            assert np.array_equal(dataset.variables["lat"][:], npz["lats"])
+            assert np.ma.allclose(dataset.variables["air_temperature"][:], np.ma.masked_invalid(temperature))
+
+        with pytest.raises(ValueError):
+            self.plot(style, return_format="image/gif")
+
     def test_VS_TemperatureStyle_01(self):
         img = self.plot(mpl_vsec_styles.VS_TemperatureStyle_01(driver=self.vsec))
         assert img is not None
@@ -206,6 +277,134 @@ class Test_HSec(object):
         img = self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800)
         assert img is not None
 
+    def test_field_cache(self):
+        hsec = self.hsec
+        self.hsec = HorizontalSectionDriver(hsec.data_access, field_cache=FieldCache())
+        img = self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800)
+        num_fields = len(self.hsec.data_vars)
+        assert self.hsec.field_cache.misses == num_fields
+        assert len(self.hsec.field_cache) == num_fields
+
+        # the cached fields are already converted to the units of the style
+        with mock.patch("mslib.mswms.mss_plot_driver.convert_to") as convert_to:
+            assert self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800) == img
+            assert convert_to.call_count == 0
+        assert self.hsec.field_cache.hits == num_fields
+        self.hsec = hsec
+        assert self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800) == img
+
+    def test_netcdf_lock(self):
+        # only reading is serialised, not converting the read fields
+        locked = []
+
+        def convert_to(*args):
+            locked.append(NETCDF_LOCK._is_owned())
+            return utils.convert_to(*args)
+
+        with mock.patch.object(mss_plot_driver, "convert_to", side_effect=convert_to):
+            self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800)
+        assert locked and not any(locked)
+
+    def test_mesh_cache(self):
+        with mock.patch.object(mpl_hsec, "MESH_CACHE", None):
+            img = self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800)
+            cache = mpl_hsec.get_mesh_cache()
+            assert len(cache) == 1 and cache.misses == 1
+            assert self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800) == img
+            self.plot(mpl_hsec_styles.HS_GeopotentialWindStyle_PL(driver=self.hsec), level=300)
+            assert len(cache) == 1 and cache.misses == 1
+            self.plot(mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec), level=800, crs="EPSG:77790010")
+            assert len(cache) == 2 and cache.misses == 2
+
+    def test_overlays(self):
+        self.hsec = HorizontalSectionDriver(self.hsec.data_access, field_cache=FieldCache())
+        base = mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec)
+        overlay = mpl_hsec_styles.HS_GeopotentialWindStyle_PL(driver=self.hsec)
+        img = self.plot(base, level=800)
+        self.hsec.field_cache.clear()
+        misses = self.hsec.field_cache.misses
+        self.hsec.set_plot_parameters(plot_object=base, bbox=self.bbox, level=800, crs="EPSG:4326",
+                                      init_time=self.init_time, valid_time=self.valid_time, noframe=False,
+                                      overlays=[(overlay, "wind_10_65")])
+        with mock.patch.object(mpl_hsec.MPLBasemapHorizontalSectionStyle, "_create_map", autospec=True,
+                               side_effect=mpl_hsec.MPLBasemapHorizontalSectionStyle._create_map) as create_map:
+            composite = self.hsec.plot()
+            assert create_map.call_count == 1
+        assert composite is not None and composite != img
+        assert overlay.bm is base.bm
+        # fields required by both layers are read once
+        names = set(_x[1] for _x in base.required_datafields + overlay.required_datafields)
+        assert self.hsec.field_cache.misses - misses == len(names)
+        assert overlay.style == "wind_10_65"
+        assert self.hsec.plot_object is base and self.hsec.style is None
+
+    def test_plot_frames(self):
+        plot_object = mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=self.hsec)
+        valid_times = [datetime(2012, 10, 17, 12), datetime(2012, 10, 18, 0), datetime(2012, 10, 17, 12)]
+        self.hsec.set_plot_parameters(plot_object=plot_object, bbox=self.bbox, level=800, crs="EPSG:4326",
+                                      init_time=self.init_time, valid_time=valid_times[0], noframe=False)
+        with mock.patch.object(mpl_hsec.MPLBasemapHorizontalSectionStyle, "_create_map", autospec=True,
+                               side_effect=mpl_hsec.MPLBasemapHorizontalSectionStyle._create_map) as create_map:
+            frames = self.hsec.plot_frames(valid_times)
+            assert create_map.call_count == 1
+        assert len(frames) == 3 and frames[0] != frames[1]
+        assert self.hsec.fc_time == valid_times[0]
+
+        # reused maps show the same as maps drawn anew
+        def pixels(image):
+            return np.asarray(PIL.Image.open(io.BytesIO(image)).convert("RGB"))
+        assert (pixels(frames[2]) == pixels(frames[0])).all()
+        self.valid_time = valid_times[1]
+        assert (pixels(frames[1]) == pixels(self.plot(plot_object, style=None, level=800))).all()
+
+    def test_get_point_values(self):
+        fields = [("pl", "air_temperature", "degC"), ("pl", "geopotential_height", "m")]
+        with mock.patch.object(utils, "get_point_stencil", wraps=utils.get_point_stencil) as stencil:
+            result = self.hsec.get_point_values(fields, self.init_time, 50.5, 10.5, level=500)
+            assert stencil.call_count == 2
+        temperature = result["pl"]["air_temperature"]
+        assert temperature["units"] == "degC" and temperature["levels"] == [500]
+        assert temperature["valid_times"][0] == self.init_time and len(temperature["valid_times"]) == 7
+        assert temperature["values"].shape == (7,)
+
+        # bilinear interpolation at the centre of four grid points
+        filename = self.hsec.data_access.get_filename(
+            "air_temperature", "pl", self.init_time, self.init_time, fullpath=True)
+        with netCDF4.Dataset(filename) as dataset:
+            lats, lons = list(dataset.variables["lat"][:]), list(dataset.variables["lon"][:])
+            levels = list(dataset.variables["isobaric"][:])
+            expected = dataset.variables["air_temperature"][
+                :, levels.index(500), lats.index(51):lats.index(50) + 1, lons.index(10):lons.index(11) + 1]
+        np.testing.assert_allclose(temperature["values"], expected.mean(axis=(1, 2)) - 273.15, rtol=1e-5)
+
+        # profiles on all levels for selected valid times
+        valid_times = [datetime(2012, 10, 18, 0), datetime(2012, 10, 17, 12), datetime(2012, 10, 30)]
+        result = self.hsec.get_point_values(fields[:1], self.init_time, 50.5, 10.5, valid_times=valid_times)
+        temperature = result["pl"]["air_temperature"]
+        assert temperature["valid_times"] == valid_times[1::-1] and len(temperature["levels"]) == 14
+        assert temperature["values"].shape == (2, 14)
+
+        with pytest.raises(ValueError):
+            self.hsec.get_point_values(fields, self.init_time, 10, 10.5, level=500)
+
+    def test_decimation(self):
+        hsec = HorizontalSectionDriver(self.hsec.data_access, points_per_pixel=1)
+        plot_object = mpl_hsec_styles.HS_TemperatureStyle_PL_01(driver=hsec)
+        hsec.set_plot_parameters(plot_object=plot_object, bbox=self.bbox, level=800, crs="EPSG:4326",
+                                 init_time=self.init_time, valid_time=self.valid_time, figsize=(20, 10))
+        assert hsec.plot() is not None
+        assert hsec.decimation > 1
+        shape = (len(hsec.window_lat_data), len(hsec.window_lon_data))
+        assert shape[0] < len(hsec.lat_data[hsec.lat_window]) and np.all(np.diff(hsec.window_lon_data) > 0)
+        for field in hsec.loaded_data.values():
+            assert field.shape == shape
+
+        # full resolution for larger images
+        hsec.set_plot_parameters(plot_object=plot_object, bbox=self.bbox, level=800, crs="EPSG:4326",
+                                 init_time=self.init_time, valid_time=self.valid_time)
+        hsec.plot()
+        assert hsec.decimation == 1
+
     def test_HS_GeopotentialWindStyle_PL(self):
         img = self.plot(mpl_hsec_styles.HS_GeopotentialWindStyle_PL(driver=self.hsec), level=300)
         assert img is not None
@@ -231,6 +430,13 @@ class Test_HSec(object):
             style="equivalent_latitude", level=300)
         assert img is not None
 
+    def test_derived_field_without_pressure(self):
+        class Style(mpl_hsec_styles.HS_RelativeHumidityStyle_PL_01):
+            required_datafields = [("ml", "air_temperature", "K"), ("ml", "specific_humidity", "kg/kg")]
+
+        with pytest.raises(ValueError):
+            self.plot(Style(driver=self.hsec), level=10)
+
     def test_HS_RelativeHumidityStyle_PL_01(self):
         img = self.plot(mpl_hsec_styles.HS_RelativeHumidityStyle_PL_01(driver=self.hsec), level=300)
         assert img is not None
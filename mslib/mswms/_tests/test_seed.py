@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms._tests.test_seed
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides pytest functions to tests mswms.seed
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import datetime
+
+import mock
+import pytest
+
+import mslib.mswms.wms
+from mslib.mswms import seed
+from mslib.mswms.cache import ImageCache
+
+MAP_SECTIONS = {
+    "europe": {"CRS": "EPSG:4326", "map": {"llcrnrlon": -50.0, "llcrnrlat": 20.0,
+                                           "urcrnrlon": 20.0, "urcrnrlat": 75.0},
+               "width": 300, "height": 200}}
+VSEC_PATHS = {
+    "north": {"path": [[52.78, -8.93], [48.08, 11.28]], "bbox": [201, 500, 10, 50], "width": 300, "height": 200}}
+
+
+class Test_Seed(object):
+    def setup(self):
+        self.server = mslib.mswms.wms.server
+
+    def test_get_seed_queries(self):
+        queries = seed.get_seed_queries(
+            self.server, MAP_SECTIONS, VSEC_PATHS, {"pl": [200, 300]},
+            layers=["ecmwf_EUR_LL015.PLDiv01", "ecmwf_EUR_LL015.VS_HV01"])
+        assert {_x[0] for _x in queries} == {"getmap"}
+        layers = {_x[1]["LAYERS"] for _x in queries}
+        assert layers == {"ecmwf_EUR_LL015.PLDiv01", "ecmwf_EUR_LL015.VS_HV01"}
+        hsec = [_x[1] for _x in queries if _x[1]["LAYERS"].endswith("PLDiv01")]
+        assert {float(_x["ELEVATION"]) for _x in hsec} == {200, 300}
+        assert hsec[0]["BBOX"] == "-50.0,20.0,20.0,75.0" and hsec[0]["SRS"] == "EPSG:4326"
+        vsec = [_x[1] for _x in queries if _x[1]["LAYERS"].endswith("VS_HV01")]
+        assert vsec[0]["PATH"] == "52.78,-8.93,48.08,11.28" and "ELEVATION" not in vsec[0]
+        # ordered by valid time
+        times = [_x[1]["TIME"] for _x in queries]
+        assert times == sorted(times)
+
+        assert seed.get_seed_queries(self.server, MAP_SECTIONS, VSEC_PATHS, layers=["unknown.*"]) == []
+        assert seed.get_seed_queries(
+            self.server, MAP_SECTIONS, layers=["ecmwf_EUR_LL015.PLDiv01"],
+            init_time=datetime.datetime(1999, 1, 1)) == []
+
+    def test_seed(self, tmpdir):
+        queries = seed.get_seed_queries(
+            self.server, MAP_SECTIONS, elevations={"pl": [200]}, layers=["ecmwf_EUR_LL015.PLDiv01"])
+        job = queries[0]
+        with mock.patch.object(self.server, "image_cache", ImageCache(directory=str(tmpdir))):
+            status, nbytes, message = seed._seed(job)
+            assert (status, message) == ("rendered", None) and nbytes > 0
+            assert seed._seed(job) == ("skipped", 0, None)
+            # a failing request does not abort seeding
+            assert seed._seed(("getmap", dict(job[1], LAYERS="unknown")))[0] == "failed"
+
+    def test_seed_requires_directory(self):
+        with mock.patch.object(self.server, "image_cache", ImageCache()):
+            with pytest.raises(RuntimeError):
+                seed.seed(dry_run=True)
+
+    def test_seed_spawns_workers(self, tmpdir):
+        with mock.patch.object(self.server, "image_cache", ImageCache(directory=str(tmpdir))), \
+                mock.patch.object(seed.multiprocessing, "get_context") as get_context:
+            seed.seed(layers=["unknown.*"])
+        get_context.assert_called_once_with("spawn")
+        get_context.return_value.Pool.assert_called_once()
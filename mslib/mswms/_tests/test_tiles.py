@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms._tests.test_tiles
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides pytest functions to tests mswms.tiles
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import numpy as np
+import pytest
+
+from mslib.mswms import tiles
+
+
+def test_get_tile_bbox():
+    web_mercator = tiles.get_tile_matrix_set("WebMercatorQuad")
+    assert web_mercator.crs == "EPSG:3857"
+    extent = web_mercator.extent
+    assert tiles.get_tile_bbox(web_mercator, 0, 0, 0) == extent
+    assert np.allclose(tiles.get_tile_bbox(web_mercator, 1, 1, 0), (0, 0, extent[2], extent[3]))
+    assert np.allclose(tiles.get_tile_bbox(web_mercator, 2, 0, 0, 2, 2), (extent[0], 0, 0, extent[3]))
+
+    crs84 = tiles.get_tile_matrix_set("worldcrs84quad")
+    assert tiles.get_matrix_size(crs84, 0) == (2, 1)
+    assert tiles.get_tile_bbox(crs84, 0, 1, 0) == (0, -90, 180, 90)
+    assert tiles.get_tile_bbox(crs84, 3, 9, 2) == (22.5, 22.5, 45, 45)
+    assert tiles.get_tile_matrix_set("unknown") is None
+
+
+def test_get_metatile():
+    crs84 = tiles.get_tile_matrix_set("WorldCRS84Quad")
+    assert tiles.get_metatile(crs84, 3, 9, 2, 4) == (8, 0, 4, 4)
+    assert tiles.get_metatile(crs84, 3, 8, 3, 4) == (8, 0, 4, 4)
+    # metatiles are clipped to the tile matrix
+    assert tiles.get_metatile(crs84, 0, 1, 0, 4) == (0, 0, 2, 1)
+    assert tiles.get_metatile(crs84, 1, 3, 1, 3) == (3, 0, 1, 2)
+    with pytest.raises(ValueError):
+        tiles.get_metatile(crs84, 1, 4, 0, 4)
+    for zoom in [-1, tiles.MAX_ZOOM + 1, 2000]:
+        with pytest.raises(ValueError):
+            tiles.get_metatile(crs84, zoom, 0, 0, 4)
@@ -1,4 +1,12 @@
-from mslib.mswms.utils import Targets
+import io
+import zipfile
+
+import matplotlib as mpl
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+import numpy as np
+import PIL.Image
+
+from mslib.mswms.utils import Targets, encode_animation, encode_png, slice_png
 
 
 def test_targets():
@@ -9,3 +17,61 @@ def test_targets():
         Targets.get_range(standard_name)
         Targets.UNITS[standard_name]
         Targets.TITLES[standard_name]
+
+
+def test_encode_png():
+    fig = mpl.figure.Figure(figsize=(2, 1), dpi=50, facecolor="white")
+    ax = fig.add_axes([0.5, 0, 0.5, 1])
+    ax.imshow([[0, 1], [2, 3]], cmap=mpl.colors.ListedColormap(["red", "green", "blue", "black"]))
+    ax.axis("off")
+    fig.patch.set_alpha(0.)
+    canvas = FigureCanvas(fig)
+
+    image = PIL.Image.open(io.BytesIO(encode_png(canvas, transparent=True)))
+    assert image.mode == "P" and image.size == (100, 50)
+    rgba = np.asarray(image.convert("RGBA"))
+    assert rgba[25, 10].tolist() == [255, 255, 255, 0]
+    assert rgba[10, 60].tolist() == [255, 0, 0, 255]
+
+    palette = [(255, 255, 255), (255, 0, 0), (0, 128, 0), (0, 0, 255), (0, 0, 0)]
+    image = PIL.Image.open(io.BytesIO(encode_png(canvas, palette=palette, compress_level=1)))
+    assert "transparency" not in image.info
+    assert set(np.unique(np.asarray(image))) <= set(range(len(palette)))
+    assert np.asarray(image.convert("RGB"))[40, 90].tolist() == [0, 0, 0]
+
+
+def test_slice_png():
+    fig = mpl.figure.Figure(figsize=(2, 1), dpi=50, facecolor="white")
+    ax = fig.add_axes([0.5, 0, 0.5, 1])
+    ax.imshow([[0, 1], [2, 3]], cmap=mpl.colors.ListedColormap(["red", "green", "blue", "black"]))
+    ax.axis("off")
+    fig.patch.set_alpha(0.)
+    image = encode_png(FigureCanvas(fig), transparent=True)
+
+    tiles = slice_png(image, 2, 1)
+    assert sorted(tiles) == [(0, 0), (1, 0)]
+    left, right = [PIL.Image.open(io.BytesIO(tiles[_x])) for _x in [(0, 0), (1, 0)]]
+    assert left.size == right.size == (50, 50)
+    assert np.asarray(left.convert("RGBA"))[25, 10].tolist() == [255, 255, 255, 0]
+    assert np.asarray(right.convert("RGBA"))[10, 10].tolist() == [255, 0, 0, 255]
+
+
+def test_encode_animation():
+    frames = []
+    for colour in ["red", "blue"]:
+        fig = mpl.figure.Figure(figsize=(2, 1), dpi=50, facecolor="white")
+        ax = fig.add_axes([0.5, 0, 0.5, 1])
+        ax.imshow([[0]], cmap=mpl.colors.ListedColormap([colour]))
+        ax.axis("off")
+        fig.patch.set_alpha(0.)
+        frames.append(encode_png(FigureCanvas(fig), transparent=True))
+
+    for return_format in ["image/gif", "image/apng"]:
+        image = PIL.Image.open(io.BytesIO(encode_animation(frames, return_format, duration=200)))
+        assert image.n_frames == 2 and image.size == (100, 50)
+        image.seek(1)
+        rgba = np.asarray(image.convert("RGBA"))
+        assert rgba[25, 10, 3] == 0 and rgba[25, 60].tolist() == [0, 0, 255, 255]
+
+    archive = zipfile.ZipFile(io.BytesIO(encode_animation(frames, "application/zip", names=["a.png", "b.png"])))
+    assert archive.namelist() == ["a.png", "b.png"] and archive.read("b.png") == frames[1]
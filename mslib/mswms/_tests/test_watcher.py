@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms._tests.test_watcher
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides pytest functions to tests mswms.watcher
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import os
+import queue
+import sys
+
+import pytest
+
+from mslib.mswms.watcher import DirectoryWatcher
+
+
+class Test_DirectoryWatcher(object):
+    def check_watcher(self, path, use_inotify):
+        changes = queue.Queue()
+        with open(os.path.join(path, "old.nc"), "w") as fid:
+            fid.write("old")
+        watcher = DirectoryWatcher(
+            path, lambda *args: changes.put(args), interval=0.1, latency=0.05, use_inotify=use_inotify)
+        watcher.start()
+        try:
+            with open(os.path.join(path, "new.nc"), "w") as fid:
+                fid.write("new")
+            os.mkdir(os.path.join(path, "subdir"))
+            assert changes.get(timeout=10) == (["new.nc"], [])
+            os.remove(os.path.join(path, "old.nc"))
+            assert changes.get(timeout=10) == ([], ["old.nc"])
+            os.rename(os.path.join(path, "new.nc"), os.path.join(path, "renamed.nc"))
+            modified, removed = changes.get(timeout=10)
+            while "renamed.nc" not in modified:
+                modified, removed = changes.get(timeout=10)
+            assert modified == ["renamed.nc"]
+        finally:
+            watcher.stop()
+        assert changes.empty()
+        return watcher
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is only available on Linux")
+    def test_inotify(self, tmpdir):
+        assert DirectoryWatcher(str(tmpdir), None).uses_inotify
+        self.check_watcher(str(tmpdir), True)
+
+    def test_polling(self, tmpdir):
+        assert not DirectoryWatcher(str(tmpdir), None, use_inotify=False).uses_inotify
+        self.check_watcher(str(tmpdir), False)
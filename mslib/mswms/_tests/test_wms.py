@@ -26,7 +26,19 @@
     limitations under the License.
 """
 
+import concurrent.futures
+import datetime
+import io
+import json
+import threading
+import zipfile
+import mock
+import PIL.Image
+import pytest
 import mslib.mswms.mswms as mswms
+import mslib.mswms.wms
+import mslib.mswms.mpl_hsec_styles as mpl_hsec_styles
+from mslib.mswms.cache import ImageCache, SingleFlight
 from mslib._tests.utils import callback_ok_image, callback_ok_xml, callback_307_html
 
 
@@ -106,6 +118,42 @@ class Test_WMS(object):
         callback_ok_xml(result.status, result.headers)
         assert isinstance(result.data, bytes), result
 
+    def test_get_capabilities_cached(self):
+        server = mslib.mswms.wms.server
+        self.client = mswms.application.test_client()
+        query_string = 'request=GetCapabilities&service=WMS&version=1.3.0'
+        result = self.client.get(f'/?{query_string}')
+        callback_ok_xml(result.status, result.headers)
+        assert ("1.3.0", "http://localhost/") in server.capabilities_cache
+        assert server.refresh_data() is False
+        assert self.client.get(f'/?{query_string}').data == result.data
+
+        sequence = server.update_sequence
+        result = self.client.get(f'/?{query_string}&updatesequence={sequence}')
+        assert result.data.count(b"CurrentUpdateSequence") == 1
+
+        # pretend that the data has changed
+        server._data_state = {}
+        assert server.refresh_data() is True
+        assert server.update_sequence == sequence + 1
+        assert len(server.capabilities_cache) == 0
+        result = self.client.get(f'/?{query_string}&updatesequence={sequence}')
+        assert f'updateSequence="{sequence + 1}"'.encode("utf-8") in result.data
+        result = self.client.get(f'/?{query_string}&updatesequence={sequence + 2}')
+        assert result.data.count(b"InvalidUpdateSequence") == 1
+
+    def test_update_files(self):
+        server = mslib.mswms.wms.server
+        sequence = server.update_sequence
+        assert server.update_files(["ecmwf_EUR_LL015"], ["unrelated.nc"], []) is False
+        assert server.update_sequence == sequence
+        # lost events cause the data set to be set up again
+        server.capabilities_cache[("1.3.0", "http://localhost/")] = b""
+        assert server.update_files(["ecmwf_EUR_LL015"], None, None) is True
+        assert server.update_sequence == sequence + 1
+        assert len(server.capabilities_cache) == 0
+        assert server.refresh_data() is False
+
     def test_produce_hsec_plot(self):
         environ = {
             'wsgi.url_scheme': 'http',
@@ -130,6 +178,189 @@ class Test_WMS(object):
         result = self.client.get('/?{}'.format(environ["QUERY_STRING"]))
         callback_ok_image(result.status, result.headers)
 
+    def test_produce_hsec_plot_layers(self):
+        query_string = (
+            'layers=ecmwf_EUR_LL015.PLTemp01,ecmwf_EUR_LL015.PLGeopWind&styles=,wind_10_65&elevation=300&'
+            'srs=EPSG%3A4326&format=image%2Fpng&request=GetMap&bgcolor=0xFFFFFF&height=376&'
+            'dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&version=1.1.1&bbox=-50.0%2C20.0%2C20.0%2C75.0&'
+            'time=2012-10-17T12%3A00%3A00Z&exceptions=application%2Fvnd.ogc.se_xml&transparent=FALSE')
+        self.client = mswms.application.test_client()
+        result = self.client.get('/?{}'.format(query_string))
+        callback_ok_image(result.status, result.headers)
+        single = self.client.get('/?{}'.format(query_string.replace(",ecmwf_EUR_LL015.PLGeopWind", "")))
+        callback_ok_image(single.status, single.headers)
+        assert result.data != single.data
+
+        for orig, fake in [
+                ("ecmwf_EUR_LL015.PLGeopWind", "ecmwf_EUR_LL015.PLGeopWind99"),
+                ("ecmwf_EUR_LL015.PLGeopWind", "ecmwf_AUR_LL015.PLGeopWind")]:
+            result = self.client.get('/?{}'.format(query_string.replace(orig, fake)))
+            callback_ok_xml(result.status, result.headers)
+            assert result.data.count(b"LayerNotDefined") > 0, result
+
+    def test_produce_hsec_plot_layers_surface_base(self):
+        # the elevation only applies to the pressure level overlay
+        query_string = (
+            'layers=ecmwf_EUR_LL015.MSLP,ecmwf_EUR_LL015.PLTemp01&styles=&elevation=300&'
+            'srs=EPSG%3A4326&format=image%2Fpng&request=GetMap&bgcolor=0xFFFFFF&height=376&'
+            'dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&version=1.1.1&bbox=-50.0%2C20.0%2C20.0%2C75.0&'
+            'time=2012-10-17T12%3A00%3A00Z&exceptions=application%2Fvnd.ogc.se_xml&transparent=FALSE')
+        server = mslib.mswms.wms.server
+        layer = mpl_hsec_styles.HS_MSLPStyle_01(server.hsec_drivers["ecmwf_EUR_LL015"])
+        self.client = mswms.application.test_client()
+        with mock.patch.dict(server.hsec_layer_registry["ecmwf_EUR_LL015"], {"MSLP": layer}):
+            result = self.client.get('/?{}'.format(query_string))
+        callback_ok_image(result.status, result.headers)
+
+    def test_metrics(self):
+        self.client = mswms.application.test_client()
+        result = self.client.get(
+            '/?layers=ecmwf_EUR_LL015.PLDiv01&styles=&elevation=200&srs=EPSG%3A4326&format=image%2Fpng&'
+            'request=GetMap&bgcolor=0xFFFFFF&height=376&dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&'
+            'version=1.1.1&bbox=-50.0%2C20.0%2C20.0%2C75.0&time=2012-10-17T12%3A00%3A00Z&'
+            'exceptions=application%2Fvnd.ogc.se_xml&transparent=FALSE')
+        callback_ok_image(result.status, result.headers)
+        result = self.client.get('/metrics')
+        assert result.status_code == 404
+        with mock.patch.object(mslib.mswms.wms.mss_wms_settings, "enable_metrics", True, create=True):
+            result = self.client.get('/metrics')
+        assert result.status == "200 OK"
+        assert result.headers["Content-type"].startswith("text/plain")
+        text = result.data.decode("utf-8")
+        labels = 'mode="getmap",layer="ecmwf_EUR_LL015.PLDiv01"'
+        assert f'mswms_request_seconds_count{{{labels}}}' in text
+        for phase in ["parse", "open", "plot", "draw", "encode"]:
+            assert f'mswms_phase_seconds_count{{{labels},phase="{phase}"}}' in text
+        assert f'mswms_requests_total{{{labels},status="ok"}}' in text
+
+    def test_produce_animation(self):
+        query_string = (
+            'layers=ecmwf_EUR_LL015.PLDiv01,ecmwf_EUR_LL015.PLGeopWind&styles=,default&elevation=200&srs=EPSG%3A4326&'
+            'request=GetMap&height=376&dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&version=1.1.1&'
+            'bbox=-50.0%2C20.0%2C20.0%2C75.0&transparent=FALSE')
+        self.client = mswms.application.test_client()
+        result = self.client.get(
+            f'/?{query_string}&format=image/gif&time=2012-10-17T12:00:00Z,2012-10-18T00:00:00Z')
+        assert result.headers["Content-type"] == "image/gif"
+        image = PIL.Image.open(io.BytesIO(result.data))
+        assert image.size == (479, 376) and image.n_frames == 2
+
+        result = self.client.get(
+            f'/?{query_string}&format=application/zip&time=2012-10-17T12:00:00Z/2012-10-19T12:00:00Z/P1D')
+        assert result.headers["Content-type"] == "application/zip"
+        archive = zipfile.ZipFile(io.BytesIO(result.data))
+        assert archive.namelist() == ["20121017T120000Z.png", "20121018T120000Z.png"]
+
+        # frames rendered by several render processes are the same
+        server = mslib.mswms.wms.server
+        with mock.patch.object(server, "render_processes", 2), mock.patch.object(
+                server, "render_pool", mslib.mswms.wms._create_render_pool(2)):
+            try:
+                result = self.client.get(
+                    f'/?{query_string}&format=application/zip&time=2012-10-17T12:00:00Z,2012-10-18T12:00:00Z')
+            finally:
+                server.render_pool.shutdown()
+        parallel = zipfile.ZipFile(io.BytesIO(result.data))
+        assert [parallel.read(_x) for _x in parallel.namelist()] == [archive.read(_x) for _x in archive.namelist()]
+
+        result = self.client.get(
+            f'/?{query_string}&format=image/apng&time=2012-10-17T12:00:00Z/2012-10-18T00:00:00Z')
+        assert result.headers["Content-type"] == "image/apng"
+        assert PIL.Image.open(io.BytesIO(result.data)).n_frames > 1
+
+        for query in [f'{query_string}&format=image/png&time=2012-10-17T12:00:00Z,2012-10-18T00:00:00Z',
+                      f'{query_string}&format=image/gif&time=2012-10-17T12:00:00Z/2012-10-18T00:00:00Z/1D',
+                      f'{query_string}&format=image/gif&time=2000-10-17T12:00:00Z/2000-10-18T00:00:00Z']:
+            result = self.client.get(f'/?{query}')
+            callback_ok_xml(result.status, result.headers)
+            assert b"InvalidDimensionValue" in result.data
+
+    def test_parse_period(self):
+        assert mslib.mswms.wms._parse_period("PT6H") == datetime.timedelta(hours=6)
+        assert mslib.mswms.wms._parse_period("P1DT30M") == datetime.timedelta(days=1, minutes=30)
+        for value in ["P", "PT", "6H", "P1H"]:
+            with pytest.raises(ValueError):
+                mslib.mswms.wms._parse_period(value)
+
+    def test_produce_tile(self):
+        server = mslib.mswms.wms.server
+        query = '?styles=&elevation=200&dim_init_time=2012-10-17T12%3A00%3A00Z&time=2012-10-17T12%3A00%3A00Z'
+        self.client = mswms.application.test_client()
+        with mock.patch.object(server, "tile_cache", ImageCache()):
+            result = self.client.get(f'/tiles/WorldCRS84Quad/ecmwf_EUR_LL015.PLDiv01/3/8/1.png{query}')
+            callback_ok_image(result.status, result.headers)
+            assert PIL.Image.open(io.BytesIO(result.data)).size == (256, 256)
+            # all tiles of the metatile are cached
+            assert len(server.tile_cache._memory) == 16
+            etag = result.headers["ETag"]
+
+            with mock.patch.object(server, "render", side_effect=AssertionError("tile not cached")):
+                result = self.client.get(f'/tiles/WorldCRS84Quad/ecmwf_EUR_LL015.PLDiv01/3/9/2.png{query}')
+                callback_ok_image(result.status, result.headers)
+                assert result.headers["ETag"] != etag
+                result = self.client.get(f'/tiles/WorldCRS84Quad/ecmwf_EUR_LL015.PLDiv01/3/8/1.png{query}',
+                                         headers={"If-None-Match": etag})
+                assert result.status_code == 304
+
+            result = self.client.get(f'/tiles/WebMercatorQuad/ecmwf_EUR_LL015.PLDiv01/2/2/1.png{query}')
+            callback_ok_image(result.status, result.headers)
+
+        for path in ['/tiles/WorldCRS84Quad/ecmwf_EUR_LL015.PLDiv01/1/4/0.png',
+                     '/tiles/WorldCRS84Quad/ecmwf_EUR_LL015.PLDiv01/2000/0/0.png',
+                     '/tiles/unknown/ecmwf_EUR_LL015.PLDiv01/1/0/0.png',
+                     '/tiles/WorldCRS84Quad/ecmwf_EUR_LL015.unknown/1/0/0.png']:
+            result = self.client.get(path + query)
+            assert result.status_code == 400
+            assert result.headers["Content-type"] == "text/xml"
+
+        # unexpected errors are reported as service exceptions, too
+        with mock.patch.object(server, "parse_plot_query", side_effect=KeyError("STYLES")):
+            result = self.client.get(f'/tiles/WorldCRS84Quad/ecmwf_EUR_LL015.PLDiv01/3/8/1.png{query}')
+        assert result.status_code == 400
+        assert result.headers["Content-type"] == "text/xml"
+        assert b"ServiceException" in result.data
+
+    def test_get_feature_info(self):
+        self.client = mswms.application.test_client()
+        query = '/?request=GetFeatureInfo&version=1.1.1&query_layers=ecmwf_EUR_LL015.PLTemp01&' \
+                'dim_init_time=2012-10-17T12%3A00%3A00Z&info_format=application%2Fjson'
+        result = self.client.get(query + '&lat=50.5&lon=10.5&elevation=500')
+        assert result.status == "200 OK" and result.headers["Content-type"] == "application/json"
+        data = json.loads(result.data.decode("utf-8"))
+        assert (data["latitude"], data["longitude"], data["level"]) == (50.5, 10.5, 500)
+        temperature = data["fields"]["pl"]["air_temperature"]
+        assert temperature["units"] == "degC" and len(temperature["valid_times"]) == 7
+        assert len(temperature["values"]) == 7 and all(isinstance(_x, float) for _x in temperature["values"])
+        assert "geopotential_height" in data["fields"]["pl"]
+
+        # pixel of a map with the same values for versions 1.1.1 and 1.3.0
+        map_query = '&srs=EPSG%3A4326&bbox=0,40,20,60&width=20&height=20&elevation=500' \
+                    '&time=2012-10-17T12%3A00%3A00Z/2012-10-18T00%3A00%3A00Z'
+        result = self.client.get(query + map_query + '&x=10&y=9')
+        data = json.loads(result.data.decode("utf-8"))
+        assert (data["latitude"], data["longitude"]) == (50.5, 10.5)
+        assert data["fields"]["pl"]["air_temperature"]["values"] == temperature["values"][:3]
+        result = self.client.get(query.replace("1.1.1", "1.3.0") + map_query.replace("srs", "crs")
+                                 .replace("0,40,20,60", "40,0,60,20") + '&i=10&j=9')
+        assert json.loads(result.data.decode("utf-8")) == data
+
+        # latest forecast and profiles on all levels by default
+        result = self.client.get(query.replace("dim_init_time", "unused") + '&lat=50.5&lon=10.5')
+        data = json.loads(result.data.decode("utf-8"))
+        assert data["init_time"] == "2012-10-17T12:00:00Z"
+        assert len(data["fields"]["pl"]["air_temperature"]["levels"]) > 1
+
+        for invalid in [query + '&lat=50.5', query + '&lat=0&lon=10.5',
+                        query.replace("application%2Fjson", "text%2Fhtml") + '&lat=50.5&lon=10.5',
+                        query.replace("PLTemp01", "unknown") + '&lat=50.5&lon=10.5']:
+            result = self.client.get(invalid)
+            assert result.status == "200 OK" and result.headers["Content-type"] == "text/xml"
+            assert b"ServiceException" in result.data
+
+        for version in ["1.1.1", "1.3.0"]:
+            result = self.client.get(f'/?request=GetCapabilities&service=WMS&version={version}')
+            assert b"<GetFeatureInfo>" in result.data and b'queryable="1"' in result.data
+
     def test_produce_hsec_service_exception(self):
         environ = {
             'wsgi.url_scheme': 'http',
@@ -164,6 +395,111 @@ class Test_WMS(object):
             callback_ok_xml(result.status, result.headers)
             assert result.data.count(b"ServiceExceptionReport") > 0, result
 
+    def test_produce_hsec_plot_cached(self):
+        query_string = (
+            'layers=ecmwf_EUR_LL015.PLDiv01&styles=&elevation=200&srs=EPSG%3A4326&format=image%2Fpng&'
+            'request=GetMap&bgcolor=0xFFFFFF&height=376&dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&'
+            'version=1.1.1&bbox=-50.0%2C20.0%2C20.0%2C75.0&time=2012-10-17T12%3A00%3A00Z&'
+            'exceptions=application%2Fvnd.ogc.se_xml&transparent=FALSE')
+        server = mslib.mswms.wms.server
+        server.image_cache = ImageCache()
+        try:
+            self.client = mswms.application.test_client()
+            result = self.client.get(f'/?{query_string}')
+            callback_ok_image(result.status, result.headers)
+            etag = result.headers["ETag"]
+            assert "Last-Modified" in result.headers
+            assert len(server.image_cache._memory) == 1
+
+            # equivalent number formatting yields the same image
+            result2 = self.client.get('/?{}'.format(query_string.replace("elevation=200", "elevation=200.0")))
+            callback_ok_image(result2.status, result2.headers)
+            assert result2.headers["ETag"] == etag
+            assert result2.data == result.data
+            assert server.image_cache._memory.hits == 1
+
+            result3 = self.client.get(f'/?{query_string}', headers={"If-None-Match": etag})
+            assert result3.status_code == 304
+            assert result3.headers["ETag"] == etag
+            assert result3.data == b""
+        finally:
+            server.image_cache = None
+
+    def test_produce_plot_concurrently(self):
+        queries = [
+            'layers=ecmwf_EUR_LL015.PLDiv01&styles=&elevation=200&srs=EPSG%3A4326&format=image%2Fpng&'
+            'request=GetMap&height=376&dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&'
+            'version=1.1.1&bbox=-50.0%2C20.0%2C20.0%2C75.0&time=2012-10-17T12%3A00%3A00Z&transparent=FALSE',
+            'layers=ecmwf_EUR_LL015.PLTemp01&styles=&elevation=300&srs=EPSG%3A4326&format=image%2Fpng&'
+            'request=GetMap&height=376&dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&'
+            'version=1.1.1&bbox=-10.0%2C40.0%2C20.0%2C60.0&time=2012-10-17T12%3A00%3A00Z&transparent=FALSE',
+            'layers=ecmwf_EUR_LL015.VS_HV01&styles=&srs=VERT%3ALOGP&format=image%2Fpng&'
+            'request=GetMap&height=245&dim_init_time=2012-10-17T12%3A00%3A00Z&width=842&'
+            'version=1.1.1&bbox=201%2C500.0%2C10%2C100.0&time=2012-10-17T12%3A00%3A00Z&'
+            'path=52.78%2C-8.93%2C48.08%2C11.28&transparent=FALSE']
+        self.client = mswms.application.test_client()
+        expected = [self.client.get(f'/?{_x}').data for _x in queries]
+
+        def get(query):
+            return mswms.application.test_client().get(f'/?{query}').data
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(get, queries * 3))
+        assert results == expected * 3
+
+        server = mslib.mswms.wms.server
+        server.render_pool = mslib.mswms.wms._create_render_pool(2)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+                results = list(executor.map(get, queries))
+            assert results == expected
+        finally:
+            server.render_pool.shutdown()
+            server.render_pool = None
+
+    def test_render_data_state(self):
+        server = mslib.mswms.wms.server
+        state = server._data_state["ecmwf_EUR_LL015"]
+        with mock.patch.object(server, "render", return_value=b"image"), \
+                mock.patch.object(server, "refresh_data") as refresh_data:
+            image, _ = mslib.mswms.wms._render("getmap", "ecmwf_EUR_LL015", "PLDiv01", {}, data_state=state)
+            assert image == b"image" and not refresh_data.called
+            # a worker catches up with data seen by the requesting server first
+            mslib.mswms.wms._render(
+                "getmap", "ecmwf_EUR_LL015", "PLDiv01", {}, data_state=state + (("new.nc", 0., 0),))
+            assert refresh_data.call_count == 1
+
+    def test_produce_plot_coalesced(self):
+        query = (
+            'layers=ecmwf_EUR_LL015.PLDiv01&styles=&elevation=200&srs=EPSG%3A4326&format=image%2Fpng&'
+            'request=GetMap&height=376&dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&'
+            'version=1.1.1&bbox=-50.0%2C20.0%2C20.0%2C75.0&time=2012-10-17T12%3A00%3A00Z&transparent=FALSE')
+        server = mslib.mswms.wms.server
+        render = server.render
+        started, proceed = threading.Event(), threading.Event()
+
+        def slow_render(*args):
+            started.set()
+            proceed.wait(10)
+            return render(*args)
+
+        def get(query):
+            return mswms.application.test_client().get(f'/?{query}').data
+
+        single_flight = SingleFlight(timeout=60)
+        with mock.patch.object(server, "render", side_effect=slow_render) as patched, \
+                mock.patch.object(server, "single_flight", single_flight), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(get, query)]
+            assert started.wait(10)
+            futures += [executor.submit(get, query) for _ in range(2)]
+            while single_flight.waiting < 2:
+                threading.Event().wait(0.01)
+            proceed.set()
+            results = [_x.result() for _x in futures]
+            assert patched.call_count == 1
+        assert results[0].startswith(b"\x89PNG") and results == results[:1] * 3
+
     def test_produce_vsec_plot(self):
         environ = {
             'wsgi.url_scheme': 'http',
@@ -222,6 +558,29 @@ class Test_WMS(object):
             callback_ok_xml(result.status, result.headers)
             assert result.data.count(b"ServiceExceptionReport") > 0, result
 
+    def test_produce_vsec_data_formats(self):
+        query_string = (
+            'layers=ecmwf_EUR_LL015.VS_HV01&styles=&srs=VERT%3ALOGP&format=application%2Fjson&'
+            'request=GetMap&bgcolor=0xFFFFFF&height=245&dim_init_time=2012-10-17T12%3A00%3A00Z&width=842&'
+            'version=1.1.1&bbox=201%2C500.0%2C10%2C100.0&time=2012-10-17T12%3A00%3A00Z&'
+            'exceptions=application%2Fvnd.ogc.se_xml&path=52.78%2C-8.93%2C48.08%2C11.28&transparent=FALSE')
+        self.client = mswms.application.test_client()
+        for return_format in mslib.mswms.wms.VSEC_DATA_FORMATS:
+            result = self.client.get('/?{}'.format(
+                query_string.replace("application%2Fjson", return_format.replace("/", "%2F"))))
+            assert result.status == "200 OK"
+            assert result.headers["Content-type"] == return_format
+            assert result.data.count(b"ServiceExceptionReport") == 0, result
+
+        # Data formats are not available for horizontal sections.
+        result = self.client.get(
+            '/?layers=ecmwf_EUR_LL015.PLDiv01&styles=&elevation=200&srs=EPSG%3A4326&format=application%2Fjson&'
+            'request=GetMap&bgcolor=0xFFFFFF&height=376&dim_init_time=2012-10-17T12%3A00%3A00Z&width=479&'
+            'version=1.1.1&bbox=-50.0%2C20.0%2C20.0%2C75.0&time=2012-10-17T12%3A00%3A00Z&'
+            'exceptions=application%2Fvnd.ogc.se_xml&transparent=FALSE')
+        callback_ok_xml(result.status, result.headers)
+        assert result.data.count(b"InvalidFORMAT") > 0, result
+
     def test_application_request(self):
         environ = {
             'wsgi.url_scheme': 'http',
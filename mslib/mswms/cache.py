@@ -0,0 +1,660 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms.cache
+    ~~~~~~~~~~~~~~~~~
+
+    Caching facilities for the MSS WMS server.
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from mslib import netCDF4tools
+from mslib.mswms import chunkstore
+
+# The NetCDF library is not thread-safe, hence all access to NetCDF files of
+# concurrently processed requests is serialised by this lock.
+NETCDF_LOCK = threading.RLock()
+
+
+def _sizeof(value):
+    """Returns an estimate of the memory used by <value> in bytes.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_sizeof(_x) for _x in value)
+    if isinstance(value, dict):
+        return sum(_sizeof(_x) for _x in value.values())
+    return getattr(value, "nbytes", 0)
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache limited by the number of bytes
+       of its stored values.
+
+    The size of a value is estimated by the <sizeof> function, which defaults
+    to the length of bytes objects and the nbytes attribute of numpy arrays.
+    Values larger than the budget are not stored at all.
+    """
+
+    def __init__(self, max_bytes, sizeof=None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._sizeof = sizeof if sizeof is not None else _sizeof
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Returns the value stored for <key> and marks it as recently used.
+        """
+        with self._lock:
+            try:
+                size, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores <value> for <key>, evicting least recently used entries
+           until the byte budget is met.
+        """
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[0]
+            if size > self.max_bytes:
+                return
+            self._data[key] = (size, value)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (old_size, _) = self._data.popitem(last=False)
+                self.nbytes -= old_size
+
+    def pop(self, key, default=None):
+        """Removes <key> from the cache and returns its value.
+        """
+        with self._lock:
+            try:
+                size, value = self._data.pop(key)
+            except KeyError:
+                return default
+            self.nbytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+def _set_readonly(value):
+    """Makes the data of the numpy array <value> (or of the arrays in the tuple
+       or list <value>) read-only.
+
+    Masks stay writeable, as e.g. matplotlib masks invalid values in place.
+    """
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _set_readonly(item)
+
+
+class FieldCache(LRUCache):
+    """LRUCache for data fields read from NetCDF files and converted to the
+       units required by the plot styles, and for fields derived from them.
+
+    Keys identify the file, variable, time step, level and region of a field
+    (see MSSPlotDriver._get_field). As the arrays are shared by concurrent
+    requests, their data is made read-only when stored.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        LRUCache.__init__(self, max_bytes)
+
+    def put(self, key, value):
+        _set_readonly(value)
+        LRUCache.put(self, key, value)
+
+
+class SectionCache(LRUCache):
+    """LRUCache for the interpolation points of vertical section paths and
+       their interpolation stencils on the data grids.
+
+    Keys identify the path and, for stencils, the grid signature of the data
+    (see VerticalSectionDriver). As with FieldCache, stored arrays are made
+    read-only.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 ** 2):
+        LRUCache.__init__(self, max_bytes)
+
+    def put(self, key, value):
+        _set_readonly(value)
+        LRUCache.put(self, key, value)
+
+
+class ImageCache(object):
+    """Two-tier cache for rendered images.
+
+    The first tier is an in-process LRUCache, the second an optional directory
+    on disk which may be shared between several server processes. Entries are
+    identified by a hexadecimal key that is also used as ETag (see
+    WMSServer.get_plot_key) and consist of the image data, its MIME type and
+    the modification time of the underlying data.
+    """
+
+    def __init__(self, max_bytes=100 * 1024 ** 2, directory=None, max_disk_bytes=1024 ** 3):
+        self._memory = LRUCache(max_bytes, sizeof=lambda _x: len(_x[0]))
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def __contains__(self, key):
+        """Returns whether an image is stored for <key>, without loading it.
+        """
+        return key in self._memory or (self.directory is not None and os.path.exists(self._disk_path(key)))
+
+    def get(self, key):
+        """Returns a tuple (image, return_format, last_modified) or None if
+           <key> is unknown.
+        """
+        entry = self._memory.get(key)
+        if entry is not None or self.directory is None:
+            return entry
+        filename = self._disk_path(key)
+        try:
+            with open(filename, "rb") as fid:
+                header = fid.readline().decode("utf-8").split()
+                image = fid.read()
+            # Keep the least recently used images at the front for pruning.
+            os.utime(filename)
+        except (IOError, OSError):
+            return None
+        return_format, last_modified = header[0], float(header[1]) if len(header) > 1 else None
+        entry = (image, return_format, last_modified)
+        self._memory.put(key, entry)
+        return entry
+
+    def put(self, key, image, return_format, last_modified=None):
+        """Stores an image in both tiers.
+        """
+        entry = (image, return_format, last_modified)
+        self._memory.put(key, entry)
+        if self.directory is None:
+            return
+        filename = self._disk_path(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        header = return_format if last_modified is None else f"{return_format} {last_modified!r}"
+        # Write to a temporary file first so that concurrent readers never
+        # see incomplete images.
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, "wb") as fid:
+                fid.write(header.encode("utf-8") + b"\n")
+                fid.write(image)
+                size = fid.tell()
+            # A rewritten key replaces its file, whose size is no longer on disk.
+            old_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            os.replace(tmpname, filename)
+        except (IOError, OSError) as ex:
+            logging.error("Could not write image cache file '%s': %s %s", filename, type(ex), ex)
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(_x[1] for _x in self._disk_entries())
+            else:
+                self._disk_bytes += size - old_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._prune_disk()
+
+    def _disk_entries(self):
+        """Yields tuples (mtime, size, filename) of all files in the disk tier.
+        """
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def _prune_disk(self):
+        """Removes least recently used files until the disk tier uses less
+           than 90% of its budget.
+        """
+        entries = sorted(self._disk_entries())
+        self._disk_bytes = sum(_x[1] for _x in entries)
+        for _, size, filename in entries:
+            if self._disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+        logging.debug("pruned image cache directory to %s bytes", self._disk_bytes)
+
+    def clear(self):
+        """Empties the in-process tier. Files on disk are kept.
+        """
+        self._memory.clear()
+
+
+class GeometryStore(object):
+    """Store of coastlines and country boundaries projected for a map.
+
+    Entries are identified by a hexadecimal key derived from the projection
+    and the map region (see MPLBasemapHorizontalSectionStyle) and consist of
+    the projected coastline segments, coastline polygons (land and lakes, see
+    Basemap.coastpolygontypes) and country boundary segments.
+
+    Each entry is stored as a single flat float64 numpy array: the number M
+    of parts, M triples (kind, end, type) and the concatenated vertices, where
+    kind is 0 for coastline segments, 1 for coastline polygons and 2 for
+    country segments, end is the index after the last vertex of the part and
+    type the polygon type. With a <directory>, the arrays are saved as .npy
+    files, which are memory-mapped, so that several server processes share
+    them. Recently used entries are kept in a LRUCache of <max_entries>.
+    """
+
+    KINDS = ("coastsegs", "coastpolygons", "cntrysegs")
+
+    def __init__(self, max_entries=20, directory=None, max_disk_bytes=256 * 1024 ** 2):
+        self._memory = LRUCache(max_entries, sizeof=lambda _x: 1)
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    @staticmethod
+    def _pack(geometry):
+        parts, vertices = [], []
+        end = 0
+        for kind, name in enumerate(GeometryStore.KINDS):
+            types = geometry["coastpolygontypes"] if name == "coastpolygons" else None
+            for i, part in enumerate(geometry[name]):
+                part = np.asarray(part, dtype=float)
+                # Polygons are given as tuples (x, y), segments as lists of points.
+                part = part.T if types is not None else part.reshape(-1, 2)
+                end += len(part)
+                parts.append((kind, end, types[i] if types is not None else 0))
+                vertices.append(part.reshape(-1))
+        return np.concatenate([[len(parts)], np.asarray(parts, dtype=float).reshape(-1)] + vertices)
+
+    @staticmethod
+    def _unpack(array):
+        num_parts = int(array[0])
+        parts = array[1:1 + 3 * num_parts].reshape(num_parts, 3).astype(int)
+        vertices = array[1 + 3 * num_parts:].reshape(-1, 2)
+        geometry = {_x: [] for _x in GeometryStore.KINDS}
+        geometry["coastpolygontypes"] = []
+        start = 0
+        for kind, end, typ in parts:
+            name = GeometryStore.KINDS[kind]
+            if name == "coastpolygons":
+                # Basemap expects polygons as tuples (x, y).
+                geometry[name].append(vertices[start:end].T)
+                geometry["coastpolygontypes"].append(typ)
+            else:
+                geometry[name].append(vertices[start:end])
+            start = end
+        return geometry
+
+    def get(self, key):
+        """Returns a dictionary with the lists coastsegs, coastpolygons,
+           coastpolygontypes and cntrysegs, or None if <key> is unknown.
+        """
+        geometry = self._memory.get(key)
+        if geometry is not None or self.directory is None:
+            return geometry
+        filename = self._disk_path(key)
+        try:
+            array = np.load(filename, mmap_mode="r")
+            # Keep the least recently used entries at the front for pruning.
+            os.utime(filename)
+        except (IOError, OSError, ValueError):
+            return None
+        geometry = self._unpack(array)
+        self._memory.put(key, geometry)
+        return geometry
+
+    def put(self, key, geometry):
+        """Stores the <geometry> dictionary (see get) in memory and on disk.
+        """
+        array = self._pack(geometry)
+        if self.directory is None:
+            self._memory.put(key, self._unpack(array))
+            return
+        filename = self._disk_path(key)
+        # Write to a temporary file first so that concurrent readers never
+        # see incomplete arrays.
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fid:
+                np.save(fid, array)
+                size = fid.tell()
+            # A rewritten key replaces its file, whose size is no longer on disk.
+            old_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            os.replace(tmpname, filename)
+        except (IOError, OSError) as ex:
+            logging.error("Could not write geometry file '%s': %s %s", filename, type(ex), ex)
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            self._memory.put(key, self._unpack(array))
+            return
+        self._memory.put(key, self._unpack(np.load(filename, mmap_mode="r")))
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(_x[1] for _x in self._disk_entries())
+            else:
+                self._disk_bytes += size - old_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._prune_disk()
+
+    def _disk_entries(self):
+        """Yields tuples (mtime, size, filename) of all stored files.
+        """
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".npy"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            yield stat.st_mtime, stat.st_size, entry.path
+
+    def _prune_disk(self):
+        """Removes least recently used files until the store uses less than
+           90% of its disk budget.
+        """
+        entries = sorted(self._disk_entries())
+        self._disk_bytes = sum(_x[1] for _x in entries)
+        for _, size, filename in entries:
+            if self._disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+        logging.debug("pruned geometry store to %s bytes", self._disk_bytes)
+
+
+class OpenDataset(object):
+    """An open MFDatasetCommonDims (or ChunkedDataset, if the files are chunk
+       stores) together with its coordinate arrays.
+
+    Attributes: dataset, filenames, times, lat_data, lon_data, lat_order,
+    grid_signature, vert_data, vert_order, vert_units.
+
+    The grid signature is a hash of the lat/lon coordinates identifying
+    datasets on the same horizontal grid.
+    """
+
+    def __init__(self, filenames, **kwargs):
+        self.filenames = list(filenames)
+        self.mtimes = [os.path.getmtime(_x) for _x in self.filenames]
+        self.users = 0
+        if chunkstore.is_chunk_store(self.filenames[0]):
+            dataset = chunkstore.ChunkedDataset(self.filenames, **kwargs)
+        else:
+            dataset = netCDF4tools.MFDatasetCommonDims(self.filenames, **kwargs)
+        try:
+            _, timevar = netCDF4tools.identify_CF_time(dataset)
+            self.times = netCDF4tools.num2date(timevar[:], timevar.units)
+            # removed after discussion, see
+            # https://mss-devel.slack.com/archives/emerge/p1486658769000007
+            # if init_time != netCDF4tools.num2date(0, timevar.units):
+            #     dataset.close()
+            #     raise ValueError("wrong initialisation time in input")
+            self.lat_data, self.lon_data, self.lat_order = netCDF4tools.get_latlon_data(dataset)
+            self.grid_signature = hashlib.sha1(
+                np.asarray(self.lat_data, dtype=float).tobytes() +
+                np.asarray(self.lon_data, dtype=float).tobytes()).hexdigest()
+            _, vert_data, self.vert_order, self.vert_units, _ = netCDF4tools.identify_vertical_axis(dataset)
+            self.vert_data = vert_data[:] if vert_data is not None else None
+        except Exception as ex:
+            logging.error("ERROR: %s %s", type(ex), ex)
+            dataset.close()
+            raise
+        self.dataset = dataset
+
+    def is_current(self):
+        """Returns False if any of the files has been modified since opening.
+        """
+        try:
+            return self.mtimes == [os.path.getmtime(_x) for _x in self.filenames]
+        except OSError:
+            return False
+
+    def close(self):
+        logging.debug("closing dataset %s", self.filenames)
+        with NETCDF_LOCK:
+            self.dataset.close()
+
+
+class DatasetPool(object):
+    """Least-recently-used pool of open datasets.
+
+    Datasets are identified by the set of their files and may be shared by
+    several drivers, which acquire() a dataset before use and release() it
+    afterwards. Datasets in use are never closed; unused ones are closed if
+    the total number of open files exceeds <max_open_files> or if one of
+    their files has been modified.
+    """
+
+    def __init__(self, max_open_files=64):
+        self.max_open_files = max_open_files
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def acquire(self, filenames, **kwargs):
+        """Returns an OpenDataset of <filenames>. The first file is used as
+           master if the dataset needs to be opened. <kwargs> are passed on
+           to MFDatasetCommonDims.
+        """
+        key = tuple(sorted(filenames))
+        unused = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.is_current():
+                self._entries.move_to_end(key)
+                entry.users += 1
+                self.hits += 1
+                return entry
+            if entry is not None:
+                logging.debug("dataset %s has been modified", key)
+                del self._entries[key]
+                if entry.users == 0:
+                    unused.append(entry)
+            self.misses += 1
+        self._close(unused)
+
+        logging.debug("opening datasets.")
+        entry = OpenDataset(filenames, **kwargs)
+        unused = []
+        with self._lock:
+            if key in self._entries:
+                # Another thread was faster.
+                unused.append(entry)
+                entry = self._entries[key]
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = entry
+            entry.users += 1
+            unused.extend(self._evict())
+        self._close(unused)
+        return entry
+
+    def release(self, entry):
+        """Marks <entry> as no longer used by the caller.
+        """
+        with self._lock:
+            entry.users -= 1
+            # Close the entry if it has been removed from the pool while in use.
+            unused = entry.users == 0 and self._entries.get(tuple(sorted(entry.filenames))) is not entry
+        if unused:
+            entry.close()
+
+    def _evict(self):
+        """Removes least recently used datasets not in use from the pool until
+           the number of open files is within limits and returns them.
+        """
+        evicted = []
+        num_files = sum(len(_x.filenames) for _x in self._entries.values())
+        for key, entry in list(self._entries.items()):
+            if num_files <= self.max_open_files:
+                break
+            if entry.users > 0:
+                continue
+            del self._entries[key]
+            evicted.append(entry)
+            num_files -= len(entry.filenames)
+        return evicted
+
+    @staticmethod
+    def _close(entries):
+        # Closing is done outside of the pool lock, as it requires NETCDF_LOCK.
+        for entry in entries:
+            entry.close()
+
+    def clear(self):
+        """Closes all datasets not in use and empties the pool.
+        """
+        with self._lock:
+            unused = [_x for _x in self._entries.values() if _x.users == 0]
+            self._entries.clear()
+        self._close(unused)
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls producing the same result.
+
+    The first caller of do() for a key computes the result, concurrent callers
+    with the same key wait for it and receive the same result or exception.
+    Callers waiting longer than <timeout> seconds compute the result
+    themselves. The number of saved computations, i.e. of callers that
+    received the result of another caller, is counted in total and for the
+    <max_keys> most recently coalesced keys.
+    """
+
+    def __init__(self, timeout=None, max_keys=100):
+        self.timeout = timeout
+        self.max_keys = max_keys
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.waiting = 0
+        self.coalesced_by_key = collections.OrderedDict()
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """Returns the result of calling <function> without arguments, shared
+           with concurrent calls for <key>.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = concurrent.futures.Future()
+                self.calls += 1
+                leader = True
+            else:
+                self.waiting += 1
+                leader = False
+
+        if not leader:
+            logging.debug("waiting for concurrent computation of '%s'", key)
+            try:
+                future.exception(timeout=self.timeout)
+            except concurrent.futures.TimeoutError:
+                logging.warning("computation of '%s' took longer than %s s, computing it again", key, self.timeout)
+                with self._lock:
+                    self.waiting -= 1
+                    self.timeouts += 1
+                return function()
+            with self._lock:
+                self.waiting -= 1
+                self.coalesced += 1
+                self.coalesced_by_key[key] = self.coalesced_by_key.pop(key, 0) + 1
+                while len(self.coalesced_by_key) > self.max_keys:
+                    self.coalesced_by_key.popitem(last=False)
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    def get_stats(self):
+        """Returns a dictionary with the number of computations, the number of
+           coalesced calls in total and by key, and the number of timeouts.
+        """
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "timeouts": self.timeouts,
+                    "coalesced_by_key": dict(self.coalesced_by_key)}
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms.chunkstore
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Chunked array stores in the Zarr (version 2) directory layout.
+
+    A store is a directory holding one sub-directory per variable. Each
+    variable is split into chunks of a fixed shape stored in separate files,
+    so that reading a region of a variable, e.g. the bbox of a map or the
+    grid points along a vertical section path, only reads the chunks
+    covering it:
+
+        20121017_12_ecmwf_forecast.PRESSURE_LEVELS.EUR_LL015.036.pl.zarr/
+            .zgroup
+            .zattrs                     global attributes
+            air_temperature/
+                .zarray                 shape, chunk shape, dtype, compressor
+                .zattrs                 attributes and dimension names
+                0.0.0.0                 chunks, zlib compressed
+                0.0.0.1
+                ...
+
+    Stores are converted from NetCDF files by convert() (or "mswms convert")
+    and read by ChunkedDataset, which provides the subset of the netCDF4
+    Dataset API used by the data access classes and drivers. Only
+    uncompressed, zlib and gzip compressed chunks are supported, so that no
+    further libraries are required; stores are readable by zarr and xarray.
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import collections
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+
+import netCDF4
+import numpy as np
+
+# Attributes of NetCDF variables that are applied by netCDF4 when reading and
+# thus not copied to the store.
+_ENCODING_ATTRIBUTES = ("_FillValue", "missing_value", "scale_factor", "add_offset")
+
+# Default number of grid points per chunk along the latitude and longitude
+# axes. Other axes (time, vertical levels) are chunked by single values.
+DEFAULT_CHUNK_SIZE = 128
+
+
+def is_chunk_store(path):
+    """Returns True if <path> is the directory of a chunk store.
+    """
+    return os.path.isfile(os.path.join(path, ".zgroup"))
+
+
+def _read_json(filename, default=None):
+    try:
+        with open(filename, "r") as fid:
+            return json.load(fid)
+    except FileNotFoundError:
+        if default is None:
+            raise
+        return default
+
+
+def _write_json(filename, content):
+    with open(filename, "w") as fid:
+        json.dump(content, fid, indent=4, sort_keys=True)
+
+
+def _decode_fill_value(value, dtype):
+    if value is None:
+        return None
+    if value in ("NaN", "Infinity", "-Infinity"):
+        value = {"NaN": np.nan, "Infinity": np.inf, "-Infinity": -np.inf}[value]
+    return np.array(value, dtype=dtype)[()]
+
+
+def _encode_fill_value(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and not np.isfinite(value):
+        return "NaN" if np.isnan(value) else ("Infinity" if value > 0 else "-Infinity")
+    return value
+
+
+def _to_json(value):
+    """Returns the attribute <value> of a NetCDF file as JSON serialisable
+       value.
+    """
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, (np.ndarray, np.generic)):
+        return _to_json(value.tolist())
+    if isinstance(value, float) and not np.isfinite(value):
+        return str(value)
+    if isinstance(value, list):
+        return [_to_json(_x) for _x in value]
+    return value
+
+
+class ChunkedVariable(object):
+    """Read-only variable of a chunk store, indexed like a netCDF4 Variable
+       by integers, slices and sequences of indices.
+
+    Values equal to the fill value are masked. Attributes are available as
+    attributes of the instance, see ncattrs().
+    """
+
+    def __init__(self, path, name):
+        self.name = name
+        self._path = path
+        meta = _read_json(os.path.join(path, ".zarray"))
+        attributes = _read_json(os.path.join(path, ".zattrs"), {})
+        if meta.get("zarr_format") != 2:
+            raise IOError(f"variable '{name}' has unsupported format {meta.get('zarr_format')}")
+        compressor = meta.get("compressor")
+        if (compressor is not None and compressor.get("id") not in ("zlib", "gzip")) or meta.get("filters"):
+            raise IOError(f"variable '{name}' uses unsupported compressor {compressor} or filters")
+        self._compressed = compressor is not None
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = np.dtype(meta["dtype"])
+        self._order = meta.get("order", "C")
+        self._separator = meta.get("dimension_separator", ".")
+        self._fill_value = _decode_fill_value(meta.get("fill_value"), self.dtype)
+        self.dimensions = tuple(attributes.pop("_ARRAY_DIMENSIONS", [f"dim_{_x}" for _x in range(len(self.shape))]))
+        self._attributes = attributes
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(f"variable '{self.name}' has no attribute '{name}'")
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def ncattrs(self):
+        return list(self._attributes)
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def _read_chunk(self, index):
+        """Returns the chunk at the chunk grid position <index>. Chunks not
+           stored consist of fill values.
+        """
+        filename = os.path.join(self._path, self._separator.join(str(_x) for _x in index) or "0")
+        try:
+            with open(filename, "rb") as fid:
+                data = fid.read()
+        except FileNotFoundError:
+            return np.full(self.chunks, self._fill_value if self._fill_value is not None else 0, dtype=self.dtype)
+        if self._compressed:
+            # Accepts zlib and gzip headers.
+            data = zlib.decompress(data, zlib.MAX_WBITS | 32)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks, order=self._order)
+
+    def _get_indices(self, key):
+        """Returns the indices selected by <key> along each axis and the axes
+           selected by single integers.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(_x is Ellipsis for _x in key):
+            position = [_x is Ellipsis for _x in key].index(True)
+            key = key[:position] + (slice(None),) * (self.ndim - len(key) + 1) + key[position + 1:]
+        if len(key) > self.ndim:
+            raise IndexError(f"too many indices for variable '{self.name}'")
+        key = key + (slice(None),) * (self.ndim - len(key))
+        indices, scalar_axes = [], []
+        for axis, (item, size) in enumerate(zip(key, self.shape)):
+            if isinstance(item, slice):
+                indices.append(np.arange(*item.indices(size)))
+                continue
+            if np.ndim(item) == 0:
+                scalar_axes.append(axis)
+                item = [item]
+            item = np.asarray(item)
+            if item.dtype == bool:
+                item = np.nonzero(item)[0]
+            item = np.where(item < 0, item + size, item).astype(int)
+            if ((item < 0) | (item >= size)).any():
+                raise IndexError(f"index out of range for axis {axis} of variable '{self.name}'")
+            indices.append(item)
+        return indices, tuple(scalar_axes)
+
+    def __getitem__(self, key):
+        """Reads the values selected by <key>, reading only the chunks
+           containing them.
+        """
+        indices, scalar_axes = self._get_indices(key)
+        data = np.empty([len(_x) for _x in indices], dtype=self.dtype)
+        # For each axis, the chunks containing the selected indices together
+        # with the positions in the result and within the chunk.
+        axes = []
+        for index, chunk_size in zip(indices, self.chunks):
+            chunk_indices = index // chunk_size
+            axes.append([(_x, np.nonzero(chunk_indices == _x)[0], index[chunk_indices == _x] - _x * chunk_size)
+                         for _x in np.unique(chunk_indices)])
+        for chunk in itertools.product(*axes):
+            values = self._read_chunk(tuple(int(_x[0]) for _x in chunk))
+            data[np.ix_(*[_x[1] for _x in chunk])] = values[np.ix_(*[_x[2] for _x in chunk])]
+        if scalar_axes:
+            data = data.squeeze(axis=scalar_axes)
+        mask = np.ma.nomask
+        if self._fill_value is not None:
+            if np.issubdtype(self.dtype, np.floating) and np.isnan(self._fill_value):
+                mask = np.isnan(data)
+            else:
+                mask = data == self._fill_value
+            if not mask.any():
+                mask = np.ma.nomask
+        return np.ma.masked_array(data, mask=mask)
+
+
+class ChunkedDataset(object):
+    """Read-only dataset of one or more chunk stores, providing the part of
+       the netCDF4 Dataset API used by the data access classes and drivers.
+
+    The variables of several stores with common dimensions appear as if they
+    were in one store, as with netCDF4tools.MFDatasetCommonDims, whose
+    arguments are accepted. The first store is the master, whose coordinate
+    variables and global attributes are used.
+    """
+
+    def __init__(self, paths, exclude=None, skip_dim_check=None, require_dim_num=False):
+        if isinstance(paths, str):
+            paths = [paths]
+        exclude = exclude or []
+        skip_dim_check = skip_dim_check or []
+        self._paths = list(paths)
+        self.variables = collections.OrderedDict()
+        self.dimensions = collections.OrderedDict()
+        self._attributes = {}
+        for number, path in enumerate(self._paths):
+            if not is_chunk_store(path):
+                raise IOError(f"'{path}' is not a chunk store")
+            variables = collections.OrderedDict(
+                (_x, ChunkedVariable(os.path.join(path, _x), _x)) for _x in sorted(os.listdir(path))
+                if _x not in exclude and os.path.isfile(os.path.join(path, _x, ".zarray")))
+            dimensions = collections.OrderedDict()
+            for variable in variables.values():
+                dimensions.update(zip(variable.dimensions, variable.shape))
+            if number == 0:
+                self._attributes = _read_json(os.path.join(path, ".zattrs"), {})
+                self.dimensions = dimensions
+                self.variables.update(variables)
+                if not variables:
+                    raise IOError(f"master dataset '{path}' does not have any variable")
+                continue
+            # Make sure that the dimensions agree with those of the master.
+            for name, size in dimensions.items():
+                if name in skip_dim_check:
+                    continue
+                if name not in self.dimensions:
+                    raise IOError(f"dimension '{name}' not defined in master '{self._paths[0]}'")
+                if name not in variables:
+                    raise IOError(f"dimension '{name}' has no coordinate variable in '{path}'")
+                if size != self.dimensions[name] or (variables[name][:] != self.variables[name][:]).any():
+                    raise IOError(f"dimension '{name}' differs in master '{self._paths[0]}' and '{path}'")
+            if require_dim_num and len(dimensions) != len(self.dimensions):
+                raise IOError(f"number of dimensions not consistent in master '{self._paths[0]}' and '{path}'")
+            self.variables.update((_x, _y) for _x, _y in variables.items() if _x not in self.dimensions)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(f"dataset has no attribute '{name}'")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def ncattrs(self):
+        return list(self._attributes)
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def close(self):
+        """Chunk files are only opened while being read, hence there is
+           nothing to close.
+        """
+        pass
+
+
+def _get_chunks(variable, chunks):
+    """Returns the chunk shape of the NetCDF <variable>, with the sizes of
+       dimensions in <chunks> taken from there.
+    """
+    result = []
+    for axis, (name, size) in enumerate(zip(variable.dimensions, variable.shape)):
+        if name in chunks:
+            chunk_size = chunks[name]
+        elif axis >= len(variable.shape) - 2:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        else:
+            chunk_size = 1
+        result.append(max(1, min(chunk_size, size)))
+    return tuple(result)
+
+
+def _get_fill_value(variable, dtype):
+    """Returns the fill value replacing masked values of <variable> when
+       stored as <dtype>.
+    """
+    fill_value = getattr(variable, "_FillValue", None)
+    if dtype.kind == "f":
+        return float(np.nan if fill_value is None else fill_value)
+    if fill_value is None:
+        fill_value = netCDF4.default_fillvals.get(dtype.str[1:])
+    return None if fill_value is None else dtype.type(fill_value).item()
+
+
+def _is_fill(values, fill_value):
+    if fill_value is None:
+        return False
+    if isinstance(fill_value, float) and np.isnan(fill_value):
+        return np.isnan(values).all()
+    return (values == fill_value).all()
+
+
+def _write_chunk(path, index, values, compress_level):
+    data = np.ascontiguousarray(values).tobytes()
+    if compress_level > 0:
+        data = zlib.compress(data, compress_level)
+    with open(os.path.join(path, ".".join(str(_x) for _x in index) or "0"), "wb") as fid:
+        fid.write(data)
+
+
+def _write_variable(path, variable, chunks, compress_level):
+    """Writes the NetCDF <variable> into the directory <path>, reading the
+       values of one chunk along the first axis at a time.
+    """
+    dtype = np.dtype(variable.dtype)
+    if any(hasattr(variable, _x) for _x in ("scale_factor", "add_offset")):
+        # Packed values are unpacked by netCDF4 when reading.
+        dtype = np.dtype(np.float32 if dtype.itemsize <= 2 else np.float64)
+    dtype = dtype.newbyteorder("<") if dtype.byteorder == ">" else dtype
+    fill_value = _get_fill_value(variable, dtype)
+    chunks = _get_chunks(variable, chunks)
+    os.mkdir(path)
+    _write_json(os.path.join(path, ".zarray"), {
+        "zarr_format": 2, "shape": list(variable.shape), "chunks": list(chunks), "dtype": dtype.str,
+        "compressor": {"id": "zlib", "level": compress_level} if compress_level > 0 else None,
+        "fill_value": _encode_fill_value(fill_value), "order": "C", "filters": None})
+    attributes = {_x: _to_json(variable.getncattr(_x)) for _x in variable.ncattrs() if _x not in _ENCODING_ATTRIBUTES}
+    attributes["_ARRAY_DIMENSIONS"] = list(variable.dimensions)
+    _write_json(os.path.join(path, ".zattrs"), attributes)
+
+    def read(index):
+        values = np.ma.asarray(variable[index]).astype(dtype)
+        return values.filled(fill_value) if fill_value is not None else values.data
+
+    if len(variable.shape) == 0:
+        _write_chunk(path, (), read(...), compress_level)
+        return
+    for first in range(0, variable.shape[0], chunks[0]):
+        block = read(slice(first, first + chunks[0]))
+        grid = [range(0, _x, _y) for _x, _y in zip(block.shape, chunks)]
+        for starts in itertools.product(*grid):
+            values = block[tuple(slice(_x, _x + _y) for _x, _y in zip(starts, chunks))]
+            if _is_fill(values, fill_value):
+                # Chunks of fill values are not stored.
+                continue
+            if values.shape != chunks:
+                padded = np.full(chunks, fill_value if fill_value is not None else 0, dtype=dtype)
+                padded[tuple(slice(0, _x) for _x in values.shape)] = values
+                values = padded
+            index = (first // chunks[0],) + tuple(_x // _y for _x, _y in zip(starts[1:], chunks[1:]))
+            _write_chunk(path, index, values, compress_level)
+
+
+def convert(filename, output, chunks=None, compress_level=1):
+    """Converts the NetCDF file <filename> into the chunk store <output>.
+
+    <chunks> optionally gives the chunk size by dimension name, e.g.
+    {"time": 1, "lat": 64, "lon": 64}; by default, the horizontal axes are
+    chunked by DEFAULT_CHUNK_SIZE and all other axes by single values. The
+    store is written next to <output> and moved there when complete, so that
+    the server never sees incomplete stores; an existing store is replaced.
+    """
+    chunks = chunks or {}
+    output = os.path.abspath(output)
+    temporary = tempfile.mkdtemp(prefix=".convert-", dir=os.path.dirname(output))
+    try:
+        with netCDF4.Dataset(filename) as dataset:
+            _write_json(os.path.join(temporary, ".zattrs"),
+                        {_x: _to_json(dataset.getncattr(_x)) for _x in dataset.ncattrs()})
+            for name, variable in dataset.variables.items():
+                if not isinstance(variable.dtype, np.dtype) or variable.dtype.kind not in "biuf":
+                    logging.warning("Skipping non-numeric variable '%s' of '%s'", name, filename)
+                    continue
+                logging.debug("converting variable '%s' of '%s'", name, filename)
+                _write_variable(os.path.join(temporary, name), variable, chunks, compress_level)
+        # The group marker is written last, as it identifies complete stores.
+        _write_json(os.path.join(temporary, ".zgroup"), {"zarr_format": 2})
+        if os.path.exists(output):
+            previous = tempfile.mkdtemp(prefix=".replaced-", dir=os.path.dirname(output))
+            os.rename(output, os.path.join(previous, "store"))
+            os.rename(temporary, output)
+            shutil.rmtree(previous)
+        else:
+            os.rename(temporary, output)
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+
+
+def get_store_name(filename):
+    """Returns the name of the chunk store converted from the NetCDF file
+       <filename>, which keeps the parts identifying the data (domain, level
+       type, ...).
+    """
+    name = os.path.basename(filename)
+    return (name[:-3] if name.endswith(".nc") else name) + ".zarr"
+
+
+def convert_files(filenames, output_dir=None, chunks=None, compress_level=1):
+    """Converts the NetCDF files <filenames> into chunk stores in <output_dir>
+       or, if None, next to each file (see convert()).
+
+    Returns the list of files that could not be converted.
+    """
+    failed = []
+    for number, filename in enumerate(filenames, start=1):
+        output = os.path.join(output_dir or os.path.dirname(os.path.abspath(filename)), get_store_name(filename))
+        logging.info("Converting '%s' to '%s' (%i/%i)", filename, output, number, len(filenames))
+        try:
+            convert(filename, output, chunks=chunks, compress_level=compress_level)
+        except (IOError, OSError, ValueError) as ex:
+            logging.error("Could not convert '%s': %s %s", filename, type(ex), ex)
+            failed.append(filename)
+    return failed
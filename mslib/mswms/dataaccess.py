@@ -27,14 +27,22 @@
 """
 
 from abc import ABCMeta, abstractmethod
+import concurrent.futures
+import copy
+import datetime
 import itertools
+import json
 import os
 import logging
+import multiprocessing
+import sqlite3
 import netCDF4
 import numpy as np
 import pint
 
 from mslib import netCDF4tools
+from mslib.mswms import chunkstore
+from mslib.mswms.cache import NETCDF_LOCK
 from mslib.utils import UR
 
 
@@ -67,14 +75,22 @@ class NWPDataAccess(metaclass=ABCMeta):
         """
         pass
 
+    def update_files(self, modified=(), removed=()):
+        """Updates the class for single new or <modified> and <removed> files
+           in the data directory. By default, the class is set up again.
+
+        Returns True if the available data may have changed.
+        """
+        self.setup()
+        return True
+
     def have_data(self, variable, vartype, init_time, valid_time):
         """Checks whether a file with data for the specified variable,
            type and times is known. This does not trigger a search for
            updated data files on disk.
         """
         try:
-            self._determine_filename(
-                variable, vartype, init_time, valid_time, reload=False)
+            self._determine_filename(variable, vartype, init_time, valid_time)
         except ValueError:
             return False
         else:
@@ -134,6 +150,18 @@ class NWPDataAccess(metaclass=ABCMeta):
         """
         pass
 
+    def get_data_state(self):
+        """Returns a summary (name, modification time and size) of the files
+           in the data directory, which changes whenever files are added,
+           removed or modified.
+        """
+        state = []
+        for entry in os.scandir(self._root_path):
+            if entry.is_file():
+                stat = entry.stat()
+                state.append((entry.name, stat.st_mtime, stat.st_size))
+        return tuple(sorted(state))
+
     @abstractmethod
     def get_init_times(self):
         """Return a list of available forecast init times (base times).
@@ -171,6 +199,66 @@ class NWPDataAccess(metaclass=ABCMeta):
         return self._mfDatasetArgsDict
 
 
+_scan_parser = None
+
+
+def _init_scan_process(parser):
+    global _scan_parser
+    _scan_parser = parser
+
+
+def _scan_file(filename):
+    return _try_parse_file(_scan_parser, filename)
+
+
+def _try_parse_file(parser, filename):
+    """Returns the content of <filename> and the exception raised by parsing it.
+    """
+    logging.info("Opening candidate '%s'", filename)
+    try:
+        with NETCDF_LOCK:
+            return parser._parse_file(filename), None
+    except IOError as ex:
+        return None, ex
+
+
+def _encode_content(content):
+    """Returns the content of a parsed file (see DefaultDataAccess._parse_file)
+       as JSON text, with times in ISO format.
+    """
+    def encode_time(value):
+        if value is None:
+            return None
+        return datetime.datetime(value.year, value.month, value.day, value.hour, value.minute, value.second,
+                                 value.microsecond).isoformat()
+
+    levels = np.asarray(content["elevations"]["levels"])
+    return json.dumps({
+        "vert_type": content["vert_type"],
+        "elevations": {"levels": levels.tolist(), "dtype": levels.dtype.str,
+                       "units": content["elevations"]["units"]},
+        "init_time": encode_time(content["init_time"]),
+        "valid_times": [encode_time(_x) for _x in content["valid_times"]],
+        "standard_names": list(content["standard_names"])})
+
+
+def _decode_content(text):
+    """Returns the content of a parsed file encoded by _encode_content().
+    """
+    def decode_time(value):
+        return None if value is None else datetime.datetime.fromisoformat(value)
+
+    content = json.loads(text)
+    elevations = content["elevations"]
+    return {
+        "vert_type": content["vert_type"],
+        "elevations": {"levels": np.array(elevations["levels"], dtype=elevations["dtype"]),
+                       "units": elevations["units"]},
+        "init_time": decode_time(content["init_time"]),
+        "valid_times": [decode_time(_x) for _x in content["valid_times"]],
+        "standard_names": content["standard_names"]}
+
+
 class DefaultDataAccess(NWPDataAccess):
     """
     Subclass to NWPDataAccess for accessing properly constructed NetCDF files
@@ -180,37 +268,50 @@ class DefaultDataAccess(NWPDataAccess):
     # Workaround for the numerical issue concering the lon dimension in
     # NetCDF files produced by netcdf-java 4.3..
 
-    def __init__(self, rootpath, domain_id, skip_dim_check=[], **kwargs):
+    def __init__(self, rootpath, domain_id, skip_dim_check=[], scan_processes=1, **kwargs):
         """Constructor takes the path of the data directory and determines whether
            this class employs different init_times or valid_times.
+
+        With <scan_processes> larger than 1, the data files are examined by the
+        given number of worker processes during setup.
         """
         NWPDataAccess.__init__(self, rootpath, **kwargs)
         self._domain_id = domain_id
+        self._scan_processes = scan_processes
         self._available_files = None
+        self._contents = {}
         self._filetree = None
         self._mfDatasetArgsDict = {"skip_dim_check": skip_dim_check}
 
-    def _determine_filename(self, variable, vartype, init_time, valid_time, reload=True):
+    def _determine_filename(self, variable, vartype, init_time, valid_time):
         """Determines the name of the data file that contains
            the variable <variable> with type <vartype> of the forecast specified
            by <init_time> and <valid_time>.
+
+        New data files are not searched for here, but when the data set is
+        set up or updated again (see update_files).
         """
         assert self._filetree is not None, "filetree is None. Forgot to call setup()?"
         try:
             return self._filetree[vartype][init_time][variable][valid_time]
-        except KeyError:
-            if reload:
-                self.setup()
-            try:
-                return self._filetree[vartype][init_time][variable][valid_time]
-            except KeyError as ex:
-                logging.error("Could not identify filename. %s %s %s %s %s %s",
-                              variable, vartype, init_time, valid_time, type(ex), ex)
-                raise ValueError(f"variable type {vartype} not available for variable {variable}")
+        except KeyError as ex:
+            logging.error("Could not identify filename. %s %s %s %s %s %s",
+                          variable, vartype, init_time, valid_time, type(ex), ex)
+            raise ValueError(f"variable type {vartype} not available for variable {variable}")
+
+    def _is_data_file(self, filename):
+        """Returns True if <filename> in the data directory is a data file of
+           this data set. Directories, e.g. chunk stores converted from the
+           files, are skipped.
+        """
+        return self._domain_id in filename and not os.path.isdir(os.path.join(self._root_path, filename))
+
+    def _open_dataset(self, filename):
+        return netCDF4.Dataset(os.path.join(self._root_path, filename))
 
     def _parse_file(self, filename):
         elevations = {"levels": [], "units": None}
-        with netCDF4.Dataset(os.path.join(self._root_path, filename)) as dataset:
+        with self._open_dataset(filename) as dataset:
 
             time_name, time_var = netCDF4tools.identify_CF_time(dataset)
             init_time = netCDF4tools.num2date(0, time_var.units)
@@ -234,16 +335,6 @@ class DefaultDataAccess(NWPDataAccess):
 
             if vert_type != "sfc":
                 elevations = {"levels": vert_var[:], "units": vert_var.units}
-                if vert_type in self._elevations:
-                    if len(vert_var[:]) != len(self._elevations[vert_type]["levels"]):
-                        raise IOError(f"Number of vertical levels does not fit to levels of "
-                                      f"previous file '{self._elevations[vert_type]['filename']}'.")
-                    if not np.allclose(vert_var[:], self._elevations[vert_type]["levels"]):
-                        raise IOError(f"vertical levels do not fit to levels of previous "
-                                      f"file '{self._elevations[vert_type]['filename']}'.")
-                    if elevations["units"] != self._elevations[vert_type]["units"]:
-                        raise IOError(f"vertical level units do not match previous "
-                                      f"file '{self._elevations[vert_type]['filename']}'")
 
             standard_names = []
             for ncvarname, ncvar in dataset.variables.items():
@@ -278,7 +369,7 @@ class DefaultDataAccess(NWPDataAccess):
             "standard_names": standard_names
         }
 
-    def _add_to_filetree(self, filename, content):
+    def _add_to_filetree(self, filename, content, filetree):
         logging.info("File '%s' identified as '%s' type", filename, content["vert_type"])
         logging.info("Found init time '%s', %s valid_times and %s standard_names",
                      content["init_time"], len(content["valid_times"]), len(content["standard_names"]))
@@ -289,7 +380,7 @@ class DefaultDataAccess(NWPDataAccess):
         else:
             logging.debug("valid_times='%s' standard_names='%s'",
                           content["valid_times"], content["standard_names"])
-        leaf = self._filetree.setdefault(content["vert_type"], {}).setdefault(content["init_time"], {})
+        leaf = filetree.setdefault(content["vert_type"], {}).setdefault(content["init_time"], {})
         for standard_name in content["standard_names"]:
             var_leaf = leaf.setdefault(standard_name, {})
             for valid_time in content["valid_times"]:
@@ -305,24 +396,111 @@ class DefaultDataAccess(NWPDataAccess):
     def setup(self):
         # Get a list of the available data files.
         self._available_files = [
-            _filename for _filename in sorted(os.listdir(self._root_path)) if self._domain_id in _filename]
+            _filename for _filename in sorted(os.listdir(self._root_path)) if self._is_data_file(_filename)]
         logging.info("Files identified for domain '%s': %s",
                      self._domain_id, self._available_files)
 
-        self._filetree = {}
-        self._elevations = {"sfc": {"filename": None, "levels": [], "units": None}}
+        contents = zip(self._available_files, self._parse_files(self._available_files))
+        self._contents = {_filename: _content for _filename, _content in contents if _content is not None}
+        self._build_filetree()
 
-        # Build the tree structure.
-        for filename in self._available_files:
-            logging.info("Opening candidate '%s'", filename)
-            try:
-                content = self._parse_file(filename)
-            except IOError as ex:
+    def update_files(self, modified=(), removed=()):
+        """Updates the tree structure for single new or <modified> and <removed>
+           files, e.g. as reported by a DirectoryWatcher, without scanning the
+           whole data directory. Only the modified files are read.
+
+        Returns True if any file of this data set was affected.
+        """
+        modified = {_x for _x in modified if self._is_data_file(_x)}
+        removed = {_x for _x in removed if self._domain_id in _x} - modified
+        if not modified and not removed:
+            return False
+        logging.info("Updating files of domain '%s': modified %s, removed %s",
+                     self._domain_id, sorted(modified), sorted(removed))
+        # Update a copy, so that concurrent requests continue to use the
+        # complete old state until the new one is available.
+        updated = copy.copy(self)
+        updated._contents = {
+            _x: _y for _x, _y in self._contents.items() if _x not in modified and _x not in removed}
+        modified = sorted(modified)
+        for filename, content in zip(modified, self._parse_files(modified)):
+            if content is not None:
+                updated._contents[filename] = content
+        updated._available_files = sorted(
+            {_x for _x in self._available_files if _x not in removed} |
+            {_x for _x in modified if os.path.exists(os.path.join(self._root_path, _x))})
+        updated._build_filetree()
+        self.__dict__.update(updated.__dict__)
+        return True
+
+    def _build_filetree(self):
+        """Builds the tree structure from the contents of the parsed files.
+           Files are added in the order of their names, independent of the
+           order in which they were parsed.
+
+        The tree is replaced only when complete, so that concurrent requests
+        never see a partial one.
+        """
+        filetree = {}
+        elevations = {"sfc": {"filename": None, "levels": [], "units": None}}
+        for filename in sorted(self._contents):
+            content = self._contents[filename]
+            if self._check_elevations(filename, content, elevations):
+                self._add_to_filetree(filename, content, filetree)
+        self._filetree, self._elevations = filetree, elevations
+
+    def _parse_files(self, filenames):
+        """Calls _parse_file() for all <filenames>, using several processes if
+           configured.
+
+        Returns the contents in the order of <filenames>; None for files that
+        could not be parsed.
+        """
+        if self._scan_processes > 1 and len(filenames) > 1:
+            # The NetCDF library is not thread-safe, hence processes are used
+            # instead of threads. They are spawned, as a forked child would
+            # inherit the state of the library from a running server.
+            parser = copy.copy(self)
+            parser._scan_processes = 1
+            parser._filetree = None
+            parser._contents = {}
+            parser.__dict__.pop("_file_cache", None)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=min(self._scan_processes, len(filenames)),
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_scan_process, initargs=(parser,)) as executor:
+                results = list(executor.map(_scan_file, filenames))
+        else:
+            results = [_try_parse_file(self, _x) for _x in filenames]
+        contents = []
+        for filename, (content, ex) in zip(filenames, results):
+            if ex is not None:
                 logging.error("Skipping file '%s' (%s: %s)", filename, type(ex), ex)
-                continue
-            if content["vert_type"] not in self._elevations:
-                self._elevations[content["vert_type"]] = content["elevations"]
-            self._add_to_filetree(filename, content)
+            contents.append(content)
+        return contents
+
+    def _check_elevations(self, filename, content, known_elevations):
+        """Checks that the vertical levels of a file fit to those of the previously
+           added files of the same type in <known_elevations>. The first file of
+           a type defines them.
+        """
+        vert_type, elevations = content["vert_type"], content["elevations"]
+        if vert_type == "sfc":
+            return True
+        if vert_type not in known_elevations:
+            known_elevations[vert_type] = dict(elevations, filename=filename)
+            return True
+        previous = known_elevations[vert_type]
+        if len(elevations["levels"]) != len(previous["levels"]):
+            reason = "Number of vertical levels does not fit to levels of previous file"
+        elif not np.allclose(elevations["levels"], previous["levels"]):
+            reason = "vertical levels do not fit to levels of previous file"
+        elif elevations["units"] != previous["units"]:
+            reason = "vertical level units do not match previous file"
+        else:
+            return True
+        logging.error("Skipping file '%s' (%s '%s')", filename, reason, previous["filename"])
+        return False
 
     def get_init_times(self):
         """Returns a list of available forecast init times (base times).
@@ -370,6 +548,13 @@ class DefaultDataAccess(NWPDataAccess):
         """
         return self._available_files
 
+    def get_data_state(self):
+        """Returns a summary (name, modification time and size) of the files
+           of this domain, which changes whenever files are added, removed or
+           modified.
+        """
+        return tuple(_x for _x in NWPDataAccess.get_data_state(self) if self._domain_id in _x[0])
+
 
 class CachedDataAccess(DefaultDataAccess):
     """
@@ -377,53 +562,159 @@ class CachedDataAccess(DefaultDataAccess):
     Constructor needs information on domain ID.
 
     Uses file name and modification date to reduce setup time by caching directory
-    content in a dictionary.
+    content in a dictionary. Optionally, the cache is persisted as JSON in an
+    SQLite database, so that it survives restarts of the server.
     """
 
-    def __init__(self, rootpath, domain_id, **kwargs):
+    def __init__(self, rootpath, domain_id, index_filename=None, **kwargs):
         """Constructor takes the path of the data directory and determines whether
            this class employs different init_times or valid_times.
+
+        <index_filename> is the name of the persistent cache, relative to the
+        data directory (e.g. ".mss_wms_index.sqlite"). It must not contain the
+        domain ID. By default, no persistent cache is used.
         """
         DefaultDataAccess.__init__(self, rootpath, domain_id, **kwargs)
         self._file_cache = {}
+        self._index_filename = None
+        if index_filename is not None:
+            self._index_filename = os.path.join(rootpath, index_filename)
+            self._load_index()
+
+    def _connect_index(self):
+        connection = sqlite3.connect(self._index_filename, timeout=30)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(filename TEXT PRIMARY KEY, mtime REAL, size INTEGER, content TEXT)")
+        return connection
+
+    def _load_index(self):
+        """Fills the cache with the entries of the persistent cache whose
+           files have not been modified since.
+        """
+        if not os.path.exists(self._index_filename):
+            return
+        try:
+            connection = self._connect_index()
+            try:
+                rows = connection.execute("SELECT filename, mtime, size, content FROM files").fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as ex:
+            logging.warning("Could not read metadata index '%s': %s %s", self._index_filename, type(ex), ex)
+            return
+        for filename, mtime, size, content in rows:
+            if self._domain_id not in filename:
+                continue
+            try:
+                stat = os.stat(os.path.join(self._root_path, filename))
+            except OSError:
+                continue
+            if (stat.st_mtime, stat.st_size) == (mtime, size):
+                try:
+                    self._file_cache[filename] = (mtime, _decode_content(content))
+                except Exception as ex:
+                    logging.warning("Ignoring index entry of '%s': %s %s", filename, type(ex), ex)
+        logging.info("Loaded %s entries from metadata index '%s'", len(self._file_cache), self._index_filename)
+
+    def _save_index(self, parsed, removed):
+        """Stores newly <parsed> files in the persistent cache and removes the
+           <removed> ones.
+        """
+        if not parsed and not removed:
+            return
+        try:
+            connection = self._connect_index()
+            try:
+                with connection:
+                    connection.executemany("DELETE FROM files WHERE filename = ?", [(_x,) for _x in removed])
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                        [(_x, self._file_cache[_x][0], os.path.getsize(os.path.join(self._root_path, _x)),
+                          _encode_content(self._file_cache[_x][1]))
+                         for _x in parsed])
+            finally:
+                connection.close()
+        except (sqlite3.Error, OSError, TypeError, ValueError) as ex:
+            logging.warning("Could not write metadata index '%s': %s %s", self._index_filename, type(ex), ex)
 
     def setup(self):
         # Get a list of the available data files.
         self._available_files = [
-            _filename for _filename in os.listdir(self._root_path) if self._domain_id in _filename]
+            _filename for _filename in os.listdir(self._root_path) if self._is_data_file(_filename)]
         logging.info("Files identified for domain '%s': %s",
                      self._domain_id, self._available_files)
 
-        for filename in list(self._file_cache):
-            if filename not in self._available_files:
-                del self._file_cache[filename]
-
-        self._filetree = {}
-        self._elevations = {"sfc": {"filename": None, "levels": []}}
+        removed = [_x for _x in self._file_cache if _x not in self._available_files]
+        for filename in removed:
+            del self._file_cache[filename]
 
-        # Build the tree structure.
+        # Parse new and modified files.
+        mtimes = {_x: os.path.getmtime(os.path.join(self._root_path, _x)) for _x in self._available_files}
+        parsed = []
         for filename in self._available_files:
-            mtime = os.path.getmtime(os.path.join(self._root_path, filename))
-            if filename in self._file_cache and mtime == self._file_cache[filename][0]:
+            if filename in self._file_cache and mtimes[filename] == self._file_cache[filename][0]:
                 logging.info("Using cached candidate '%s'", filename)
-                content = self._file_cache[filename][1]
-                if content["vert_type"] != "sfc":
-                    if content["vert_type"] not in self._elevations:
-                        self._elevations[content["vert_type"]] = content["elevations"]
-                    elif not np.allclose(
-                            self._elevations[content["vert_type"]]["levels"],
-                            content["elevations"]["levels"]):
-                        logging.error("Skipping file '%s' due to elevation mismatch", filename)
-                        continue
+                continue
+            if filename in self._file_cache:
+                del self._file_cache[filename]
+                removed.append(filename)
+            parsed.append(filename)
+        for filename, content in zip(parsed, self._parse_files(parsed)):
+            if content is not None:
+                self._file_cache[filename] = (mtimes[filename], content)
+        parsed = [_x for _x in parsed if _x in self._file_cache]
+
+        self._contents = {
+            _x: self._file_cache[_x][1] for _x in self._available_files if _x in self._file_cache}
+        self._build_filetree()
+
+        if self._index_filename is not None:
+            self._save_index(parsed, [_x for _x in removed if _x not in parsed])
+
+    def update_files(self, modified=(), removed=()):
+        mtimes = {}
+        for filename in modified:
+            try:
+                mtimes[filename] = os.path.getmtime(os.path.join(self._root_path, filename))
+            except OSError:
+                pass
+        if not DefaultDataAccess.update_files(self, modified, removed):
+            return False
+        parsed = [_x for _x in mtimes if _x in self._contents]
+        removed = [_x for _x in set(modified) | set(removed) if _x in self._file_cache and _x not in parsed]
+        for filename in removed:
+            del self._file_cache[filename]
+        for filename in parsed:
+            self._file_cache[filename] = (mtimes[filename], self._contents[filename])
+        if self._index_filename is not None:
+            self._save_index(parsed, removed)
+        return True
+
+
+class ChunkedDataAccess(DefaultDataAccess):
+    """
+    Subclass to NWPDataAccess for accessing chunk stores (see
+    mslib.mswms.chunkstore) converted from properly constructed NetCDF files,
+    e.g. by "mswms convert". Constructor needs information on domain ID.
 
-            else:
-                if filename in self._file_cache:
-                    del self._file_cache[filename]
-                logging.info("Opening candidate '%s'", filename)
-                try:
-                    content = self._parse_file(filename)
-                except IOError as ex:
-                    logging.error("Skipping file '%s' (%s: %s)", filename, type(ex), ex)
-                    continue
-                self._file_cache[filename] = (mtime, content)
-            self._add_to_filetree(filename, content)
+    The drivers read only the chunks covering the requested map or vertical
+    section instead of whole fields.
+    """
+
+    def _is_data_file(self, filename):
+        return self._domain_id in filename and chunkstore.is_chunk_store(os.path.join(self._root_path, filename))
+
+    def _open_dataset(self, filename):
+        return chunkstore.ChunkedDataset(os.path.join(self._root_path, filename), **self.mfDatasetArgs())
+
+    def get_data_state(self):
+        """Returns a summary (name and modification time) of the chunk stores
+           of this domain. Stores are expected to be replaced as a whole, as
+           done by chunkstore.convert(), which changes their modification time.
+        """
+        state = []
+        for entry in os.scandir(self._root_path):
+            if entry.is_dir() and self._is_data_file(entry.name):
+                state.append((entry.name, entry.stat().st_mtime, 0))
+        return tuple(sorted(state))
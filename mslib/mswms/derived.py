@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms.derived
+    ~~~~~~~~~~~~~~~~~~~
+
+    Registry of data fields derived from the fields stored in the data files.
+
+    Plot styles request derived fields by their CF standard name through
+    Abstract2DSectionStyle.get_derived_field(). The plot driver computes them
+    from the loaded fields when requested for the first time and keeps them in
+    its field cache, so that styles sharing a derived field do not compute it
+    again for the same data.
+
+    Further fields may be registered, e.g. in mss_wms_settings.py:
+
+        @register_derived_field("wind_speed", ["eastward_wind", "northward_wind"], "m/s", ["m/s", "m/s"])
+        def wind_speed(u, v):
+            return np.hypot(u, v)
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import collections
+
+import numpy as np
+
+from mslib import thermolib
+
+DerivedField = collections.namedtuple("DerivedField", ["name", "inputs", "units", "input_units", "function"])
+
+# Registered derived fields by standard name.
+DERIVED_FIELDS = {}
+
+
+def register_derived_field(name, inputs, units, input_units):
+    """Decorator registering a function that computes the field <name> in
+       <units> from the fields listed by standard name in <inputs>, which are
+       passed as positional arguments in the same order. The inputs may
+       themselves be derived fields.
+
+    The input fields are converted to the units listed in the same order in
+    <input_units> before they are passed.
+    """
+    if len(input_units) != len(inputs):
+        raise ValueError(f"derived field '{name}' requires units for each of its inputs")
+
+    def decorator(function):
+        DERIVED_FIELDS[name] = DerivedField(name, tuple(inputs), units, tuple(input_units), function)
+        return function
+    return decorator
+
+
+@register_derived_field("air_potential_temperature", ["air_pressure", "air_temperature"], "K", ["Pa", "K"])
+def _air_potential_temperature(p, t):
+    return thermolib.pot_temp(p, t)
+
+
+@register_derived_field(
+    "equivalent_potential_temperature", ["air_pressure", "air_temperature", "specific_humidity"], "K",
+    ["Pa", "K", "kg/kg"])
+def _equivalent_potential_temperature(p, t, q):
+    return thermolib.eqpt_approx(p, t, q)
+
+
+@register_derived_field(
+    "relative_humidity", ["air_pressure", "air_temperature", "specific_humidity"], "percent", ["Pa", "K", "kg/kg"])
+def _relative_humidity(p, t, q):
+    return thermolib.rel_hum(p, t, q)
+
+
+@register_derived_field(
+    "upward_wind", ["lagrangian_tendency_of_air_pressure", "air_pressure", "air_temperature"], "m/s",
+    ["Pa/s", "Pa", "K"])
+def _upward_wind(omega, p, t):
+    return thermolib.omega_to_w(omega, p, t)
+
+
+@register_derived_field("horizontal_wind", ["eastward_wind", "northward_wind"], "m/s", ["m/s", "m/s"])
+def _horizontal_wind(u, v):
+    return np.hypot(u, v)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms.metrics
+    ~~~~~~~~~~~~~~~~~~~
+
+    Timing and resource metrics of the MSS WMS server.
+
+    The processing of a GetMap or GetVSec request is divided into phases
+    (parsing the request, opening files, reading data, ...), which are timed
+    by the phase() context manager. Together with the number of bytes read,
+    the peak memory of the loaded arrays and cache hits, the timings of a
+    request are collected by a RequestMetrics instance and aggregated per
+    layer into the histograms and counters of REGISTRY. These are exposed in
+    the Prometheus text format on the /metrics endpoint of the server.
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import bisect
+import collections
+import contextlib
+import math
+import threading
+import time
+
+# Upper bounds of the histogram buckets of durations in seconds.
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Upper bounds of the histogram buckets of memory sizes in bytes.
+BYTE_BUCKETS = tuple(2 ** _x for _x in range(16, 34, 2))
+
+# Layer label of requests combining several layers, e.g. a layer with
+# overlays, which keeps the number of label values bounded by the layers.
+COMPOSITE_LAYER = "composite"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(_y).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _y in labels.values())
+    return "{" + ",".join(f'{_x}="{_y}"' for _x, _y in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """Monotonically increasing values by label values.
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), value=1):
+        with self._lock:
+            self._values[tuple(labels)] += value
+
+    def get(self, labels=()):
+        with self._lock:
+            return self._values.get(tuple(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Histogram(object):
+    """Distribution of observed values by label values, counted in buckets
+       with the upper bounds <buckets>.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(tuple(labels), ([0] * len(self.buckets), 0.))
+            counts[index] += 1
+            self._values[tuple(labels)] = (counts, total + value)
+
+    def get_count(self, labels=()):
+        with self._lock:
+            return sum(self._values.get(tuple(labels), ([0], 0.))[0])
+
+    def samples(self):
+        with self._lock:
+            values = sorted((_x, (list(_y[0]), _y[1])) for _x, _y in self._values.items())
+        for labels, (counts, total) in values:
+            labels = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + "_bucket", dict(labels, le=_format_value(bound)), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class Registry(object):
+    """Collection of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}"
+                         for name, labels, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    "mswms_phase_seconds", "Time spent in the phases of GetMap/GetVSec requests.", ["mode", "layer", "phase"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "mswms_request_seconds", "Time spent processing GetMap/GetVSec requests.", ["mode", "layer"]))
+PEAK_ARRAY_BYTES = REGISTRY.register(Histogram(
+    "mswms_peak_array_bytes", "Peak memory of the data arrays loaded for a request.", ["mode", "layer"],
+    buckets=BYTE_BUCKETS))
+READ_BYTES = REGISTRY.register(Counter(
+    "mswms_read_bytes_total", "Bytes of data read from the data files.", ["mode", "layer"]))
+CACHE_EVENTS = REGISTRY.register(Counter(
+    "mswms_cache_total", "Lookups in the caches of the server.", ["mode", "layer", "cache", "result"]))
+REQUESTS = REGISTRY.register(Counter(
+    "mswms_requests_total", "Processed GetMap/GetVSec requests.", ["mode", "layer", "status"]))
+
+
+class RequestMetrics(object):
+    """Timings and resource usage of a single request.
+
+    <phases> holds the time spent exclusively in each phase, i.e. without
+    the time of nested phases.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = collections.defaultdict(float)
+        self.read_bytes = 0
+        self.peak_array_bytes = 0
+        self.cache_events = collections.Counter()
+        self._stack = []
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            parent, start = self._stack[-1]
+            self.phases[parent] += now - start
+        self._stack.append((name, now))
+
+    def exit(self):
+        now = time.perf_counter()
+        name, start = self._stack.pop()
+        self.phases[name] += now - start
+        if self._stack:
+            self._stack[-1] = (self._stack[-1][0], now)
+
+    def to_dict(self):
+        """Returns the collected values as dictionary of plain data, e.g. to
+           pass them between processes.
+        """
+        return {"phases": dict(self.phases), "read_bytes": self.read_bytes,
+                "peak_array_bytes": self.peak_array_bytes, "cache_events": dict(self.cache_events)}
+
+    def update(self, values):
+        """Adds the values of to_dict() of another request, e.g. of the part
+           processed by a worker process.
+        """
+        for name, value in values["phases"].items():
+            self.phases[name] += value
+        self.read_bytes += values["read_bytes"]
+        self.peak_array_bytes = max(self.peak_array_bytes, values["peak_array_bytes"])
+        self.cache_events.update(values["cache_events"])
+
+    def record(self, mode, layer, status="ok"):
+        """Aggregates the values into the metrics of REGISTRY.
+
+        <layer> is a comma-separated list of the requested layers; requests
+        of more than one layer are aggregated as COMPOSITE_LAYER.
+        """
+        labels = (mode, COMPOSITE_LAYER if "," in layer else layer)
+        REQUESTS.inc(labels + (status,))
+        REQUEST_SECONDS.observe(time.perf_counter() - self.start, labels)
+        for name, value in self.phases.items():
+            PHASE_SECONDS.observe(value, labels + (name,))
+        if self.read_bytes:
+            READ_BYTES.inc(labels, self.read_bytes)
+        if self.peak_array_bytes:
+            PEAK_ARRAY_BYTES.observe(self.peak_array_bytes, labels)
+        for (cache, result), value in self.cache_events.items():
+            CACHE_EVENTS.inc(labels + (cache, result), value)
+
+
+_local = threading.local()
+
+
+def current():
+    """Returns the RequestMetrics of the request processed by this thread, or
+       None.
+    """
+    return getattr(_local, "request", None)
+
+
+@contextlib.contextmanager
+def collect():
+    """Collects the metrics of the request processed within the block by
+       this thread and yields its RequestMetrics.
+    """
+    previous = current()
+    _local.request = RequestMetrics()
+    try:
+        yield _local.request
+    finally:
+        _local.request = previous
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times the block as phase <name> of the current request.
+    """
+    request = current()
+    if request is None:
+        yield
+        return
+    request.enter(name)
+    try:
+        yield
+    finally:
+        request.exit()
+
+
+def add_read_bytes(nbytes):
+    request = current()
+    if request is not None:
+        request.read_bytes += nbytes
+
+
+def observe_array_bytes(nbytes):
+    """Notes that arrays of <nbytes> bytes are held at the same time.
+    """
+    request = current()
+    if request is not None:
+        request.peak_array_bytes = max(request.peak_array_bytes, nbytes)
+
+
+def count_cache(cache, hit):
+    request = current()
+    if request is not None:
+        request.cache_events[(cache, "hit" if hit else "miss")] += 1
@@ -29,7 +29,7 @@
 # style definitions should be put in mpl_hsec_styles.py
 
 
-import io
+import hashlib
 import logging
 from abc import abstractmethod
 import mss_wms_settings
@@ -38,14 +38,48 @@ import matplotlib as mpl
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 import mpl_toolkits.basemap as basemap
 import numpy as np
-import PIL.Image
 
-from mslib.mswms import mss_2D_sections
+from mslib.mswms import metrics, mss_2D_sections
+from mslib.mswms.cache import GeometryStore, LRUCache
+from mslib.mswms.utils import encode_png
 from mslib.utils import get_projection_params, convert_to
 
 
-BASEMAP_CACHE = {}
-BASEMAP_REQUESTS = []
+# Projected coastlines and country boundaries of recent maps, see
+# get_geometry_store().
+GEOMETRY_STORE = None
+
+
+def get_geometry_store():
+    """Returns the GeometryStore configured in mss_wms_settings, or None if
+       basemap_use_cache is disabled.
+    """
+    global GEOMETRY_STORE
+    if not getattr(mss_wms_settings, "basemap_use_cache", False):
+        return None
+    if GEOMETRY_STORE is None:
+        GEOMETRY_STORE = GeometryStore(
+            max_entries=getattr(mss_wms_settings, "basemap_cache_size", 20),
+            directory=getattr(mss_wms_settings, "basemap_cache_directory", None),
+            max_disk_bytes=getattr(mss_wms_settings, "basemap_cache_max_disk_bytes", 256 * 1024 ** 2))
+    return GEOMETRY_STORE
+
+
+# Projected coordinates of data grids, see get_mesh_cache().
+MESH_CACHE = None
+
+
+def get_mesh_cache():
+    """Returns the LRUCache for projected data grids configured by
+       mesh_cache_max_bytes in mss_wms_settings, or None if disabled.
+    """
+    global MESH_CACHE
+    max_bytes = getattr(mss_wms_settings, "mesh_cache_max_bytes", 128 * 1024 ** 2)
+    if not max_bytes:
+        return None
+    if MESH_CACHE is None:
+        MESH_CACHE = LRUCache(max_bytes)
+    return MESH_CACHE
 
 
 class AbstractHorizontalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
@@ -61,6 +95,27 @@ class AbstractHorizontalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
         """
         pass
 
+    def get_lonlat_extent(self, bbox, crs):
+        """Returns the region (lonmin, latmin, lonmax, latmax) in degree
+           required to plot a map of <bbox> in <crs>. None stands for the
+           complete data domain.
+        """
+        return None
+
+    def get_lonlat(self, bbox, crs, x, y):
+        """Returns the longitude and latitude of the point at the relative
+           position <x>, <y> (0..1 from the upper left corner) of a map of
+           <bbox> in <crs>, or None if it cannot be determined.
+        """
+        return None
+
+    @property
+    def queryable(self):
+        """Layers showing data fields may be queried for the values at a
+           location by GetFeatureInfo requests.
+        """
+        return len(self.required_datafields) > 0
+
 
 class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
     """Matplotlib-based super class for all horizontal section styles.
@@ -197,6 +252,91 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
                                             labels=[0, 0, 0, 1],
                                             color='0.5', dashes=[5, 5])
 
+    def _get_basemap_params(self, proj_params, bbox, bbox_units):
+        """Returns the projection and corner parameters of the Basemap
+           instance covering <bbox>.
+        """
+        bm_params = dict(proj_params)
+        if bbox_units == "degree":
+            bm_params.update({"llcrnrlon": bbox[0], "llcrnrlat": bbox[1],
+                              "urcrnrlon": bbox[2], "urcrnrlat": bbox[3]})
+        elif bbox_units.startswith("meter"):
+            # convert meters to degrees
+            try:
+                bm_p = basemap.Basemap(resolution=None, **bm_params)
+            except ValueError:  # projection requires some extent
+                bm_p = basemap.Basemap(resolution=None, width=1e7, height=1e7, **bm_params)
+            bm_center = [float(_x) for _x in bbox_units[6:-1].split(",")]
+            center_x, center_y = bm_p(*bm_center)
+            bbox_0, bbox_1 = bm_p(bbox[0] + center_x, bbox[1] + center_y, inverse=True)
+            bbox_2, bbox_3 = bm_p(bbox[2] + center_x, bbox[3] + center_y, inverse=True)
+            bm_params.update({"llcrnrlon": bbox_0, "llcrnrlat": bbox_1,
+                              "urcrnrlon": bbox_2, "urcrnrlat": bbox_3})
+        elif bbox_units == "no":
+            pass
+        else:
+            raise ValueError(f"bbox_units '{bbox_units}' not known.")
+        return bm_params
+
+    def get_lonlat_extent(self, bbox, crs):
+        """Returns the region (lonmin, latmin, lonmax, latmax) in degree that
+           contains all data points left unmasked by mask_data() for a map of
+           <bbox> in <crs>, or None if it cannot be determined.
+
+        The driver uses this region to read only the required part of the data
+        fields.
+        """
+        if crs is None:
+            return None
+        try:
+            proj_params, bbox_units = [get_projection_params(crs)[_x] for _x in ("basemap", "bbox")]
+            bm = basemap.Basemap(resolution=None, **self._get_basemap_params(proj_params, bbox, bbox_units))
+        except (ValueError, KeyError) as ex:
+            logging.debug("could not determine map extent: %s %s", type(ex), ex)
+            return None
+        # Same domain as in mask_data(), sampled along its boundary.
+        add_x = (bm.xmax - bm.xmin) / 10.
+        add_y = (bm.ymax - bm.ymin) / 10.
+        xmin, xmax, ymin, ymax = bm.xmin - add_x, bm.xmax + add_x, bm.ymin - add_y, bm.ymax + add_y
+        steps = np.linspace(0, 1, 50)
+        x = np.concatenate([xmin + (xmax - xmin) * steps, np.full(50, xmax),
+                            xmax - (xmax - xmin) * steps, np.full(50, xmin)])
+        y = np.concatenate([np.full(50, ymin), ymin + (ymax - ymin) * steps,
+                            np.full(50, ymax), ymax - (ymax - ymin) * steps])
+        lons, lats = bm(x, y, inverse=True)
+        lons, lats = np.asarray(lons), np.asarray(lats)
+        if not (np.isfinite(lons).all() and np.isfinite(lats).all() and (np.abs(lats) <= 90).all()):
+            # parts of the domain are outside of the globe
+            return None
+        lats = lats.tolist()
+        lons = np.rad2deg(np.unwrap(np.deg2rad(lons)))
+        lonmin, lonmax = lons.min(), lons.max()
+        for pole in (-90, 90):
+            pole_x, pole_y = bm(0, pole)
+            if xmin <= pole_x <= xmax and ymin <= pole_y <= ymax:
+                lats.append(pole)
+                lonmin, lonmax = -180, 180
+        if lonmax - lonmin >= 360:
+            lonmin, lonmax = -180, 180
+        return lonmin, min(lats), lonmax, max(lats)
+
+    def get_lonlat(self, bbox, crs, x, y):
+        """Returns the longitude and latitude of the point at the relative
+           position <x>, <y> (0..1 from the upper left corner) of a frameless
+           map of <bbox> in <crs>, or None if it cannot be determined.
+        """
+        try:
+            proj_params, bbox_units = [get_projection_params(crs)[_x] for _x in ("basemap", "bbox")]
+            bm = basemap.Basemap(resolution=None, **self._get_basemap_params(proj_params, bbox, bbox_units))
+        except (ValueError, KeyError) as ex:
+            logging.debug("could not determine location: %s %s", type(ex), ex)
+            return None
+        # Frameless maps fill the whole image (see _create_map).
+        lon, lat = bm(bm.xmin + x * (bm.xmax - bm.xmin), bm.ymax - y * (bm.ymax - bm.ymin), inverse=True)
+        if not (np.isfinite(lon) and np.isfinite(lat) and abs(lat) <= 90):
+            return None
+        return (float(lon) + 180) % 360 - 180, float(lat)
+
     def plot_hsection(self, data, lats, lons, bbox=(-180, -90, 180, 90),
                       level=None, figsize=(960, 640), crs=None,
                       proj_params=None,
@@ -206,6 +346,23 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
         """
         EPSG overrides proj_params!
         """
+        self.draw_hsection(data, lats, lons, bbox=bbox, level=level, figsize=figsize, crs=crs,
+                           proj_params=proj_params, valid_time=valid_time, init_time=init_time, style=style,
+                           resolution=resolution, noframe=noframe)
+        return self.encode_image(show=show, transparent=transparent, palette=self.palette)
+
+    def draw_hsection(self, data, lats, lons, bbox=(-180, -90, 180, 90),
+                      level=None, figsize=(960, 640), crs=None,
+                      proj_params=None,
+                      valid_time=None, init_time=None, style=None,
+                      resolution=-1, noframe=False, base=None):
+        """Draws the style onto a new map, or onto the map of the style <base>
+           drawn before for the same bbox, crs and figsize. Several layers
+           thus share the figure, the basemap and the projected data grid.
+
+        The image is obtained from the style that created the map by
+        encode_image().
+        """
         if proj_params is None:
             proj_params = {"projection": "cyl"}
             bbox_units = "latlon"
@@ -222,7 +379,9 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
                 raise KeyError(f"required data field '{dataitem}' not found")
             origunit = self.driver.data_units[dataitem]
             if dataunit is not None:
-                data[dataitem] = convert_to(data[dataitem], origunit, dataunit)
+                # the driver usually loads the data in the required units
+                if origunit != dataunit:
+                    data[dataitem] = convert_to(data[dataitem], origunit, dataunit)
                 self.data_units[dataitem] = dataunit
             else:
                 logging.debug("Please add units to plot variables")
@@ -241,8 +400,24 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
 
         # Derive additional data fields and make the plot.
         logging.debug("preparing additional data fields..")
-        self._prepare_datafields()
+        with metrics.phase("derived"):
+            self._prepare_datafields()
 
+        if base is None:
+            with metrics.phase("basemap"):
+                self._create_map(bbox, figsize, proj_params, bbox_units, noframe)
+        else:
+            logging.debug("drawing onto map of layer '%s'..", base.name)
+            self.fig, self.bm, self.projection_key = base.fig, base.bm, base.projection_key
+        with metrics.phase("plot"):
+            self.shift_data()
+            self.mask_data()
+            self._plot_style()
+
+    def _create_map(self, bbox, figsize, proj_params, bbox_units, noframe):
+        """Creates the figure and the basemap with coastlines and country
+           boundaries.
+        """
         logging.debug("creating figure..")
         dpi = 80
         figsize = (figsize[0] / dpi), (figsize[1] / dpi)
@@ -272,57 +447,31 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
         # NOTE: While the MSUI always requests image sizes that match the aspect
         # ratio, for instance the Metview 4 client does not (mr, 2011Dec16).
 
-        # Some additional code to store the last 20 coastlines in memory for quicker
-        # access.
-        key = repr((proj_params, bbox, bbox_units))
-        basemap_use_cache = getattr(mss_wms_settings, "basemap_use_cache", False)
-        basemap_request_size = getattr(mss_wms_settings, "basemap_request_size ", 200)
-        basemap_cache_size = getattr(mss_wms_settings, "basemap_cache_size", 20)
+        # Coastlines and country boundaries projected for previous maps of the
+        # same projection and region are taken from the geometry store.
         bm_params = {"area_thresh": 1000., "ax": ax, "fix_aspect": (not noframe)}
-        bm_params.update(proj_params)
-        if bbox_units == "degree":
-            bm_params.update({"llcrnrlon": bbox[0], "llcrnrlat": bbox[1],
-                              "urcrnrlon": bbox[2], "urcrnrlat": bbox[3]})
-        elif bbox_units.startswith("meter"):
-            # convert meters to degrees
-            try:
-                bm_p = basemap.Basemap(resolution=None, **bm_params)
-            except ValueError:  # projection requires some extent
-                bm_p = basemap.Basemap(resolution=None, width=1e7, height=1e7, **bm_params)
-            bm_center = [float(_x) for _x in bbox_units[6:-1].split(",")]
-            center_x, center_y = bm_p(*bm_center)
-            bbox_0, bbox_1 = bm_p(bbox[0] + center_x, bbox[1] + center_y, inverse=True)
-            bbox_2, bbox_3 = bm_p(bbox[2] + center_x, bbox[3] + center_y, inverse=True)
-            bm_params.update({"llcrnrlon": bbox_0, "llcrnrlat": bbox_1,
-                              "urcrnrlon": bbox_2, "urcrnrlat": bbox_3})
-        elif bbox_units == "no":
-            pass
-        else:
-            raise ValueError(f"bbox_units '{bbox_units}' not known.")
-        if basemap_use_cache and key in BASEMAP_CACHE:
+        bm_params.update(self._get_basemap_params(proj_params, bbox, bbox_units))
+        store = get_geometry_store()
+        key = hashlib.sha1(repr(sorted(
+            (_k, _v) for _k, _v in bm_params.items() if _k not in ("ax", "fix_aspect"))).encode("utf-8")).hexdigest()
+        self.projection_key = key
+        geometry = None
+        if store is not None:
+            geometry = store.get(key)
+            metrics.count_cache("geometry", geometry is not None)
+        if geometry is not None:
             bm = basemap.Basemap(resolution=None, **bm_params)
-            (bm.resolution, bm.coastsegs, bm.coastpolygontypes, bm.coastpolygons,
-             bm.coastsegs, bm.landpolygons, bm.lakepolygons, bm.cntrysegs) = BASEMAP_CACHE[key]
-            logging.debug("Loaded '%s' from basemap cache", key)
+            bm.resolution = "l"
+            for name, value in geometry.items():
+                setattr(bm, name, value)
+            logging.debug("Loaded '%s' from geometry store", key)
         else:
             bm = basemap.Basemap(resolution='l', **bm_params)
             # read in countries manually, as those are laoded only on demand
             bm.cntrysegs, _ = bm._readboundarydata("countries")
-            if basemap_use_cache:
-                BASEMAP_CACHE[key] = (bm.resolution, bm.coastsegs, bm.coastpolygontypes, bm.coastpolygons,
-                                      bm.coastsegs, bm.landpolygons, bm.lakepolygons, bm.cntrysegs)
-        if basemap_use_cache:
-            BASEMAP_REQUESTS.append(key)
-            BASEMAP_REQUESTS[:] = BASEMAP_REQUESTS[-basemap_request_size:]
-
-            if len(BASEMAP_CACHE) > basemap_cache_size:
-                useful = {}
-                for idx, key in enumerate(BASEMAP_REQUESTS):
-                    useful[key] = useful.get(key, 0) + idx
-                least_useful = sorted([(value, key) for key, value in useful.items()])[:-basemap_cache_size]
-                for _, key in least_useful:
-                    del BASEMAP_CACHE[key]
-                    BASEMAP_REQUESTS[:] = [_x for _x in BASEMAP_REQUESTS if key != _x]
+            if store is not None:
+                store.put(key, {_x: getattr(bm, _x) for _x in (
+                    "coastsegs", "coastpolygons", "coastpolygontypes", "cntrysegs")})
 
         # Set up the map appearance.
         bm.drawcoastlines(color='0.25')
@@ -341,9 +490,28 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
 
         self.bm = bm  # !! BETTER PASS EVERYTHING AS PARAMETERS?
         self.fig = fig
-        self.shift_data()
-        self.mask_data()
-        self._plot_style()
+        # Artists and layout of the map itself, kept by clear_hsection().
+        self.map_artists = set(fig.get_children()) | set(ax.get_children())
+        self.map_layout = (ax.get_position(original=True), ax.get_anchor())
+
+    def clear_hsection(self):
+        """Removes everything drawn onto the map since it was created, e.g.
+           the layers of the previous time step of an animation, so that the
+           map can be drawn onto again by draw_hsection(base=...).
+        """
+        for artist in list(self.bm.ax.get_children()) + list(self.fig.get_children()):
+            if artist not in self.map_artists:
+                artist.remove()
+        # Colorbars take their space from the map.
+        self.bm.ax.set_position(self.map_layout[0])
+        self.bm.ax.set_anchor(self.map_layout[1])
+
+    def encode_image(self, show=False, transparent=False, palette=None):
+        """Returns the map drawn by draw_hsection() as PNG image, quantised
+           to <palette> if given.
+        """
+        fig = self.fig
+        facecolor = "white"
 
         # Set transparency for the output image.
         if transparent:
@@ -351,53 +519,15 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
 
         # Return the image as png embedded in a StringIO stream.
         canvas = FigureCanvas(fig)
-        output = io.BytesIO()
-        canvas.print_png(output)
-
         if show:
             logging.debug("saving figure to mpl_hsec.png ..")
             canvas.print_png("mpl_hsec.png")
 
-        # Convert the image to an 8bit palette image with a significantly
-        # smaller file size (~factor 4, from RGBA to one 8bit value, plus the
-        # space to store the palette colours).
-        # NOTE: PIL at the current time can only create an adaptive palette for
-        # RGB images, hence alpha values are lost here. If transparency is
-        # requested, the figure face colour is stored as the "transparent"
-        # colour in the image. This works in most cases, but might lead to
-        # visible artefacts in some cases.
-        logging.debug("converting image to indexed palette.")
-        # Read the above stored png into a PIL image and create an adaptive
-        # colour palette.
-        output.seek(0)  # necessary for PIL.Image.open()
-        palette_img = PIL.Image.open(output).convert(mode="RGB").convert("P", palette=PIL.Image.ADAPTIVE)
-        output = io.BytesIO()
-        if not transparent:
-            logging.debug("saving figure as non-transparent PNG.")
-            palette_img.save(output, format="PNG")  # using optimize=True doesn't change much
-        else:
-            # If the image has a transparent background, we need to find the
-            # index of the background colour in the palette. See the
-            # documentation for PIL's ImagePalette module
-            # (http://www.pythonware.com/library/pil/handbook/imagepalette.htm). The
-            # idea is to create a 256 pixel image with the same colour palette
-            # as the original image and use it as a lookup-table. Converting the
-            # lut image back to RGB gives us a list of all colours in the
-            # palette. (Why doesn't PIL provide a method to directly access the
-            # colours in a palette??)
-            lut = palette_img.resize((256, 1))
-            lut.putdata(list(range(256)))
-            lut = [c[1] for c in lut.convert("RGB").getcolors()]
-            facecolor_rgb = list(mpl.colors.hex2color(mpl.colors.cnames[facecolor]))
-            for i in [0, 1, 2]:
-                facecolor_rgb[i] = int(facecolor_rgb[i] * 255)
-            facecolor_index = lut.index(tuple(facecolor_rgb))
-
-            logging.debug("saving figure as transparent PNG with transparency index %s.", facecolor_index)
-            palette_img.save(output, format="PNG", transparency=facecolor_index)
+        output = encode_png(canvas, transparent=transparent, facecolor=facecolor, palette=palette,
+                            compress_level=getattr(mss_wms_settings, "png_compress_level", 6))
 
         logging.debug("returning figure..")
-        return output.getvalue()
+        return output
 
     def shift_data(self):
         """Shift the data fields such that the longitudes are in the range
@@ -425,16 +555,25 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
         for key in self.data:
             self.data[key] = self.data[key][:, self.lon_indices]
 
-    def mask_data(self):
-        """Mask data arrays so that all values outside the map domain
-           are masked. This is required for clabel to work correctly.
-
-        See:
-        http://www.mail-archive.com/matplotlib-users@lists.sourceforge.net/msg02892.html
-        (Re: [Matplotlib-users] clabel and basemap).
+    def _get_projected_grid(self):
+        """Returns the native map projection coordinates x, y of the lat/lon
+           grid of the data as 2D arrays and the mask of grid points outside of
+           the map domain.
 
-        (mr, 2011-01-18)
+        These are the same for all layers, times and levels of a map, hence
+        they are cached per projection and grid (see get_mesh_cache()). The
+        returned arrays are read-only.
         """
+        cache = get_mesh_cache()
+        key = (self.projection_key, hashlib.sha1(
+            np.asarray(self.lats, dtype=float).tobytes() + np.asarray(self.lons, dtype=float).tobytes()).hexdigest())
+        grid = None
+        if cache is not None:
+            grid = cache.get(key)
+            metrics.count_cache("mesh", grid is not None)
+        if grid is not None:
+            return grid
+
         # compute native map projection coordinates of lat/lon grid.
         lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
         x, y = self.bm(lonmesh_, latmesh_)
@@ -448,7 +587,31 @@ class MPLBasemapHorizontalSectionStyle(AbstractHorizontalSectionStyle):
         mask3 = y > self.bm.ymax + add_y
         mask4 = y < self.bm.ymin - add_y
         mask = mask1 + mask2 + mask3 + mask4
+        grid = (np.asarray(x), np.asarray(y), mask)
+        for value in grid:
+            value.flags.writeable = False
+        if cache is not None:
+            cache.put(key, grid)
+        return grid
+
+    def get_projected_mesh(self):
+        """Returns the native map projection coordinates x, y of the lat/lon
+           grid of the data as read-only 2D arrays, e.g. for contourf().
+        """
+        return self._get_projected_grid()[:2]
+
+    def mask_data(self):
+        """Mask data arrays so that all values outside the map domain
+           are masked. This is required for clabel to work correctly.
+
+        See:
+        http://www.mail-archive.com/matplotlib-users@lists.sourceforge.net/msg02892.html
+        (Re: [Matplotlib-users] clabel and basemap).
+
+        (mr, 2011-01-18)
+        """
+        mask = self._get_projected_grid()[2]
         # mask data arrays.
         for key in self.data:
             self.data[key] = np.ma.masked_array(
-                self.data[key], mask=mask, keep_mask=False)
+                self.data[key], mask=mask.copy(), keep_mask=False)
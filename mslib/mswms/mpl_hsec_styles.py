@@ -74,7 +74,6 @@ from matplotlib import patheffects
 
 from mslib.mswms.mpl_hsec import MPLBasemapHorizontalSectionStyle
 from mslib.mswms.utils import Targets, get_style_parameters, get_cbar_label_format
-from mslib import thermolib
 from mslib.utils import convert_to
 
 
@@ -106,8 +105,7 @@ class HS_CloudsStyle_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         if self.style.lower() == "default":
             self.style = "TOT"
@@ -195,8 +193,7 @@ class HS_MSLPStyle_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         thick_contours = np.arange(952, 1050, 8)
         thin_contours = [c for c in np.arange(952, 1050, 2)
@@ -271,8 +268,7 @@ class HS_SEAStyle_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         thick_contours = np.arange(-10, 95, 5)
         thin_contours = [c for c in np.arange(0, 90, 1)
@@ -342,8 +338,7 @@ class HS_SeaIceStyle_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         ice = data['sea_ice_area_fraction']
 
@@ -403,8 +398,7 @@ class HS_TemperatureStyle_ML_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         cmin = -72
         cmax = 42
@@ -461,8 +455,7 @@ class HS_GenericStyle(MPLBasemapHorizontalSectionStyle):
         bm = self.bm
         ax = self.bm.ax
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         show_data = np.ma.masked_invalid(self.data[self.dataname]) * self.unit_scale
         # get cmin, cmax, cbar_log and cbar_format for level_key
@@ -593,8 +586,7 @@ class HS_TemperatureStyle_PL_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         cmin = -72
         cmax = 42
@@ -680,13 +672,12 @@ class HS_GeopotentialWindStyle_PL(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         # Compute wind speed.
         u = data["eastward_wind"]
         v = data["northward_wind"]
-        wind = np.hypot(u, v)
+        wind = self.get_derived_field("horizontal_wind")
 
         # Plot wind contours.
         # NOTE: Setting alpha=0.8 raises the transparency problem in the client
@@ -775,8 +766,7 @@ class HS_RelativeHumidityStyle_PL_01(MPLBasemapHorizontalSectionStyle):
     def _prepare_datafields(self):
         """Computes relative humidity from p, t, q.
         """
-        self.data["relative_humidity"] = thermolib.rel_hum(
-            self.level * 100., self.data["air_temperature"], self.data["specific_humidity"])
+        self.data["relative_humidity"] = self.get_derived_field("relative_humidity")
 
     def _plot_style(self):
         """
@@ -785,8 +775,7 @@ class HS_RelativeHumidityStyle_PL_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         filled_contours = np.arange(70, 140, 15)
         thin_contours = np.arange(10, 140, 15)
@@ -858,10 +847,8 @@ class HS_EQPTStyle_PL_01(MPLBasemapHorizontalSectionStyle):
     def _prepare_datafields(self):
         """Computes relative humidity from p, t, q.
         """
-        self.data["equivalent_potential_temperature"] = thermolib.eqpt_approx(
-            self.level * 100., self.data["air_temperature"], self.data["specific_humidity"])
-        self.data["equivalent_potential_temperature"] = convert_to(
-            self.data["equivalent_potential_temperature"], "K", "degC")
+        self.data["equivalent_potential_temperature"] = self.get_derived_field(
+            "equivalent_potential_temperature", "degC")
 
     def _plot_style(self):
         """
@@ -870,8 +857,7 @@ class HS_EQPTStyle_PL_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         filled_contours = np.arange(0, 72, 2)
         thin_contours = np.arange(-40, 100, 2)
@@ -946,10 +932,7 @@ class HS_WStyle_PL_01(MPLBasemapHorizontalSectionStyle):
     def _prepare_datafields(self):
         """Computes relative humidity from p, t, q.
         """
-        self.data["upward_wind"] = thermolib.omega_to_w(
-            self.data["lagrangian_tendency_of_air_pressure"],
-            self.level * 100., self.data["air_temperature"])
-        self.data["upward_wind"] = convert_to(self.data["upward_wind"], "m/s", "cm/s")
+        self.data["upward_wind"] = self.get_derived_field("upward_wind", "cm/s")
 
     def _plot_style(self):
         """
@@ -958,8 +941,7 @@ class HS_WStyle_PL_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         upward_contours = np.arange(-42, 46, 4)
         w = data["upward_wind"]
@@ -1035,8 +1017,7 @@ class HS_DivStyle_PL_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         pos_contours = np.arange(4, 42, 4)
         neg_contours = np.arange(-40, 0, 4)
@@ -1101,8 +1082,7 @@ class HS_EMAC_TracerStyle_ML_01(MPLBasemapHorizontalSectionStyle):
         tracer = data["emac_R12"] * 1.e4
 
         # Shift lat/lon grid for PCOLOR (see comments in HS_EMAC_TracerStyle_SFC_01).
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         tc = bm.pcolormesh(lonmesh, latmesh, tracer,
                            cmap=plt.cm.hot_r,
@@ -1168,8 +1148,7 @@ class HS_EMAC_TracerStyle_SFC_01(MPLBasemapHorizontalSectionStyle):
         # NOTE that this assumes a regular grid, which is not fully true for
         # EMAC's latitudes. The error, however, is small, thus we neglect it
         # here.
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         tc = bm.pcolormesh(lonmesh, latmesh, tracer,
                            cmap=plt.cm.hot_r,
@@ -1234,8 +1213,7 @@ class HS_PVTropoStyle_PV_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         # Default style is pressure.
         if self.style.lower() == "default":
@@ -1340,8 +1318,7 @@ class HS_ThermalTropoStyle_SFC_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         # Define colourbars and contour levels for the three styles. For
         # pressure and height, a terrain colourmap is used (bluish colours for
@@ -1422,8 +1399,7 @@ class HS_VIProbWCB_Style_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         thick_contours = np.arange(952, 1050, 8)
         thin_contours = [c for c in np.arange(952, 1050, 2)
@@ -1487,8 +1463,7 @@ class HS_LagrantoTrajStyle_PL_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         thin_contours = [0.1, 0.5, 1., 2., 3., 4., 5., 6., 7., 8.]
 
@@ -1556,8 +1531,7 @@ class HS_BLH_MSLP_Style_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         thick_contours = np.arange(952, 1050, 8)
         thin_contours = [c for c in np.arange(952, 1050, 2)
@@ -1624,8 +1598,7 @@ class HS_Meteosat_BT108_01(MPLBasemapHorizontalSectionStyle):
         ax = self.bm.ax
         data = self.data
 
-        lonmesh_, latmesh_ = np.meshgrid(self.lons, self.lats)
-        lonmesh, latmesh = bm(lonmesh_, latmesh_)
+        lonmesh, latmesh = self.get_projected_mesh()
 
         cmin = 230
         cmax = 300
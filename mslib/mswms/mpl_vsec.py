@@ -28,16 +28,21 @@
 """
 # style definitions should be put in mpl_vsec_styles.py
 
-import PIL.Image
+import base64
 import io
+import json
 import logging
+import netCDF4
 import numpy as np
 from abc import abstractmethod
 from xml.dom.minidom import getDOMImplementation
 import matplotlib as mpl
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+import mss_wms_settings
 
-from mslib.mswms import mss_2D_sections
+from mslib.mswms import metrics, mss_2D_sections
+from mslib.mswms.cache import NETCDF_LOCK
+from mslib.mswms.utils import encode_png
 from mslib.utils import convert_to
 
 mpl.rcParams['xtick.direction'] = 'out'
@@ -135,7 +140,9 @@ class AbstractVerticalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
                 raise KeyError(f"required data field '{dataitem}' not found")
             origunit = self.driver.data_units[dataitem]
             if dataunit is not None:
-                data[dataitem] = convert_to(data[dataitem], origunit, dataunit)
+                # the driver usually loads the data in the required units
+                if origunit != dataunit:
+                    data[dataitem] = convert_to(data[dataitem], origunit, dataunit)
                 self.data_units[dataitem] = dataunit
             else:
                 logging.debug("Please add units to plot variables")
@@ -157,7 +164,8 @@ class AbstractVerticalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
         self.orography_color = orography_color
 
         # Derive additional data fields and make the plot.
-        self._prepare_datafields()
+        with metrics.phase("derived"):
+            self._prepare_datafields()
 
         # Code for producing a png image with Matplotlib.
         # ===============================================
@@ -175,7 +183,8 @@ class AbstractVerticalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
             else:
                 self.ax = self.fig.add_axes([0.07, 0.17, 0.9, 0.72])
 
-            self._plot_style()
+            with metrics.phase("plot"):
+                self._plot_style()
 
             # Set transparency for the output image.
             if transparent:
@@ -183,55 +192,15 @@ class AbstractVerticalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
 
             # Return the image as png embedded in a StringIO stream.
             canvas = FigureCanvas(self.fig)
-            output = io.BytesIO()
-            canvas.print_png(output)
-
             if show:
                 logging.debug("saving figure to mpl_vsec.png ..")
                 canvas.print_png("mpl_vsec.png")
 
-            # Convert the image to an 8bit palette image with a significantly
-            # smaller file size (~factor 4, from RGBA to one 8bit value, plus the
-            # space to store the palette colours).
-            # NOTE: PIL at the current time can only create an adaptive palette for
-            # RGB images, hence alpha values are lost here. If transparency is
-            # requested, the figure face colour is stored as the "transparent"
-            # colour in the image. This works in most cases, but might lead to
-            # visible artefacts in some cases.
-            logging.debug("converting image to indexed palette.")
-            # Read the above stored png into a PIL image and create an adaptive
-            # colour palette.
-            output.seek(0)  # necessary for PIL.Image.open()
-            palette_img = PIL.Image.open(output).convert(mode="RGB"
-                                                         ).convert("P", palette=PIL.Image.ADAPTIVE)
-            output = io.BytesIO()
-            if not transparent:
-                logging.debug("saving figure as non-transparent PNG.")
-                palette_img.save(output, format="PNG")  # using optimize=True doesn't change much
-            else:
-                # If the image has a transparent background, we need to find the
-                # index of the background colour in the palette. See the
-                # documentation for PIL's ImagePalette module
-                # (http://www.pythonware.com/library/pil/handbook/imagepalette.htm). The
-                # idea is to create a 256 pixel image with the same colour palette
-                # as the original image and use it as a lookup-table. Converting the
-                # lut image back to RGB gives us a list of all colours in the
-                # palette. (Why doesn't PIL provide a method to directly access the
-                # colours in a palette??)
-                lut = palette_img.resize((256, 1))
-                lut.putdata(list(range(256)))
-                lut = [c[1] for c in lut.convert("RGB").getcolors()]
-                facecolor_rgb = list(mpl.colors.hex2color(mpl.colors.cnames[facecolor]))
-                for i in [0, 1, 2]:
-                    facecolor_rgb[i] = int(facecolor_rgb[i] * 255)
-                facecolor_index = lut.index(tuple(facecolor_rgb))
-
-                logging.debug("saving figure as transparent PNG with transparency index %i.",
-                              facecolor_index)
-                palette_img.save(output, format="PNG", transparency=facecolor_index)
+            output = encode_png(canvas, transparent=transparent, facecolor=facecolor, palette=self.palette,
+                                compress_level=getattr(mss_wms_settings, "png_compress_level", 6))
 
             logging.debug("returning figure..")
-            return output.getvalue()
+            return output
 
         # Code for generating an XML document with the data values in ASCII format.
         # =========================================================================
@@ -257,25 +226,13 @@ class AbstractVerticalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
             # Longitude data.
             node = xmldoc.createElement("Longitude")
             node.setAttribute("num_waypoints", f"{len(self.lons)}")
-
-            data_str = ""
-            for value in self.lons:
-                data_str += str(value) + ","
-            data_str = data_str[:-1]
-
-            node.appendChild(xmldoc.createTextNode(data_str))
+            node.appendChild(xmldoc.createTextNode(",".join(map(str, self.lons))))
             xmldoc.documentElement.appendChild(node)
 
             # Latitude data.
             node = xmldoc.createElement("Latitude")
             node.setAttribute("num_waypoints", f"{len(self.lats)}")
-
-            data_str = ""
-            for value in self.lats:
-                data_str += str(value) + ","
-            data_str = data_str[:-1]
-
-            node.appendChild(xmldoc.createTextNode(data_str))
+            node.appendChild(xmldoc.createTextNode(",".join(map(str, self.lats))))
             xmldoc.documentElement.appendChild(node)
 
             # Variable data.
@@ -286,14 +243,9 @@ class AbstractVerticalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
                 data_shape = self.data[var].shape
                 node.setAttribute("num_levels", f"{data_shape[0]}")
                 node.setAttribute("num_waypoints", f"{data_shape[1]}")
-
-                data_str = ""
-                for data_row in self.data[var]:
-                    for value in data_row:
-                        data_str += str(value) + ","
-                    data_str = data_str[:-1] + "\n"
-                data_str = data_str[:-1]
-
+                # Joining the rows keeps the size of the document linear in
+                # the number of values.
+                data_str = "\n".join(",".join(map(str, data_row)) for data_row in self.data[var])
                 node.appendChild(xmldoc.createTextNode(data_str))
                 data_node.appendChild(node)
 
@@ -301,3 +253,85 @@ class AbstractVerticalSectionStyle(mss_2D_sections.Abstract2DSectionStyle):
 
             # Return the XML document as formatted string.
             return xmldoc.toprettyxml(indent="  ")
+
+        # Binary formats with the data values as float32 arrays.
+        # ======================================================
+        elif return_format == "application/x-netcdf":
+            with metrics.phase("encode"):
+                return self._get_netcdf()
+
+        elif return_format == "application/x-npz":
+            with metrics.phase("encode"):
+                return self._get_npz()
+
+        elif return_format == "application/json":
+            with metrics.phase("encode"):
+                return self._get_json()
+
+        else:
+            raise ValueError(f"unsupported return format '{return_format}'")
+
+    def _get_curtains(self):
+        """Returns the data of the section as dictionary of float32 arrays
+           with NaN for missing values.
+        """
+        return {var: np.ma.filled(np.ma.asarray(self.data[var], dtype=np.float32), np.nan) for var in self.data}
+
+    def _get_netcdf(self):
+        """Returns the section as NetCDF file.
+
+        The variables have the dimensions (level, waypoint) and the standard
+        names of the data fields.
+        """
+        with NETCDF_LOCK:
+            dataset = netCDF4.Dataset("vsec.nc", "w", memory=1024)
+            try:
+                dataset.title = self.title
+                dataset.valid_time = self.valid_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                dataset.init_time = self.init_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                num_levels = max([self.data[var].shape[0] for var in self.data] + [0])
+                dataset.createDimension("level", num_levels)
+                dataset.createDimension("waypoint", len(self.lats))
+                for name, values, units in (("lat", self.lats, "degrees_north"), ("lon", self.lons, "degrees_east")):
+                    var = dataset.createVariable(name, "f4", ("waypoint",))
+                    var.units = units
+                    var[:] = values
+                for name, values in self._get_curtains().items():
+                    var = dataset.createVariable(name, "f4", ("level", "waypoint"), fill_value=np.nan)
+                    var.standard_name = name
+                    if self.data_units.get(name) is not None:
+                        var.units = self.data_units[name]
+                    var[:values.shape[0]] = values
+            finally:
+                memory = dataset.close()
+        return memory.tobytes()
+
+    def _get_npz(self):
+        """Returns the section as numpy .npz archive with the arrays lats,
+           lons and the data fields by standard name.
+        """
+        output = io.BytesIO()
+        np.savez(output, lats=np.asarray(self.lats, dtype=np.float32), lons=np.asarray(self.lons, dtype=np.float32),
+                 **self._get_curtains())
+        return output.getvalue()
+
+    def _get_json(self):
+        """Returns the section as JSON document. Arrays are given as objects
+           with shape, dtype and the base64 encoded little endian float32
+           values.
+        """
+        def encode(values):
+            values = np.asarray(values, dtype="<f4")
+            return {"shape": list(values.shape), "dtype": "float32",
+                    "data": base64.b64encode(values.tobytes()).decode("ascii")}
+
+        result = {
+            "title": self.title,
+            "valid_time": self.valid_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "init_time": self.init_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "lats": encode(self.lats),
+            "lons": encode(self.lons),
+            "units": {var: self.data_units.get(var) for var in self.data},
+            "data": {var: encode(values) for var, values in self._get_curtains().items()},
+        }
+        return json.dumps(result).encode("utf-8")
@@ -37,8 +37,6 @@ import numpy as np
 
 from mslib.mswms.mpl_vsec import AbstractVerticalSectionStyle
 from mslib.mswms.utils import Targets, get_style_parameters, get_cbar_label_format
-from mslib.utils import convert_to
-from mslib import thermolib
 
 
 class VS_TemperatureStyle_01(AbstractVerticalSectionStyle):
@@ -61,8 +59,7 @@ class VS_TemperatureStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature if
         it has not been passed as a data field.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
 
     def _plot_style(self):
         """Make a temperature/potential temperature vertical section.
@@ -338,8 +335,7 @@ class VS_CloudsStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature if
         it has not been passed as a data field.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
 
     def _plot_style(self):
         """Make a cloud cover vertical section with temperature/potential
@@ -422,10 +418,8 @@ class VS_CloudsWindStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature and
            total horizontal wind speed.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
-        self.data["horizontal_wind"] = np.hypot(
-            self.data["eastward_wind"], self.data["northward_wind"])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
+        self.data["horizontal_wind"] = self.get_derived_field("horizontal_wind")
 
     def _plot_style(self):
         """Make a cloud cover vertical section with wind speed and potential
@@ -500,11 +494,8 @@ class VS_RelativeHumdityStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature if
         it has not been passed as a data field. Also computes relative humdity.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
-        self.data["relative_humidity"] = thermolib.rel_hum(
-            self.data['air_pressure'], self.data["air_temperature"],
-            self.data["specific_humidity"])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
+        self.data["relative_humidity"] = self.get_derived_field("relative_humidity")
 
     def _plot_style(self):
         """Make a relative humidity vertical section with temperature/potential
@@ -600,8 +591,7 @@ class VS_SpecificHumdityStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature if
         it has not been passed as a data field. Also computes relative humdity.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
 
     def _plot_style(self):
         """Make a relative humidity vertical section with temperature/potential
@@ -710,12 +700,8 @@ class VS_VerticalVelocityStyle_01(AbstractVerticalSectionStyle):
         it has not been passed as a data field. Also computes vertical
         velocity in cm/s.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
-        self.data["upward_wind"] = convert_to(
-            thermolib.omega_to_w(self.data["lagrangian_tendency_of_air_pressure"],
-                                 self.data['air_pressure'], self.data["air_temperature"]),
-            "m/s", "cm/s")
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
+        self.data["upward_wind"] = self.get_derived_field("upward_wind", "cm/s")
 
     def _plot_style(self):
         """Make a vertical velocity vertical section with temperature/potential
@@ -812,10 +798,8 @@ class VS_HorizontalVelocityStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature and
            total horizontal wind speed.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
-        self.data["horizontal_wind"] = np.hypot(
-            self.data["eastward_wind"], self.data["northward_wind"])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
+        self.data["horizontal_wind"] = self.get_derived_field("horizontal_wind")
 
     def _plot_style(self):
         """Make a horizontal velocity vertical section with temperature/potential
@@ -1047,10 +1031,8 @@ class VS_PotentialVorticityStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature and
            total horizontal wind speed.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
-        self.data["horizontal_wind"] = np.hypot(
-            self.data["eastward_wind"], self.data["northward_wind"])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
+        self.data["horizontal_wind"] = self.get_derived_field("horizontal_wind")
 
     def _plot_style(self):
         """Make a horizontal velocity vertical section with temperature/potential
@@ -1173,10 +1155,8 @@ class VS_ProbabilityOfWCBStyle_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature and
            total horizontal wind speed.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
-        self.data["horizontal_wind"] = np.hypot(
-            self.data["eastward_wind"], self.data["northward_wind"])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
+        self.data["horizontal_wind"] = self.get_derived_field("horizontal_wind")
 
     def _plot_style(self):
         """Make a horizontal velocity vertical section with temperature/potential
@@ -1340,8 +1320,7 @@ class VS_EMACEyja_Style_01(AbstractVerticalSectionStyle):
         """Computes potential temperature from pressure and temperature if
         it has not been passed as a data field.
         """
-        self.data['air_potential_temperature'] = thermolib.pot_temp(
-            self.data['air_pressure'], self.data['air_temperature'])
+        self.data['air_potential_temperature'] = self.get_derived_field('air_potential_temperature')
 
     def _plot_style(self):
         """Make a volcanic ash cloud cover vertical section with temperature/potential
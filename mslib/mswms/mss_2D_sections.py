@@ -49,6 +49,11 @@ class Abstract2DSectionStyle(metaclass=ABCMeta):
     # Define the datafields required by a style with this property.
     required_datafields = []
 
+    # Optional fixed colour palette (list of at most 256 RGB tuples with values
+    # 0..255) for the PNG images of the style, e.g. to match the colours of a
+    # fixed colour map. An adaptive palette is computed per image if None.
+    palette = None
+
     def __init__(self, driver=None):
         self.set_driver(driver)
         self.required_datatypes()
@@ -77,6 +82,14 @@ class Abstract2DSectionStyle(metaclass=ABCMeta):
         """
         pass
 
+    def get_derived_field(self, name, units=None):
+        """Returns the field <name> registered in mslib.mswms.derived (e.g.
+           air_potential_temperature), computed from the data fields of the
+           current plot and converted to <units>. The driver caches the
+           result for other plots of the same data.
+        """
+        return self.driver.get_derived_field(name, self.data, units=units)
+
     def supported_epsg_codes(self):
         """Returns a list of supported EPSG codes, if available.
         """
@@ -33,9 +33,14 @@ import os
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
+import pint
 
 from mslib import netCDF4tools
 from mslib import utils
+from mslib.mswms import metrics
+from mslib.mswms.cache import DatasetPool, FieldCache, NETCDF_LOCK
+from mslib.mswms.derived import DERIVED_FIELDS
+from mslib.utils import UR, convert_to
 
 
 class MSSPlotDriver(metaclass=ABCMeta):
@@ -58,19 +63,35 @@ class MSSPlotDriver(metaclass=ABCMeta):
     set_plot_parameters() and plot().
     """
 
-    def __init__(self, data_access_object):
+    def __init__(self, data_access_object, dataset_pool=None, field_cache=None):
         """Requires an instance of a data access object from the MSS
            configuration (i.e. an NWPDataAccess instance).
+
+        Open datasets are taken from <dataset_pool>, which may be shared with
+        other drivers of the same data access object. A private pool is
+        created if none is given. Likewise, loaded data fields are kept in the
+        optional FieldCache <field_cache>.
         """
         self.data_access = data_access_object
+        self.dataset_pool = dataset_pool if dataset_pool is not None else DatasetPool()
+        self.field_cache = field_cache
+        self.open_dataset = None
         self.dataset = None
         self.plot_object = None
+        self.loaded_data = {}
 
     def __del__(self):
-        """Closes the open NetCDF dataset, if existing.
+        """Returns the open NetCDF dataset to the pool, if existing.
+        """
+        self.release_dataset()
+
+    def release_dataset(self):
+        """Returns the open NetCDF dataset to the pool.
         """
-        if self.dataset is not None:
-            self.dataset.close()
+        if self.open_dataset is not None:
+            self.dataset_pool.release(self.open_dataset)
+            self.open_dataset = None
+        self.dataset = None
 
     def _set_time(self, init_time, fc_time):
         """Open the dataset that corresponds to a forecast field specified
@@ -78,20 +99,20 @@ class MSSPlotDriver(metaclass=ABCMeta):
 
         This method
           determines the files that correspond to an init time and forecast step
-          checks if an open NetCDF dataset exists
-            if yes, checks whether it contains the requested valid time
-              if not, closes the dataset and opens the corresponding one
-          loads dimension data if required.
+          takes the corresponding dataset from the pool of open datasets
+          checks whether it contains the requested valid time
+          sets the dimension data of the dataset.
         """
         if len(self.plot_object.required_datafields) == 0:
             logging.debug("no datasets required.")
-            self.dataset = None
+            self.release_dataset()
             self.init_time = None
             self.fc_time = None
             self.times = np.array([])
             self.lat_data = np.array([])
             self.lon_data = np.array([])
             self.lat_order = 1
+            self.grid_signature = None
             self.vert_data = None
             self.vert_order = None
             self.vert_units = None
@@ -108,30 +129,18 @@ class MSSPlotDriver(metaclass=ABCMeta):
         logging.debug("\trequested initialisation time %s", init_time)
         logging.debug("\trequested forecast valid time %s (step %s hrs)", fc_time, fc_step)
 
-        # Check if a dataset is open and if it contains the requested times.
-        # (a dataset will only be open if the used layer has not changed,
-        # i.e. the required variables have not changed as well).
-        if self.dataset is not None:
-            logging.debug("checking on open dataset.")
-            if self.init_time == init_time:
-                logging.debug("\tinitialisation time ok (%s).", init_time)
-                if fc_time in self.times:
-                    logging.debug("\tforecast valid time contained (%s).", fc_time)
-                    return
-            logging.debug("need to re-open input files.")
-            self.dataset.close()
-            self.dataset = None
-
         # Determine the input files from the required variables and the
         # requested time:
 
         # Create the names of the files containing the required parameters.
         filenames = []
+        self.data_files = {}
         for vartype, var, _ in self.plot_object.required_datafields:
             filename = self.data_access.get_filename(
                 var, vartype, init_time, fc_time, fullpath=True)
             if filename not in filenames:
                 filenames.append(filename)
+            self.data_files[var] = filename
             logging.debug("\tvariable '%s' requires input file '%s'",
                           var, os.path.basename(filename))
 
@@ -141,49 +150,34 @@ class MSSPlotDriver(metaclass=ABCMeta):
 
         self.init_time = init_time
 
-        # Open NetCDF files as one dataset with common dimensions.
-        logging.debug("opening datasets.")
+        # Open NetCDF files as one dataset with common dimensions. Time,
+        # lat/lon and vertical dimensions are loaded only once by the pool.
         dsKWargs = self.data_access.mfDatasetArgs()
-        dataset = netCDF4tools.MFDatasetCommonDims(filenames, **dsKWargs)
-
-        # Load and check time dimension. self.dataset will remain None
-        # if an Exception is raised here.
-        timename, timevar = netCDF4tools.identify_CF_time(dataset)
-        times = netCDF4tools.num2date(timevar[:], timevar.units)
-        # removed after discussion, see
-        # https://mss-devel.slack.com/archives/emerge/p1486658769000007
-        # if init_time != netCDF4tools.num2date(0, timevar.units):
-        #     dataset.close()
-        #     raise ValueError("wrong initialisation time in input")
-
-        if fc_time not in times:
+        with metrics.phase("open"), NETCDF_LOCK:
+            open_dataset = self.dataset_pool.acquire(filenames, **dsKWargs)
+
+        if fc_time not in open_dataset.times:
+            self.dataset_pool.release(open_dataset)
             msg = f"Forecast valid time '{fc_time}' is not available."
             logging.error(msg)
-            dataset.close()
             raise ValueError(msg)
 
-        # Load lat/lon dimensions.
-        try:
-            lat_data, lon_data, lat_order = netCDF4tools.get_latlon_data(dataset)
-        except Exception as ex:
-            logging.error("ERROR: %s %s", type(ex), ex)
-            dataset.close()
-            raise
-
-        _, vert_data, vert_orientation, vert_units, _ = netCDF4tools.identify_vertical_axis(dataset)
-        self.vert_data = vert_data[:] if vert_data is not None else None
-        self.vert_order = vert_orientation
-        self.vert_units = vert_units
-
-        self.dataset = dataset
-        self.times = times
-        self.lat_data = lat_data
-        self.lon_data = lon_data
-        self.lat_order = lat_order
+        self.release_dataset()
+        self.open_dataset = open_dataset
+        self.dataset = open_dataset.dataset
+        self.times = open_dataset.times
+        self.lat_data = open_dataset.lat_data
+        self.lon_data = open_dataset.lon_data
+        self.lat_order = open_dataset.lat_order
+        self.grid_signature = open_dataset.grid_signature
+        self.vert_data = open_dataset.vert_data
+        self.vert_order = open_dataset.vert_order
+        self.vert_units = open_dataset.vert_units
 
         # Identify the variable objects from the NetCDF file that correspond
         # to the data fields required by the plot object.
-        self._find_data_vars()
+        with metrics.phase("open"), NETCDF_LOCK:
+            self._find_data_vars()
 
     def _find_data_vars(self):
         """Find NetCDF variables of required data fields.
@@ -195,12 +189,128 @@ class MSSPlotDriver(metaclass=ABCMeta):
         <data_vars> can be accessed as <self.data_vars>.
         """
         self.data_vars = {}
+        self.data_ndims = {}
+        self.field_keys = {}
+        self.native_units = {}
         self.data_units = {}
-        for df_type, df_name, _ in self.plot_object.required_datafields:
+        for df_type, df_name, df_units in self.plot_object.required_datafields:
             varname, var = netCDF4tools.identify_variable(self.dataset, df_name, check=True)
             logging.debug("\tidentified variable <%s> for field <%s>", varname, df_name)
             self.data_vars[df_name] = var
-            self.data_units[df_name] = getattr(var, "units", None)
+            self.data_ndims[df_name] = len(var.shape)
+            self.native_units[df_name] = getattr(var, "units", None)
+            # Fields are loaded in the units required by the plot object.
+            self.data_units[df_name] = df_units if df_units is not None else self.native_units[df_name]
+
+    def _get_field(self, name, key, read):
+        """Returns the data field <name> as read by the function <read>,
+           converted to the units required by the plot object.
+
+        With a field cache, the converted field is stored under its file, NetCDF
+        variable, the units and <key>, which has to identify the time step,
+        level and region that <read> selects. Subsequent requests for the same
+        field skip reading and converting it.
+        """
+        units, required_units = self.native_units[name], self.data_units[name]
+        filename = self.data_files[name]
+        mtime = self.open_dataset.mtimes[self.open_dataset.filenames.index(filename)]
+        cache_key = (filename, mtime, self.data_vars[name].name, key, required_units)
+        self.field_keys[name] = cache_key
+        if self.field_cache is not None:
+            data = self.field_cache.get(cache_key)
+            metrics.count_cache("field", data is not None)
+            if data is not None:
+                logging.debug("\tTook data field <%s> from cache.", name)
+                return data
+        with metrics.phase("read"):
+            data = read()
+        metrics.add_read_bytes(data.nbytes)
+        logging.debug("\tLoaded %.2f Mbytes from data field <%s>.", data.nbytes / 1048576., name)
+        if required_units != units:
+            with metrics.phase("convert"):
+                data = convert_to(data, units, required_units)
+        if self.field_cache is not None:
+            self.field_cache.put(cache_key, data)
+        return data
+
+    def _get_section_key(self):
+        """Returns a key identifying how the loaded fields are processed before
+           plotting, e.g. interpolated to a path. Fields derived from the
+           processed fields are cached under this key.
+        """
+        return None
+
+    def _get_derived_input(self, name, data, units):
+        """Returns the value of input field <name> of a derived field in
+           <units> and a key identifying it, or None as key if the value cannot
+           be cached.
+
+        Fields in <data> are taken to be in the units they were loaded in.
+        """
+        if name in data:
+            # Fields replaced by the plot object are not identified by their key.
+            key = self.field_keys.get(name) if data[name] is self.loaded_data.get(name) else None
+            data_units = self.data_units.get(name)
+            if data_units is None or data_units == units:
+                return data[name], key
+            with metrics.phase("convert"):
+                return convert_to(data[name], data_units, units), key
+        if name in DERIVED_FIELDS:
+            return self._get_derived_field(name, data, units)
+        raise ValueError(f"input data field '{name}' of a derived field is not available")
+
+    def _get_derived_field(self, name, data, units=None):
+        derived = DERIVED_FIELDS[name]
+        inputs = [self._get_derived_input(_x, data, _y) for _x, _y in zip(derived.inputs, derived.input_units)]
+        units = units if units is not None else derived.units
+        cache_key = None
+        if all(_x[1] is not None for _x in inputs):
+            cache_key = ("derived", name, units, self._get_section_key(), tuple(_x[1] for _x in inputs))
+            if self.field_cache is not None:
+                value = self.field_cache.get(cache_key)
+                metrics.count_cache("derived", value is not None)
+                if value is not None:
+                    logging.debug("\tTook derived field <%s> from cache.", name)
+                    return value, cache_key
+        logging.debug("\tComputing derived field <%s>.", name)
+        with metrics.phase("derived"):
+            value = derived.function(*[_x[0] for _x in inputs])
+            if units != derived.units:
+                value = convert_to(value, derived.units, units)
+        if self.field_cache is not None and cache_key is not None:
+            self.field_cache.put(cache_key, value)
+        return value, cache_key
+
+    def get_derived_field(self, name, data, units=None):
+        """Returns the field <name> registered in mslib.mswms.derived, computed
+           from the loaded fields in <data> and converted to <units>.
+
+        Derived fields are computed once per loaded data and kept in the field
+        cache, if existing.
+        """
+        return self._get_derived_field(name, data, units)[0]
+
+    def _read_index_window(self, var, index):
+        """Read the lat/lon window <self.lat_window>, <self.lon_windows> of the
+           field selected by <index> from NetCDF variable <var>.
+
+        Latitudes are returned in increasing order.
+        """
+        lat_window = self.lat_window
+        if self.lat_order == -1:
+            # Latitudes are stored in decreasing order.
+            num_lats = len(self.lat_data)
+            lat_window = slice(num_lats - lat_window.stop, num_lats - lat_window.start)
+        # Only reading from the NetCDF library is serialised, not processing.
+        with NETCDF_LOCK:
+            parts = [var[index + (lat_window, _x)] for _x in self.lon_windows]
+        if len(parts) == 1:
+            var_data = parts[0]
+        elif any(isinstance(_x, np.ma.MaskedArray) for _x in parts):
+            var_data = np.ma.concatenate(parts, axis=-1)
+        else:
+            var_data = np.concatenate(parts, axis=-1)
+        return var_data[..., ::self.lat_order, :]
 
     def have_data(self, plot_object, init_time, valid_time):
         """Checks if this driver has the required data to do the plot
@@ -234,9 +344,8 @@ class MSSPlotDriver(metaclass=ABCMeta):
         # (the required variables could have changed).
         if self.plot_object is not None:
             require_reload = require_reload or (self.plot_object != plot_object)
-        if require_reload and self.dataset is not None:
-            self.dataset.close()
-            self.dataset = None
+        if require_reload:
+            self.release_dataset()
 
         self.plot_object = plot_object
         self.figsize = figsize
@@ -337,6 +446,14 @@ class VerticalSectionDriver(MSSPlotDriver):
        to be registered).
     """
 
+    def __init__(self, data_access_object, dataset_pool=None, field_cache=None, section_cache=None):
+        """The interpolation points of paths and their interpolation stencils
+           are kept in the optional SectionCache <section_cache>, which may be
+           shared by all vertical section drivers.
+        """
+        MSSPlotDriver.__init__(self, data_access_object, dataset_pool=dataset_pool, field_cache=field_cache)
+        self.section_cache = section_cache
+
     def set_plot_parameters(self, plot_object=None, vsec_path=None,
                             vsec_numpoints=101, vsec_path_connection='linear',
                             vsec_numlabels=10,
@@ -401,16 +518,94 @@ class VerticalSectionDriver(MSSPlotDriver):
                                    vsec_path_connection='linear'):
         """
         """
-        logging.debug("computing %i interpolation points, connection: %s",
-                      vsec_numpoints, vsec_path_connection)
-        now = datetime.now()
-        self.lats, self.lons, _ = utils.path_points(
-            [(_x, _y, now) for _x, _y in vsec_path],
-            numpoints=vsec_numpoints, connection=vsec_path_connection)
+        key = ("path", tuple(tuple(_x) for _x in vsec_path), vsec_numpoints, vsec_path_connection)
+        points = None
+        if self.section_cache is not None:
+            points = self.section_cache.get(key)
+            metrics.count_cache("section", points is not None)
+        if points is None:
+            logging.debug("computing %i interpolation points, connection: %s",
+                          vsec_numpoints, vsec_path_connection)
+            now = datetime.now()
+            lats, lons, _ = utils.path_points(
+                [(_x, _y, now) for _x, _y in vsec_path],
+                numpoints=vsec_numpoints, connection=vsec_path_connection)
+            points = (np.asarray(lats), np.asarray(lons))
+            if self.section_cache is not None:
+                self.section_cache.put(key, points)
+        self.lats, self.lons = points
         self.vsec_path = vsec_path
         self.vsec_numpoints = vsec_numpoints
         self.vsec_path_connection = vsec_path_connection
 
+    def _get_section_key(self):
+        return (tuple(tuple(_x) for _x in self.vsec_path), self.vsec_numpoints, self.vsec_path_connection)
+
+    def _set_index_window(self):
+        """Determine the part of the lat/lon grid surrounding the cross-section
+           path (see mslib.utils.get_index_window).
+
+        The cropped coordinates are stored in <self.window_lat_data> and
+        <self.window_lon_data>.
+        """
+        self.lat_window = slice(0, len(self.lat_data))
+        self.lon_windows = [slice(0, len(self.lon_data))]
+        if len(self.lat_data) > 1:
+            extent = (self.lons.min(), self.lats.min(), self.lons.max(), self.lats.max())
+            lat_window, lon_windows = utils.get_index_window(self.lat_data, self.lon_data, extent)
+            if lat_window.stop - lat_window.start > 1 and sum(_x.stop - _x.start for _x in lon_windows) > 1:
+                self.lat_window, self.lon_windows = lat_window, lon_windows
+            logging.debug("reading index window %s / %s for path region %s",
+                          self.lat_window, self.lon_windows, extent)
+        self.window_lat_data = self.lat_data[self.lat_window]
+        self.window_lon_data = np.concatenate([self.lon_data[_x] for _x in self.lon_windows])
+
+    def _get_stencil(self):
+        """Returns the interpolation stencil of the path on the data grid (see
+           mslib.utils.get_vertsec_stencil) and sets the index window of the
+           grid surrounding the path.
+
+        Both are kept in the section cache for the grid signature of the
+        dataset, so that further requests for the path on the same grid (e.g.
+        for other times or styles) only gather the data.
+        """
+        key = ("stencil",) + self._get_section_key() + (self.grid_signature,)
+        cached = None
+        if self.section_cache is not None:
+            cached = self.section_cache.get(key)
+            metrics.count_cache("section", cached is not None)
+        if cached is not None:
+            (self.lat_window, self.lon_windows, self.window_lat_data, self.window_lon_data), stencil = cached
+            return stencil
+
+        # Determine the westmost longitude in the cross-section path. Subtract
+        # one gridbox size to obtain "left_longitude".
+        dlon = self.lon_data[1] - self.lon_data[0]
+        left_longitude = self.lons.min() - dlon
+        logging.debug("shifting data grid to gridpoint west of westmost "
+                      "longitude in path: %.2f (path %.2f).",
+                      left_longitude, self.lons.min())
+
+        self._set_index_window()
+
+        # Shift the longitude field such that the data is in the range
+        # left_longitude .. left_longitude+360.
+        # NOTE: This does not overwrite self.lon_data (which is required
+        # in its original form in case other data is loaded while this
+        # file is open).
+        lon_data = ((self.window_lon_data - left_longitude) % 360) + left_longitude
+        lon_indices = lon_data.argsort()
+        lon_data = lon_data[lon_indices]
+
+        # The interpolation weights are the same for all variables and levels.
+        stencil = utils.get_vertsec_stencil(self.window_lat_data, lon_data, self.lats, self.lons)
+        # Map the stencil to the unsorted longitudes of the window.
+        stencil = (stencil[0], lon_indices[stencil[1]]) + stencil[2:]
+        if self.section_cache is not None:
+            self.section_cache.put(
+                key, ((self.lat_window, self.lon_windows, self.window_lat_data, self.window_lon_data), stencil))
+        return stencil
+
     def _load_interpolate_timestep(self):
         """Load and interpolate the data fields as required by the vertical
            section style instance. Only data of time <fc_time> is processed.
@@ -431,37 +626,24 @@ class VerticalSectionDriver(MSSPlotDriver):
         timestep = self.times.searchsorted(self.fc_time)
         logging.debug("loading data for time step %s (%s)", timestep, self.fc_time)
 
-        # Determine the westmost longitude in the cross-section path. Subtract
-        # one gridbox size to obtain "left_longitude".
-        dlon = self.lon_data[1] - self.lon_data[0]
-        left_longitude = self.lons.min() - dlon
-        logging.debug("shifting data grid to gridpoint west of westmost "
-                      "longitude in path: %.2f (path %.2f).",
-                      left_longitude, self.lons.min())
-
-        # Shift the longitude field such that the data is in the range
-        # left_longitude .. left_longitude+360.
-        # NOTE: This does not overwrite self.lon_data (which is required
-        # in its original form in case other data is loaded while this
-        # file is open).
-        lon_data = ((self.lon_data - left_longitude) % 360) + left_longitude
-        lon_indices = lon_data.argsort()
-        lon_data = lon_data[lon_indices]
+        # Only the part of the grid surrounding the path is read.
+        stencil = self._get_stencil()
+        window = ((self.lat_window.start, self.lat_window.stop),
+                  tuple((_x.start, _x.stop) for _x in self.lon_windows))
 
         for name, var in self.data_vars.items():
-            if len(var.shape) == 4:
-                var_data = var[timestep, ::-self.vert_order, ::self.lat_order, :]
+            if self.data_ndims[name] == 4:
+                var_data = self._get_field(
+                    name, (timestep,) + window,
+                    lambda: self._read_index_window(var, (timestep, slice(None, None, -self.vert_order))))
             else:
-                var_data = var[:][timestep, np.newaxis, ::self.lat_order, :]
-            logging.debug("\tLoaded %.2f Mbytes from data field <%s> at timestep %s.",
-                          var_data.nbytes / 1048576., name, timestep)
+                var_data = self._get_field(
+                    name, (timestep,) + window, lambda: self._read_index_window(var, (timestep,))[np.newaxis])
             logging.debug("\tVertical dimension direction is %s.",
                           "up" if self.vert_order == 1 else "down")
             logging.debug("\tInterpolating to cross-section path.")
-            # Re-arange longitude dimension in the data field.
-            var_data = var_data[:, :, lon_indices]
-            data[name] = utils.interpolate_vertsec(var_data, self.lat_data, lon_data,
-                                                   self.lats, self.lons)
+            data[name] = utils.apply_vertsec_stencil(var_data, stencil)
+            metrics.observe_array_bytes(var_data.nbytes + sum(_x.nbytes for _x in data.values()))
             # Free memory.
             del var_data
 
@@ -501,7 +683,9 @@ class VerticalSectionDriver(MSSPlotDriver):
         # section style instance. <data> is a dictionary containing the
         # interpolated curtains of the variables identified through CF
         # standard names as specified by <self.vsec_style_instance>.
-        data = self._load_interpolate_timestep()
+        with metrics.phase("interpolate"):
+            data = self._load_interpolate_timestep()
+        self.loaded_data = dict(data)
 
         d2 = datetime.now()
         logging.debug("Loaded and interpolated data (required time %s).", d2 - d1)
@@ -543,10 +727,19 @@ class HorizontalSectionDriver(MSSPlotDriver):
        to be registered).
     """
 
+    def __init__(self, data_access_object, dataset_pool=None, field_cache=None, points_per_pixel=None):
+        """If <points_per_pixel> is given, fields with more grid points per
+           pixel of the requested image are block-averaged to about this
+           resolution before plotting (see _get_decimation_factor).
+        """
+        MSSPlotDriver.__init__(self, data_access_object, dataset_pool=dataset_pool, field_cache=field_cache)
+        self.points_per_pixel = points_per_pixel
+
     def set_plot_parameters(self, plot_object=None, bbox=None, level=None, crs=None, init_time=None, valid_time=None,
                             style=None, figsize=(800, 600), noframe=False, show=False, transparent=False,
-                            return_format="image/png"):
-        """
+                            return_format="image/png", overlays=None):
+        """<overlays> is a list of tuples (plot object, style) of further
+           layers drawn onto the map of <plot_object> in the given order.
         """
         MSSPlotDriver.set_plot_parameters(self, plot_object,
                                           init_time=init_time,
@@ -560,9 +753,11 @@ class HorizontalSectionDriver(MSSPlotDriver):
         self.actual_level = None
         self.crs = crs
         self.show = show
+        self.overlays = list(overlays) if overlays is not None else []
 
     def update_plot_parameters(self, plot_object=None, bbox=None, level=None, crs=None, init_time=None, valid_time=None,
-                               style=None, figsize=None, noframe=None, show=None, transparent=None, return_format=None):
+                               style=None, figsize=None, noframe=None, show=None, transparent=None, return_format=None,
+                               overlays=None):
         """
         """
         plot_object = plot_object if plot_object is not None else self.plot_object
@@ -577,14 +772,67 @@ class HorizontalSectionDriver(MSSPlotDriver):
         show = show if show is not None else self.show
         transparent = transparent if transparent is not None else self.transparent
         return_format = return_format if return_format is not None else self.return_format
+        overlays = overlays if overlays is not None else self.overlays
         self.set_plot_parameters(plot_object=plot_object, bbox=bbox, level=level, crs=crs, init_time=init_time,
                                  valid_time=valid_time, style=style, figsize=figsize, noframe=noframe, show=show,
-                                 transparent=transparent, return_format=return_format)
+                                 transparent=transparent, return_format=return_format, overlays=overlays)
+
+    def _get_derived_input(self, name, data, units):
+        # Fields on pressure levels are derived with the pressure of the level.
+        if name == "air_pressure" and name not in data and self.actual_level is not None:
+            try:
+                pressure_levels = UR(self.vert_units).dimensionality == UR.Pa.dimensionality
+            except (KeyError, ValueError, pint.UndefinedUnitError):
+                pressure_levels = False
+            if not pressure_levels:
+                raise ValueError(f"air_pressure is required for a derived field, but neither loaded nor given "
+                                 f"by the levels in '{self.vert_units}'")
+            return convert_to(self.actual_level, self.vert_units, units), ("level", self.actual_level)
+        return MSSPlotDriver._get_derived_input(self, name, data, units)
+
+    def _set_index_window(self):
+        """Determine the part of the lat/lon grid required for the requested
+           map (see mslib.utils.get_index_window).
+
+        The cropped coordinates are stored in <self.window_lat_data> and
+        <self.window_lon_data>.
+        """
+        self.lat_window = slice(0, len(self.lat_data))
+        self.lon_windows = [slice(0, len(self.lon_data))]
+        extent = None
+        if len(self.lat_data) > 1:
+            extent = self.plot_object.get_lonlat_extent(self.bbox, self.crs)
+        if extent is not None:
+            lat_window, lon_windows = utils.get_index_window(self.lat_data, self.lon_data, extent)
+            # Plotting requires at least 2x2 grid points.
+            if lat_window.stop - lat_window.start > 1 and sum(_x.stop - _x.start for _x in lon_windows) > 1:
+                self.lat_window, self.lon_windows = lat_window, lon_windows
+            logging.debug("reading index window %s / %s for region %s", self.lat_window, self.lon_windows, extent)
+        self.window_lat_data = self.lat_data[self.lat_window]
+        self.window_lon_data = np.concatenate([self.lon_data[_x] for _x in self.lon_windows])
+
+    def _get_decimation_factor(self):
+        """Returns the size of the blocks of grid points to be averaged, so
+           that the window of the grid determined by _set_index_window() has
+           about <self.points_per_pixel> grid points per pixel of the requested
+           image in the less resolved direction.
+        """
+        if not self.points_per_pixel or self.figsize is None:
+            return 1
+        points_per_pixel = min(len(self.window_lon_data) / self.figsize[0],
+                               len(self.window_lat_data) / self.figsize[1])
+        return max(int(points_per_pixel / self.points_per_pixel), 1)
 
     def _load_timestep(self):
         """Load the data fields as required by the horizontal section style
            instance at the current timestep.
+
+        Only the part of the fields required for the requested map is read.
+        Fields much finer resolved than the requested image are block-averaged
+        (see _get_decimation_factor).
         """
+        self._set_index_window()
+        self.decimation = self._get_decimation_factor()
         if self.dataset is None:
             return {}
         data = {}
@@ -598,50 +846,59 @@ class HorizontalSectionDriver(MSSPlotDriver):
             self.actual_level = self.vert_data[level]
         logging.debug("loading data for time step %s (%s), level index %s (level %s)",
                       timestep, self.fc_time, level, self.actual_level)
+        window = ((self.lat_window.start, self.lat_window.stop),
+                  tuple((_x.start, _x.stop) for _x in self.lon_windows), self.decimation)
         for name, var in self.data_vars.items():
-            if level is None or len(var.shape) == 3:
+            if level is None or self.data_ndims[name] == 3:
                 # 2D fields: time, lat, lon.
-                var_data = var[timestep, ::self.lat_order, :]
+                index = (timestep,)
             else:
                 # 3D fields: time, level, lat, lon.
-                var_data = var[timestep, level, ::self.lat_order, :]
-            logging.debug("\tLoaded %.2f Mbytes from data field <%s>.",
-                          var_data.nbytes / 1048576., name)
-            data[name] = var_data
-            # Free memory.
-            del var_data
-
+                index = (timestep, level)
+            if self.decimation > 1:
+                data[name] = self._get_field(name, index + window, lambda: utils.block_average(
+                    self._read_index_window(var, index), self.decimation))
+            else:
+                data[name] = self._get_field(name, index + window, lambda: self._read_index_window(var, index))
+
+        if self.decimation > 1:
+            logging.debug("averaged blocks of %i x %i grid points", self.decimation, self.decimation)
+            # The longitudes of the window are unwrapped before averaging.
+            lons = self.window_lon_data[0] + (self.window_lon_data - self.window_lon_data[0]) % 360
+            self.window_lat_data = utils.block_average(self.window_lat_data[:, np.newaxis], self.decimation)[:, 0]
+            self.window_lon_data = utils.block_average(lons[np.newaxis, :], self.decimation)[0]
+        metrics.observe_array_bytes(sum(_x.nbytes for _x in data.values()))
         return data
 
     def plot(self):
         """
         """
+        if self.overlays:
+            return self._plot_composite()
+
         d1 = datetime.now()
 
         # Load and interpolate the data fields as required by the horizontal
         # section style instance. <data> is a dictionary containing the
         # horizontal sections of the variables identified through CF
         # standard names as specified by <self.hsec_style_instance>.
-        data = self._load_timestep()
+        with metrics.phase("load"):
+            data = self._load_timestep()
+        self.loaded_data = dict(data)
 
         d2 = datetime.now()
         logging.debug("Loaded data (required time %s).", (d2 - d1))
         logging.debug("Plotting horizontal section.")
 
-        if len(self.lat_data) > 1:
-            resolution = (self.lat_data[1] - self.lat_data[0])
-        else:
-            resolution = 0
-
         # Call the plotting method of the horizontal section style instance.
         image = self.plot_object.plot_hsection(data,
-                                               self.lat_data,
-                                               self.lon_data,
+                                               self.window_lat_data,
+                                               self.window_lon_data,
                                                self.bbox,
                                                level=self.actual_level,
                                                valid_time=self.fc_time,
                                                init_time=self.init_time,
-                                               resolution=resolution,
+                                               resolution=self._get_resolution(),
                                                show=self.show,
                                                crs=self.crs,
                                                style=self.style,
@@ -656,3 +913,190 @@ class HorizontalSectionDriver(MSSPlotDriver):
                       "time %s).\n", d3 - d2, d3 - d1)
 
         return image
+
+    def get_point_values(self, required_datafields, init_time, lat, lon, level=None, valid_times=None):
+        """Returns the values of the data fields <required_datafields> at
+           <lat>, <lon> for all valid times of <init_time>, or for those of
+           <valid_times> that are available.
+
+        The values are bilinearly interpolated from the surrounding 2x2 grid
+        points (see utils.get_point_stencil), which are all that is read from
+        the data files, for all time steps of a file at once. Fields on
+        vertical levels are given at <level> or, if None, on all levels.
+
+        Returns a dictionary by vertical type and standard name of
+        dictionaries with the "units", the sorted "valid_times", the "levels"
+        and the "values" by valid time (and level, if <level> is None) of
+        each field.
+        """
+        result = {}
+        for vartype, name, units in required_datafields:
+            available = self.data_access.get_valid_times(name, vartype, init_time)
+            times = sorted(set(available) if valid_times is None else set(valid_times) & set(available))
+            files = {}
+            for valid_time in times:
+                filename = self.data_access.get_filename(name, vartype, init_time, valid_time, fullpath=True)
+                files.setdefault(filename, []).append(valid_time)
+            values, levels = [], None
+            for filename, file_times in files.items():
+                part, levels, native_units = self._read_point(filename, name, file_times, lat, lon, level)
+                if units is not None and units != native_units:
+                    with metrics.phase("convert"):
+                        part = convert_to(part, native_units, units)
+                values.append(part)
+                units = units if units is not None else native_units
+            result.setdefault(vartype, {})[name] = {
+                "units": units, "valid_times": times, "levels": levels,
+                "values": np.ma.concatenate(values) if values else np.ma.masked_array([])}
+        return result
+
+    def _read_point(self, filename, name, valid_times, lat, lon, level):
+        """Reads the field <name> of <filename> at <lat>, <lon> for the time
+           steps <valid_times> (see get_point_values).
+
+        Returns the values, the levels and the units of the field.
+        """
+        with metrics.phase("open"), NETCDF_LOCK:
+            open_dataset = self.dataset_pool.acquire([filename], **self.data_access.mfDatasetArgs())
+        try:
+            with metrics.phase("open"), NETCDF_LOCK:
+                _, var = netCDF4tools.identify_variable(open_dataset.dataset, name, check=True)
+                native_units = getattr(var, "units", None)
+                ndim = len(var.shape)
+            lat_indices, lon_indices, weights = utils.get_point_stencil(
+                open_dataset.lat_data, open_dataset.lon_data, lat, lon)
+            if open_dataset.lat_order == -1:
+                # Latitudes are stored in decreasing order.
+                lat_window = slice(len(open_dataset.lat_data) - 2 - lat_indices[0],
+                                   len(open_dataset.lat_data) - lat_indices[0])
+            else:
+                lat_window = slice(lat_indices[0], lat_indices[0] + 2)
+
+            # Equidistant time steps are read with a single strided read.
+            times = list(open_dataset.times)
+            time_indices = [times.index(_x) for _x in valid_times]
+            steps = set(np.diff(time_indices)) or {1}
+            if len(steps) == 1:
+                time_index = slice(time_indices[0], time_indices[-1] + 1, steps.pop())
+            else:
+                time_index = time_indices
+
+            levels = None
+            index = (time_index,)
+            if ndim == 4:
+                vert_data = open_dataset.vert_data
+                if level is not None:
+                    level_index = np.abs(vert_data - level).argmin()
+                    if abs(vert_data[level_index] - level) > 1e-3 * np.abs(np.diff(vert_data).mean()):
+                        raise ValueError("Requested elevation not available.")
+                    levels = [float(vert_data[level_index])]
+                    index += (int(level_index),)
+                else:
+                    levels = [float(_x) for _x in vert_data]
+                    index += (slice(None),)
+
+            with metrics.phase("read"), NETCDF_LOCK:
+                if lon_indices[1] == lon_indices[0] + 1:
+                    data = var[index + (lat_window, slice(lon_indices[0], lon_indices[1] + 1))]
+                else:
+                    data = np.ma.concatenate([var[index + (lat_window, slice(_x, _x + 1))] for _x in lon_indices],
+                                             axis=-1)
+            metrics.add_read_bytes(data.nbytes)
+        finally:
+            self.dataset_pool.release(open_dataset)
+
+        data = np.ma.masked_invalid(data[..., ::open_dataset.lat_order, :])
+        values = (data.filled(0) * weights).sum(axis=(-2, -1))
+        values = np.ma.masked_array(values, mask=np.ma.getmaskarray(data).any(axis=(-2, -1)))
+        return values, levels, native_units
+
+    def _get_resolution(self):
+        if len(self.lat_data) > 1:
+            return (self.lat_data[1] - self.lat_data[0]) * self.decimation
+        return 0
+
+    def _plot_composite(self):
+        """Draws the plot object and the overlays onto one map and returns
+           the image.
+        """
+        d1 = datetime.now()
+        count = self._draw_layers()
+        # A fixed palette of a single style does not fit the composite.
+        image = self.plot_object.encode_image(show=self.show, transparent=self.transparent)
+        logging.debug("Finished plotting %i layers (total time %s).\n", count, datetime.now() - d1)
+        return image
+
+    def _draw_layers(self, reuse_map=False):
+        """Draws the plot object and the overlays onto one map, reusing the
+           map of the plot object drawn before if <reuse_map>. Returns the
+           number of layers drawn.
+
+        The overlays share the figure, the basemap and the projected grid
+        with the plot object. Fields required by several layers are read once
+        from the field cache; a temporary one is used if the driver has none.
+        """
+        base = self.plot_object
+        style, level, init_time, valid_time = self.style, self.level, self.init_time, self.fc_time
+        field_cache = self.field_cache
+        if field_cache is None and self.overlays:
+            self.field_cache = FieldCache()
+        layers = [(_x, _y, level if _x.uses_elevation_dimension() else None)
+                  for _x, _y in [(base, style)] + list(self.overlays)]
+        try:
+            for index, (plot_object, layer_style, layer_level) in enumerate(layers):
+                logging.debug("Plotting layer '%s' (%i of %i).", plot_object.name, index + 1, len(layers))
+                self.style, self.level, self.actual_level = layer_style, layer_level, None
+                if index > 0:
+                    self.plot_object = plot_object
+                    self._set_time(init_time, valid_time)
+                with metrics.phase("load"):
+                    data = self._load_timestep()
+                self.loaded_data = dict(data)
+                plot_object.draw_hsection(data,
+                                          self.window_lat_data,
+                                          self.window_lon_data,
+                                          self.bbox,
+                                          level=self.actual_level,
+                                          valid_time=self.fc_time,
+                                          init_time=self.init_time,
+                                          resolution=self._get_resolution(),
+                                          crs=self.crs,
+                                          style=self.style,
+                                          noframe=self.noframe,
+                                          figsize=self.figsize,
+                                          base=base if index > 0 or reuse_map else None)
+                del data
+        finally:
+            self.field_cache = field_cache
+            self.style, self.level = style, level
+            if self.plot_object is not base:
+                self.plot_object = base
+                self._set_time(init_time, valid_time)
+        return len(layers)
+
+    def plot_frames(self, valid_times):
+        """Returns the maps of the plot object and the overlays at each of
+           <valid_times> as list of PNG images, e.g. for an animation.
+
+        The figure, the basemap and the projected grid of the first map are
+        reused for all further maps; only the layers are drawn anew.
+        """
+        d1 = datetime.now()
+        base, init_time, valid_time = self.plot_object, self.init_time, self.fc_time
+        # A fixed palette of a single style does not fit the composite.
+        palette = base.palette if not self.overlays else None
+        frames = []
+        try:
+            for index, frame_time in enumerate(valid_times):
+                logging.debug("Plotting frame %i of %i (%s).", index + 1, len(valid_times), frame_time)
+                if frame_time != self.fc_time:
+                    self._set_time(init_time, frame_time)
+                if index > 0:
+                    base.clear_hsection()
+                self._draw_layers(reuse_map=index > 0)
+                frames.append(base.encode_image(transparent=self.transparent, palette=palette))
+        finally:
+            if self.fc_time != valid_time:
+                self._set_time(init_time, valid_time)
+        logging.debug("Finished plotting %i frames (total time %s).\n", len(frames), datetime.now() - d1)
+        return frames
@@ -45,6 +45,31 @@ def main():
     parser.add_argument("--debug", help="show debugging log messages on console", action="store_true", default=False)
     parser.add_argument("--logfile", help="If set to a name log output goes to that file", dest="logfile",
                         default=None)
+
+    subparsers = parser.add_subparsers(help="Available actions (default: run the server)", dest="action")
+    seed = subparsers.add_parser(
+        "seed", help="render the images of the map sections and paths configured in mss_wms_settings.py "
+                     "(seed_map_sections, seed_vsec_paths, seed_elevations) into the image cache")
+    seed.add_argument("--init-time", help="'latest', 'all' or an ISO init time (default: latest)",
+                      dest="init_time", default="latest")
+    seed.add_argument("--layers", help="render only layers matching these patterns, e.g. 'ecmwf_EUR_LL015.PL*'",
+                      nargs="+", default=None)
+    seed.add_argument("--all-styles", help="render all styles of each layer, not only the default one",
+                      dest="all_styles", action="store_true", default=False)
+    seed.add_argument("--processes", help="number of rendering processes (default: number of CPUs)",
+                      type=int, default=None)
+    seed.add_argument("--dry-run", help="list the requests without rendering them",
+                      dest="dry_run", action="store_true", default=False)
+    convert = subparsers.add_parser(
+        "convert", help="convert NetCDF data files into chunk stores read by ChunkedDataAccess")
+    convert.add_argument("files", help="NetCDF files to convert", nargs="+")
+    convert.add_argument("--output-dir", help="directory of the chunk stores (default: that of each file)",
+                         dest="output_dir", default=None)
+    convert.add_argument("--chunks", help="chunk sizes by dimension name, e.g. 'time=1,lat=64,lon=64' "
+                                          "(default: 128 points along lat and lon, 1 along other dimensions)",
+                         default="")
+    convert.add_argument("--compress-level", help="zlib compression level, 0 to store uncompressed (default: 1)",
+                         dest="compress_level", type=int, default=1)
     args = parser.parse_args()
 
     if args.version:
@@ -59,7 +84,23 @@ def main():
 
     logging.info("Configuration File: '%s'", mss_wms_settings.__file__)
 
-    application.run(args.host, args.port)
+    if args.action == "seed":
+        from mslib.mswms.seed import seed
+        counts = seed(init_time=args.init_time, layers=args.layers, all_styles=args.all_styles,
+                      processes=args.processes, dry_run=args.dry_run)
+        sys.exit(1 if counts["failed"] else 0)
+
+    if args.action == "convert":
+        from mslib.mswms.chunkstore import convert_files
+        try:
+            chunks = {_x.split("=")[0].strip(): int(_x.split("=")[1]) for _x in args.chunks.split(",") if _x}
+        except (IndexError, ValueError):
+            parser.error(f"invalid --chunks '{args.chunks}'")
+        failed = convert_files(args.files, output_dir=args.output_dir, chunks=chunks,
+                               compress_level=args.compress_level)
+        sys.exit(1 if failed else 0)
+
+    application.run(args.host, args.port, threaded=True)
 
 
 if __name__ == '__main__':
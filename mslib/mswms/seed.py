@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms.seed
+    ~~~~~~~~~~~~~~~~
+
+    Pre-rendering of the images of the WMS server into its image cache.
+
+    The images of all registered layers are rendered for the map sections and
+    vertical section paths configured in mss_wms_settings.py, e.g.
+
+        seed_map_sections = {
+            "01 Europe (cyl)": {"CRS": "EPSG:4326",
+                                "map": {"llcrnrlon": -15.0, "llcrnrlat": 35.0,
+                                        "urcrnrlon": 30.0, "urcrnrlat": 65.0},
+                                "width": 800, "height": 600}}
+        seed_vsec_paths = {
+            "Kiruna - Oberpfaffenhofen": {"path": [[67.8, 20.2], [48.1, 11.3]],
+                                          "bbox": [201, 1050, 10, 180],
+                                          "width": 800, "height": 300}}
+        seed_elevations = {"pl": [850, 500, 300, 250, 200]}
+
+    for all valid times of the latest (or the given) forecast initialisation
+    time. Images already contained in the image cache are skipped, so that an
+    interrupted run continues where it stopped when started again.
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import collections
+import datetime
+import fnmatch
+import logging
+import multiprocessing
+import time
+
+from multidict import CIMultiDict
+
+from mslib.mswms import wms
+from mslib.mswms.wms import mss_wms_settings
+from mslib.utils import parse_iso_datetime
+
+
+def _format_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _get_bbox(section):
+    """Returns the BBOX parameter of a map section given either by "BBOX" or
+       by the corners in "map" (for CRS with bounding boxes in degree).
+    """
+    if "BBOX" in section:
+        bbox = section["BBOX"]
+    else:
+        corners = section["map"]
+        bbox = (corners["llcrnrlon"], corners["llcrnrlat"], corners["urcrnrlon"], corners["urcrnrlat"])
+    return ",".join(str(_x) for _x in bbox)
+
+
+def _get_init_times(layer, init_time):
+    if not layer.uses_inittime_dimension():
+        return [None]
+    init_times = layer.get_init_times()
+    if init_time == "all":
+        return init_times
+    if init_time == "latest":
+        return init_times[-1:]
+    return [_x for _x in init_times if _x == init_time]
+
+
+def _get_elevations(layer, elevations):
+    """Returns the elevations of <layer> listed for its level type in
+       <elevations>, or all of them if the level type is not listed.
+    """
+    if not layer.uses_elevation_dimension():
+        return [None]
+    levels = layer.get_elevations()
+    vert_types = [_x for _x in layer.required_datatypes() if _x != "sfc"]
+    if elevations is None or not vert_types or vert_types[0] not in elevations:
+        return levels
+    return [_x for _x in levels if any(abs(float(_x) - _y) < 1e-3 for _y in elevations[vert_types[0]])]
+
+
+def _get_styles(layer, all_styles):
+    if not layer.styles:
+        return [""]
+    if all_styles:
+        return [_x[0] for _x in layer.styles]
+    return [layer.styles[0][0]]
+
+
+def get_seed_queries(server, map_sections=None, vsec_paths=None, elevations=None, init_time="latest",
+                     layers=None, all_styles=False):
+    """Returns a list of tuples (mode, query) of the GetMap requests for all
+       combinations of the layers registered with <server> and the map
+       sections, paths, elevations and times, ordered by valid time.
+
+    <init_time> is "latest", "all" or a datetime. <layers> optionally
+    restricts the layers to those matching one of the given patterns, e.g.
+    "ecmwf_EUR_LL015.PL*". Only the default style of a layer is rendered
+    unless <all_styles> is set.
+    """
+    map_sections = map_sections or {}
+    vsec_paths = vsec_paths or {}
+    queries = []
+    for registry, sections in ((server.hsec_layer_registry, map_sections), (server.vsec_layer_registry, vsec_paths)):
+        for dataset in sorted(registry):
+            for name in sorted(registry[dataset]):
+                layer = registry[dataset][name]
+                if layers and not any(fnmatch.fnmatch(f"{dataset}.{name}", _x) for _x in layers):
+                    continue
+                for section_name in sorted(sections):
+                    section = sections[section_name]
+                    query = {"REQUEST": "GetMap", "VERSION": "1.1.1", "LAYERS": f"{dataset}.{name}",
+                             "FORMAT": "image/png", "WIDTH": str(section.get("width", 900)),
+                             "HEIGHT": str(section.get("height", 600)),
+                             "TRANSPARENT": "TRUE" if section.get("transparent", False) else "FALSE"}
+                    if registry is server.hsec_layer_registry:
+                        mode = "getmap"
+                        query.update({"SRS": section["CRS"], "BBOX": _get_bbox(section)})
+                        levels = _get_elevations(layer, elevations)
+                    else:
+                        query.update({
+                            "SRS": "VERT:LOGP", "BBOX": ",".join(str(_x) for _x in section.get("bbox", [])),
+                            "PATH": ",".join(f"{_x[0]},{_x[1]}" for _x in section["path"])})
+                        mode = "getvsec"
+                        if not section.get("bbox"):
+                            del query["BBOX"]
+                        levels = [None]
+                    for init in _get_init_times(layer, init_time):
+                        valid_times = [None]
+                        if layer.uses_validtime_dimension():
+                            valid_times = server._get_valid_times(
+                                dataset, [name], init, datetime.datetime.min, datetime.datetime.max, mode=mode)
+                        for valid in valid_times:
+                            for level in levels:
+                                for style in _get_styles(layer, all_styles):
+                                    item = dict(query, STYLES=style)
+                                    if init is not None:
+                                        item["DIM_INIT_TIME"] = _format_time(init)
+                                    if valid is not None:
+                                        item["TIME"] = _format_time(valid)
+                                    if level is not None:
+                                        item["ELEVATION"] = level
+                                    queries.append((valid, "getmap", item))
+    queries.sort(key=lambda _x: (_x[0] is not None, _x[0] or datetime.datetime.min))
+    return [_x[1:] for _x in queries]
+
+
+def _seed(job):
+    """Renders the image of <job> into the image cache of the server unless
+       already contained and returns a tuple (status, number of bytes,
+       message).
+    """
+    mode, query = job
+    server = wms.server
+    query = CIMultiDict(query)
+    try:
+        plot_mode, dataset, layer, params = server.parse_plot_query(query, mode)
+    except wms.ServiceException as ex:
+        return "failed", 0, ex.text
+    key, _ = server.get_plot_key(plot_mode, dataset, layer, params)
+    if key is not None and key in server.image_cache:
+        return "skipped", 0, None
+    image, return_format, _ = server.produce_plot(query, mode)
+    if return_format != params["return_format"]:
+        return "failed", 0, image.decode("utf-8", errors="replace") if isinstance(image, bytes) else image
+    return "rendered", len(image), None
+
+
+def seed(init_time="latest", layers=None, all_styles=False, processes=None, dry_run=False):
+    """Renders the images configured in mss_wms_settings.py into the image
+       cache of the server with a pool of <processes> processes and returns
+       the number of images by status (rendered, skipped and failed).
+    """
+    server = wms.server
+    if server.image_cache is None or server.image_cache.directory is None:
+        raise RuntimeError("Seeding requires an image cache directory shared with the server "
+                           "(image_cache_use and image_cache_directory in mss_wms_settings.py).")
+    if init_time not in ("latest", "all"):
+        init_time = parse_iso_datetime(init_time)
+    jobs = get_seed_queries(
+        server,
+        map_sections=mss_wms_settings.__dict__.get("seed_map_sections", {}),
+        vsec_paths=mss_wms_settings.__dict__.get("seed_vsec_paths", {}),
+        elevations=mss_wms_settings.__dict__.get("seed_elevations", None),
+        init_time=init_time, layers=layers, all_styles=all_styles)
+    logging.info("Seeding %i images", len(jobs))
+    counts = collections.Counter()
+    if dry_run:
+        for _, query in jobs:
+            print("&".join(f"{_x}={_y}" for _x, _y in query.items()))
+        return counts
+
+    nbytes = 0
+    start = last_report = time.time()
+    # spawned instead of forked workers, which could inherit locks held by
+    # other threads, e.g. NETCDF_LOCK; each worker builds its own server
+    pool = multiprocessing.get_context("spawn").Pool(processes, initializer=wms._init_render_process)
+    try:
+        for index, (status, size, message) in enumerate(pool.imap_unordered(_seed, jobs), start=1):
+            counts[status] += 1
+            nbytes += size
+            if message is not None:
+                logging.error("Could not render image: %s", message)
+            now = time.time()
+            if now - last_report >= 10 or index == len(jobs):
+                last_report = now
+                logging.info("%i/%i images (%i rendered, %i skipped, %i failed), %.2f images/s, %.1f MiB",
+                             index, len(jobs), counts["rendered"], counts["skipped"], counts["failed"],
+                             counts["rendered"] / max(now - start, 1e-6), nbytes / 1024 ** 2)
+        pool.close()
+    except KeyboardInterrupt:
+        logging.warning("Interrupted; images rendered so far are kept and skipped when seeding again.")
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
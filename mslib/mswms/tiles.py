@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms.tiles
+    ~~~~~~~~~~~~~~~~~
+
+    Tile matrix sets of the tile endpoint of the MSS WMS server.
+
+    Tiles are addressed as in XYZ/WMTS REST services by zoom level, column and
+    row, counted from the upper left corner of the tile matrix. Neighbouring
+    tiles are rendered together as one metatile, i.e. a single GetMap image
+    that is sliced into the tiles afterwards.
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import collections
+
+TileMatrixSet = collections.namedtuple("TileMatrixSet", ["crs", "extent", "matrix_width", "matrix_height"])
+
+# Well-known tile matrix sets of the OGC Two Dimensional Tile Matrix Set
+# standard, with the extent (xmin, ymin, xmax, ymax) in the units of the bbox
+# of the CRS and the number of tiles at zoom level 0.
+_WEB_MERCATOR = 20037508.342789244
+TILE_MATRIX_SETS = {
+    "webmercatorquad": TileMatrixSet("EPSG:3857", (-_WEB_MERCATOR, -_WEB_MERCATOR, _WEB_MERCATOR, _WEB_MERCATOR), 1, 1),
+    "worldcrs84quad": TileMatrixSet("EPSG:4326", (-180., -90., 180., 90.), 2, 1),
+}
+
+TILE_SIZE = 256
+
+# Highest zoom level, beyond which tiles are finer than any data.
+MAX_ZOOM = 30
+
+
+def get_tile_matrix_set(name):
+    """Returns the TileMatrixSet of <name> (case-insensitive) or None.
+    """
+    return TILE_MATRIX_SETS.get(name.lower())
+
+
+def get_matrix_size(tile_matrix_set, zoom):
+    """Returns the number of tile columns and rows at <zoom>.
+    """
+    return tile_matrix_set.matrix_width * 2 ** zoom, tile_matrix_set.matrix_height * 2 ** zoom
+
+
+def get_tile_bbox(tile_matrix_set, zoom, column, row, columns=1, rows=1):
+    """Returns the bbox (xmin, ymin, xmax, ymax) covered by <columns> x <rows>
+       tiles starting at the tile <column>, <row>.
+    """
+    xmin, ymin, xmax, ymax = tile_matrix_set.extent
+    matrix_width, matrix_height = get_matrix_size(tile_matrix_set, zoom)
+    tile_width = (xmax - xmin) / matrix_width
+    tile_height = (ymax - ymin) / matrix_height
+    return (xmin + column * tile_width, ymax - (row + rows) * tile_height,
+            xmin + (column + columns) * tile_width, ymax - row * tile_height)
+
+
+def get_metatile(tile_matrix_set, zoom, column, row, size):
+    """Returns the metatile of at most <size> x <size> tiles containing the
+       tile <column>, <row> as tuple (first column, first row, columns, rows).
+
+    Metatiles are aligned to multiples of <size> and clipped to the tile
+    matrix, so that all tiles of a metatile map to the same one.
+    """
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise ValueError(f"zoom level {zoom} is outside of 0..{MAX_ZOOM}")
+    matrix_width, matrix_height = get_matrix_size(tile_matrix_set, zoom)
+    if not (0 <= column < matrix_width and 0 <= row < matrix_height):
+        raise ValueError(f"tile {column}/{row} is outside of the tile matrix of zoom level {zoom}")
+    first_column, first_row = column - column % size, row - row % size
+    return (first_column, first_row,
+            min(size, matrix_width - first_column), min(size, matrix_height - first_row))
@@ -25,10 +25,17 @@
     limitations under the License.
 """
 
+import io
+import logging
+import zipfile
+
 import numpy as np
 import matplotlib
+import PIL.Image
 import pint
 
+from mslib.mswms import metrics
+
 UR = pint.UnitRegistry()
 N_LEVELS = 16
 
@@ -476,3 +483,134 @@ def get_cbar_label_format(style, maxvalue):
     if style == 'log_ice_cloud':
         format = "%.0E"
     return format
+
+
+def encode_png(canvas, transparent=False, facecolor="white", palette=None, compress_level=6):
+    """
+    Encodes the figure of a matplotlib Agg canvas as 8bit palette PNG image.
+
+    The RGBA buffer of the Agg renderer is quantized directly, without writing
+    and decoding an intermediate PNG image. The palette image has a
+    significantly smaller file size (~factor 4, from RGBA to one 8bit value,
+    plus the space to store the palette colours).
+
+    Alpha values are lost in the quantization. If transparency is requested,
+    the figure face colour is stored as the "transparent" colour in the image.
+    This works in most cases, but might lead to visible artefacts in some
+    cases.
+
+    Args:
+        canvas: FigureCanvasAgg of the figure
+        transparent (optional): whether the background shall be transparent
+        facecolor (optional): name of the figure face colour
+        palette (optional): list of RGB tuples (0..255) of a fixed colour
+            palette of at most 256 colours; an adaptive palette is used if None
+        compress_level (optional): zlib compression level (0..9)
+
+    Returns:
+        PNG image as bytes
+    """
+    with metrics.phase("draw"):
+        canvas.draw()
+
+    with metrics.phase("encode"):
+        width, height = canvas.get_width_height()
+        image = PIL.Image.frombuffer(
+            "RGBA", (width, height), canvas.buffer_rgba(), "raw", "RGBA", 0, 1).convert("RGB")
+
+        logging.debug("converting image to indexed palette.")
+        if palette is None:
+            palette_img = image.convert("P", palette=PIL.Image.ADAPTIVE)
+        else:
+            lut = PIL.Image.new("P", (1, 1))
+            lut.putpalette([int(_x) for colour in palette for _x in colour[:3]])
+            palette_img = image.quantize(palette=lut, dither=PIL.Image.NONE)
+
+        kwargs = {}
+        if transparent:
+            # Find the index of the background colour in the palette.
+            facecolor_rgb = [int(_x * 255) for _x in matplotlib.colors.to_rgb(facecolor)]
+            colours = palette_img.getpalette()
+            indices = [_i for _i in range(len(colours) // 3) if colours[3 * _i:3 * _i + 3] == facecolor_rgb]
+            used = set(_x for _, _x in palette_img.getcolors(256))
+            indices = [_i for _i in indices if _i in used] or indices
+            if indices:
+                kwargs["transparency"] = indices[0]
+            logging.debug("saving figure as transparent PNG with transparency index %s.", kwargs.get("transparency"))
+        else:
+            logging.debug("saving figure as non-transparent PNG.")
+        output = io.BytesIO()
+        palette_img.save(output, format="PNG", compress_level=compress_level, **kwargs)
+        return output.getvalue()
+
+
+def slice_png(image, columns, rows, compress_level=6):
+    """
+    Slices a PNG image into <columns> x <rows> tiles of equal size.
+
+    Palette and transparent colour of the image are kept, so that the tiles
+    show the same colours as the image.
+
+    Args:
+        image: PNG image as bytes
+        columns: number of tiles in x direction
+        rows: number of tiles in y direction
+        compress_level (optional): zlib compression level (0..9)
+
+    Returns:
+        dictionary of the tiles as PNG images by (column, row)
+    """
+    with metrics.phase("slice"):
+        image = PIL.Image.open(io.BytesIO(image))
+        width, height = image.size[0] // columns, image.size[1] // rows
+        kwargs = {}
+        if "transparency" in image.info:
+            kwargs["transparency"] = image.info["transparency"]
+        tiles = {}
+        for row in range(rows):
+            for column in range(columns):
+                tile = image.crop((column * width, row * height, (column + 1) * width, (row + 1) * height))
+                output = io.BytesIO()
+                tile.save(output, format="PNG", compress_level=compress_level, **kwargs)
+                tiles[(column, row)] = output.getvalue()
+        return tiles
+
+
+def encode_animation(frames, return_format, names=None, duration=500):
+    """
+    Combines PNG images into an animation.
+
+    Args:
+        frames: list of PNG images as bytes
+        return_format: "image/gif" or "image/apng" for an animated GIF or PNG
+            image, or "application/zip" for a zip archive of the PNG images
+        names (optional): file names of the images in the zip archive
+        duration (optional): display duration of each image in milliseconds
+
+    Returns:
+        the animation as bytes
+    """
+    with metrics.phase("encode"):
+        output = io.BytesIO()
+        if return_format == "application/zip":
+            names = names or [f"frame{_i:04d}.png" for _i in range(len(frames))]
+            # PNG images are compressed already.
+            with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+                for name, frame in zip(names, frames):
+                    archive.writestr(name, frame)
+            return output.getvalue()
+
+        images = [PIL.Image.open(io.BytesIO(_x)) for _x in frames]
+        if any("transparency" in _x.info for _x in images):
+            # The transparent colour differs between the palettes of the frames.
+            images = [_x.convert("RGBA") for _x in images]
+        if return_format == "image/gif":
+            # Each frame replaces the previous one, also where transparent.
+            images[0].save(output, format="GIF", save_all=True, append_images=images[1:], duration=duration,
+                           loop=0, disposal=2)
+        elif return_format == "image/apng":
+            images[0].save(output, format="PNG", save_all=True, append_images=images[1:], duration=duration,
+                           loop=0, default_image=False)
+        else:
+            raise ValueError(f"unsupported animation format '{return_format}'")
+        return output.getvalue()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+
+    mslib.mswms.watcher
+    ~~~~~~~~~~~~~~~~~~~
+
+    Watching of data directories for new, modified and removed files.
+
+    This file is part of mss.
+
+    :copyright: Copyright 2020 by the mss team, see AUTHORS.
+    :license: APACHE-2.0, see LICENSE for details.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import traceback
+
+# see inotify(7)
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF
+_IN_EVENT = struct.Struct("iIII")
+
+
+def _inotify_open(path):
+    """Returns an inotify file descriptor watching the directory <path>, or
+       None if inotify is not available.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    except (OSError, AttributeError) as ex:
+        logging.info("inotify is not available: %s %s", type(ex), ex)
+        return None
+    if fd < 0:
+        logging.info("inotify is not available: %s", os.strerror(ctypes.get_errno()))
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), _IN_MASK) < 0:
+        logging.info("Cannot watch '%s' with inotify: %s", path, os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+
+class DirectoryWatcher(object):
+    """Watches a directory for files that have been written, moved in, or
+       removed, and passes their names to <callback>(modified, removed).
+
+    On Linux, inotify is used. Otherwise, or if inotify is not available, the
+    directory is polled every <interval> seconds and files are reported as
+    modified once their size and modification time did not change for one
+    interval. Events are collected until none arrived for <latency> seconds,
+    so that files written at the same time are reported together. If events
+    were lost, the callback receives None for both arguments and the whole
+    directory has to be examined again.
+    """
+
+    def __init__(self, path, callback, interval=5, latency=0.5, use_inotify=True):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.latency = latency
+        self._fd = _inotify_open(path) if use_inotify else None
+        self._snapshot = self._scan() if self._fd is None else None
+        self._unsettled = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"watch {self.path}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._fd is not None:
+                    modified, removed = self._wait_inotify()
+                else:
+                    modified, removed = self._poll()
+            except OSError as ex:
+                logging.error("Could not watch '%s': %s %s", self.path, type(ex), ex)
+                self._stopped.wait(self.interval)
+                continue
+            if modified is None or modified or removed:
+                try:
+                    if modified is None:
+                        self.callback(None, None)
+                    else:
+                        self.callback(sorted(modified), sorted(removed))
+                except Exception as ex:
+                    logging.error("Could not process changes of '%s': %s %s\n%s",
+                                  self.path, type(ex), ex, traceback.format_exc())
+
+    def _wait_inotify(self):
+        modified, removed = set(), set()
+        timeout = self.interval
+        while not self._stopped.is_set() and select.select([self._fd], [], [], timeout)[0]:
+            # after the first event, wait for the directory to become quiet
+            timeout = self.latency
+            for mask, name in self._read_inotify():
+                if mask & _IN_Q_OVERFLOW:
+                    logging.warning("Lost events while watching '%s'", self.path)
+                    return None, None
+                if mask & (_IN_IGNORED | _IN_DELETE_SELF | _IN_MOVE_SELF):
+                    logging.warning("Directory '%s' is gone, polling instead", self.path)
+                    os.close(self._fd)
+                    self._fd = None
+                    self._snapshot = {}
+                    return None, None
+                if mask & _IN_ISDIR or not name:
+                    continue
+                if mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                    modified.add(name)
+                    removed.discard(name)
+                elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    removed.add(name)
+                    modified.discard(name)
+        return modified, removed
+
+    def _read_inotify(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _IN_EVENT.size <= len(data):
+            _, mask, _, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            events.append((mask, os.fsdecode(data[offset:offset + length].rstrip(b"\0"))))
+            offset += length
+        return events
+
+    def _scan(self):
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return {}
+        snapshot = {}
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_mtime, stat.st_size)
+            except FileNotFoundError:
+                pass
+        return snapshot
+
+    def _poll(self):
+        if self._stopped.wait(self.interval):
+            return set(), set()
+        snapshot = self._scan()
+        changed = {_x for _x in snapshot if snapshot[_x] != self._snapshot.get(_x)}
+        modified = {_x for _x in self._unsettled if _x in snapshot and _x not in changed}
+        removed = {_x for _x in self._snapshot if _x not in snapshot}
+        self._snapshot = snapshot
+        self._unsettled = changed
+        return modified, removed
@@ -45,16 +45,28 @@ from future import standard_library
 
 standard_library.install_aliases()
 
+import concurrent.futures
+import copy
+import datetime
+import functools
+import hashlib
+import json
 import os
 import logging
+import multiprocessing
+import re
+import threading
+import time
 import traceback
 import urllib.parse
+import numpy as np
 from chameleon import PageTemplateLoader
 from owslib.crs import axisorder_yx
 
-from flask import request, make_response, redirect
+from flask import abort, request, make_response, redirect
 from flask_httpauth import HTTPBasicAuth
 from multidict import CIMultiDict
+from werkzeug.http import http_date, quote_etag
 from mslib.utils import conditional_decorator
 from mslib.utils import parse_iso_datetime
 from mslib.index import app_loader
@@ -108,7 +120,6 @@ except ImportError as ex:
 if mss_wms_settings.__dict__.get('enable_basic_http_authentication', False):
     logging.debug("Enabling basic HTTP authentication. Username and "
                   "password required to access the service.")
-    import hashlib
 
     def authfunc(username, password):
         for u, p in mss_wms_auth.allowed_users:
@@ -124,9 +135,18 @@ if mss_wms_settings.__dict__.get('enable_basic_http_authentication', False):
             password = auth.password
         return authfunc(username, password)
 
-from mslib.mswms import mss_plot_driver
+from mslib.mswms import metrics, mss_plot_driver, tiles
+from mslib.mswms.cache import DatasetPool, FieldCache, ImageCache, SectionCache, SingleFlight
+from mslib.mswms.utils import encode_animation, slice_png
+from mslib.mswms.watcher import DirectoryWatcher
 from mslib.utils import get_projection_params
 
+# Data formats of GetVSec requests in addition to image/png and text/xml.
+VSEC_DATA_FORMATS = ["application/x-netcdf", "application/x-npz", "application/json"]
+
+# Formats of GetMap requests for several valid times.
+ANIMATION_FORMATS = ["image/gif", "image/apng", "application/zip"]
+
 # Logging the Standard Output, which will be added to the Apache Log Files
 logging.basicConfig(level=logging.DEBUG,
                     format="%(asctime)s %(funcName)19s || %(message)s",
@@ -138,6 +158,64 @@ xml_template_location = os.path.join(base_dir, "xml_templates")
 templates = PageTemplateLoader(mss_wms_settings.__dict__.get("xml_template_location", xml_template_location))
 
 
+class ServiceException(Exception):
+    """Raised for invalid requests, reported to the client as WMS service
+       exception.
+    """
+
+    def __init__(self, text, code=None):
+        super(ServiceException, self).__init__(text)
+        self.text = text
+        self.code = code
+
+
+def _parse_period(value):
+    """Returns the ISO 8601 duration <value>, e.g. "PT6H" or "P1D", as
+       timedelta.
+    """
+    match = re.match(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$", value)
+    if match is None or not any(match.groups()):
+        raise ValueError(f"invalid period '{value}'")
+    days, hours, minutes, seconds = [int(_x) if _x else 0 for _x in match.groups()]
+    return datetime.timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+
+def _parse_time(value):
+    """Returns the TIME parameter <value> as tuple (valid_times, time_range),
+       with a list "time1,time2,..." of valid times given as <valid_times>
+       and a range "start/end[/period]" as <time_range> (start, end, period).
+    """
+    valid_times, time_range = None, None
+    if value is not None:
+        try:
+            if "/" in value:
+                values = value.split("/")
+                if len(values) not in (2, 3):
+                    raise ValueError(f"invalid TIME range '{value}'")
+                time_range = (parse_iso_datetime(values[0]), parse_iso_datetime(values[1]),
+                              _parse_period(values[2]) if len(values) == 3 else None)
+            else:
+                valid_times = [parse_iso_datetime(_x) for _x in value.split(",")]
+        except ValueError:
+            raise ServiceException(
+                code="InvalidDimensionValue",
+                text="TIME has wrong format (needs to be 2005-08-29T13:00:00Z)")
+    return valid_times, time_range
+
+
+def _canonicalise(value):
+    """Returns a hashable representation of a request parameter that does not
+       depend on the number formatting of the request.
+    """
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonicalise(_x) for _x in value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
 class WMSServer(object):
 
     def __init__(self):
@@ -146,18 +224,40 @@ class WMSServer(object):
         """
         data_access_dict = mss_wms_settings.data
 
+        self._data_state = self._get_data_state()
         for key in data_access_dict:
             data_access_dict[key].setup()
 
+        # Open datasets are shared by the drivers of each data set.
+        self.dataset_pools = {}
+        for key in data_access_dict:
+            self.dataset_pools[key] = DatasetPool(
+                max_open_files=mss_wms_settings.__dict__.get("dataset_pool_max_open_files", 64))
+
+        # Loaded data fields are likewise shared by the drivers of each data set.
+        self.field_caches = {}
+        field_cache_max_bytes = mss_wms_settings.__dict__.get("field_cache_max_bytes", 256 * 1024 ** 2)
+        for key in data_access_dict:
+            self.field_caches[key] = FieldCache(field_cache_max_bytes) if field_cache_max_bytes else None
+
+        # Fields much finer resolved than the requested maps are block-averaged.
+        points_per_pixel = mss_wms_settings.__dict__.get("getmap_points_per_pixel", 1)
         self.hsec_drivers = {}
         for key in data_access_dict:
             self.hsec_drivers[key] = mss_plot_driver.HorizontalSectionDriver(
-                data_access_dict[key])
+                data_access_dict[key], dataset_pool=self.dataset_pools[key], field_cache=self.field_caches[key],
+                points_per_pixel=points_per_pixel)
+
+        # Path points and interpolation stencils are identified by the grid
+        # and may thus be shared by all vertical section drivers.
+        section_cache_max_bytes = mss_wms_settings.__dict__.get("section_cache_max_bytes", 16 * 1024 ** 2)
+        self.section_cache = SectionCache(section_cache_max_bytes) if section_cache_max_bytes else None
 
         self.vsec_drivers = {}
         for key in data_access_dict:
             self.vsec_drivers[key] = mss_plot_driver.VerticalSectionDriver(
-                data_access_dict[key])
+                data_access_dict[key], dataset_pool=self.dataset_pools[key], field_cache=self.field_caches[key],
+                section_cache=self.section_cache)
 
         self.hsec_layer_registry = {}
         for layer, datasets in mss_wms_settings.register_horizontal_layers:
@@ -167,6 +267,60 @@ class WMSServer(object):
         for layer, datasets in mss_wms_settings.register_vertical_layers:
             self.register_vsec_layer(datasets, layer)
 
+        self.image_cache = None
+        if mss_wms_settings.__dict__.get("image_cache_use", False):
+            self.image_cache = ImageCache(
+                max_bytes=mss_wms_settings.__dict__.get("image_cache_max_bytes", 100 * 1024 ** 2),
+                directory=mss_wms_settings.__dict__.get("image_cache_directory", None),
+                max_disk_bytes=mss_wms_settings.__dict__.get("image_cache_max_disk_bytes", 1024 ** 3))
+
+        # Tiles are rendered in metatiles of metatile_size x metatile_size
+        # tiles and kept in the image cache, or in a cache of their own if
+        # images are not cached.
+        self.metatile_size = mss_wms_settings.__dict__.get("metatile_size", 4)
+        self.tile_cache = self.image_cache
+        if self.tile_cache is None:
+            self.tile_cache = ImageCache(
+                max_bytes=mss_wms_settings.__dict__.get("tile_cache_max_bytes", 64 * 1024 ** 2))
+
+        # Concurrent requests for the same image wait for a single rendering.
+        self.single_flight = None
+        if mss_wms_settings.__dict__.get("coalesce_requests", True):
+            self.single_flight = SingleFlight(timeout=mss_wms_settings.__dict__.get("coalesce_timeout", 60))
+
+        # Capabilities documents are cached per (version, server url) until
+        # the data changes, which increments the update sequence.
+        self.update_sequence = 0
+        self.capabilities_cache = {}
+        self._refresh_lock = threading.Lock()
+        self.refresh_thread = None
+        refresh_interval = mss_wms_settings.__dict__.get("capabilities_refresh_interval", 60)
+        if refresh_interval:
+            self.refresh_thread = threading.Thread(
+                target=self._refresh_periodically, args=(refresh_interval,), name="refresh_data", daemon=True)
+            self.refresh_thread.start()
+
+        # Optionally, new and removed data files are picked up individually as
+        # soon as they appear, by watching the data directories.
+        self.data_watchers = []
+        if mss_wms_settings.__dict__.get("data_watch", False):
+            datapaths = {}
+            for key, data_access in data_access_dict.items():
+                datapaths.setdefault(data_access.get_datapath(), []).append(key)
+            for datapath, keys in datapaths.items():
+                watcher = DirectoryWatcher(
+                    datapath, functools.partial(self.update_files, keys),
+                    interval=mss_wms_settings.__dict__.get("data_watch_interval", 5))
+                watcher.start()
+                self.data_watchers.append(watcher)
+
+        # Optionally, images are rendered by a pool of worker processes, each
+        # holding its own server.
+        self.render_pool = None
+        self.render_processes = mss_wms_settings.__dict__.get("render_processes", 0)
+        if self.render_processes > 0:
+            self.render_pool = _create_render_pool(self.render_processes)
+
     def register_hsec_layer(self, datasets, layer_class):
         """Register horizontal section layer in internal dict of layers.
 
@@ -234,29 +388,109 @@ class WMSServer(object):
         template = templates['service_exception.pt' if version == "1.1.1" else "service_exception130.pt"]
         return template(code=code, text=text).encode("utf-8"), "text/xml"
 
-    def get_capabilities(self, query, server_url=None):
-        # ToDo find a more elegant method to do the same
-        # Preferable we don't want a seperate data_access module to be configured
-        data_access_dict = mss_wms_settings.data
+    def _get_data_state(self):
+        """Returns the state of the data directories of all data sets (see
+           NWPDataAccess.get_data_state).
+        """
+        state = {}
+        for key, data_access in mss_wms_settings.data.items():
+            try:
+                state[key] = data_access.get_data_state()
+            except OSError as ex:
+                logging.error("Could not scan data directory of '%s': %s %s", key, type(ex), ex)
+                state[key] = None
+        return state
 
-        for key in data_access_dict:
-            data_access_dict[key].setup()
+    def refresh_data(self):
+        """Sets up the data sets again whose data directory has changed and
+           invalidates the cached capabilities documents.
+
+        Returns True if any data set has changed.
+        """
+        with self._refresh_lock:
+            state = self._get_data_state()
+            changed = [_x for _x in state if state[_x] != self._data_state.get(_x)]
+            if not changed:
+                return False
+            for key in changed:
+                logging.info("data of '%s' has changed, setting up again", key)
+                # Set up a copy, so that concurrent requests continue to use
+                # the complete old state until the new one is available.
+                data_access = mss_wms_settings.data[key]
+                updated = copy.copy(data_access)
+                updated.setup()
+                data_access.__dict__.update(updated.__dict__)
+            self._data_state = state
+            self.capabilities_cache = {}
+            self.update_sequence += 1
+            return True
+
+    def update_files(self, keys, modified, removed):
+        """Updates the data sets <keys> for single <modified> and <removed>
+           files, as reported by a DirectoryWatcher, and invalidates the cached
+           capabilities documents.
+
+        Returns True if any data set has changed.
+        """
+        with self._refresh_lock:
+            changed = False
+            for key in keys:
+                data_access = mss_wms_settings.data[key]
+                if modified is None:
+                    logging.info("data of '%s' may have changed, setting up again", key)
+                    updated = copy.copy(data_access)
+                    updated.setup()
+                    data_access.__dict__.update(updated.__dict__)
+                    changed = True
+                elif data_access.update_files(modified, removed):
+                    changed = True
+                else:
+                    continue
+                try:
+                    self._data_state[key] = data_access.get_data_state()
+                except OSError as ex:
+                    logging.error("Could not scan data directory of '%s': %s %s", key, type(ex), ex)
+                    self._data_state[key] = None
+            if changed:
+                self.capabilities_cache = {}
+                self.update_sequence += 1
+            return changed
+
+    def _refresh_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh_data()
+            except Exception as ex:
+                logging.error("Could not refresh data: %s %s\n%s", type(ex), ex, traceback.format_exc())
+
+    def get_capabilities(self, query, server_url=None):
+        # Without background refresh, the data directories are checked now.
+        if self.refresh_thread is None:
+            self.refresh_data()
 
         version = query.get("VERSION", "1.1.1")
+        update_sequence = self.update_sequence
+        capabilities_cache = self.capabilities_cache
 
         # Handle update sequence exceptions
         sequence = query.get("UPDATESEQUENCE")
-        if sequence and int(sequence) == 0:
+        if sequence and int(sequence) == update_sequence:
             return self.create_service_exception(
                 code="CurrentUpdateSequence",
                 text="Requested update sequence is the current",
                 version=version)
-        elif sequence and int(sequence) > 0:
+        elif sequence and int(sequence) > update_sequence:
             return self.create_service_exception(
                 code="InvalidUpdateSequence",
                 text="Requested update sequence is higher than current",
                 version=version)
 
+        key = (version, server_url)
+        if key in capabilities_cache:
+            logging.debug("Using cached capabilities for '%s'", key)
+            return capabilities_cache[key], "text/xml"
+
         template = templates['get_capabilities130.pt' if version == "1.3.0" else 'get_capabilities.pt']
         logging.debug("server-url '%s'", server_url)
 
@@ -286,6 +520,7 @@ class WMSServer(object):
 
         settings = mss_wms_settings.__dict__
         return_data = template(hsec_layers=hsec_layers, vsec_layers=vsec_layers, server_url=server_url,
+                               update_sequence=update_sequence,
                                service_name=settings.get("service_name", "OGC:WMS"),
                                service_title=settings.get("service_title", "Mission Support System Web Map Service"),
                                service_abstract=settings.get("service_abstract", ""),
@@ -302,17 +537,17 @@ class WMSServer(object):
                                service_fees=settings.get("service_fees", ""),
                                service_access_constraints=settings.get(
                                    "service_access_constraints",
-                                   "This service is intended for research purposes only."))
-        return return_data.encode("utf-8"), "text/xml"
+                                   "This service is intended for research purposes only.")).encode("utf-8")
+        capabilities_cache[key] = return_data
+        return return_data, "text/xml"
 
-    def produce_plot(self, query, mode):
-        """
-        Handler for a GetMap and GetVSec requests. Produces a plot with
-        the parameters specified in the URL.
+    def parse_plot_query(self, query, mode):
+        """Interprets the parameters of a GetMap or GetVSec request.
 
-        # TODO: Handle multiple layers. (mr, 2010-06-09)
-        # TODO: Cache the produced images: Check whether an image with the given
-        #      parameters has already been produced. (mr, 2010-08-18)
+        Returns a tuple (mode, dataset, layer, params), with params being the
+        keyword arguments for the set_plot_parameters() method of the
+        corresponding section driver. Raises a ServiceException for invalid
+        requests.
         """
         logging.debug("GetMap/GetVSec request. Interpreting parameters..")
 
@@ -327,7 +562,8 @@ class WMSServer(object):
         figsize = float(width if width != "" else 900), float(height if height != "" else 600)
         logging.debug("  requested image size = %sx%s", figsize[0], figsize[1])
 
-        # Requested layers.
+        # Requested layers. GetMap requests draw all layers onto one map in
+        # the given order.
         layers = [layer for layer in query.get('LAYERS', '').strip().split(',') if layer]
         layer = layers[0] if len(layers) > 0 else ''
         if layer.find(".") > 0:
@@ -336,8 +572,9 @@ class WMSServer(object):
             dataset = None
         logging.debug("  requested dataset = '%s', layer = '%s'", dataset, layer)
 
-        # Requested style(s).
-        styles = [style for style in query.get('STYLES', 'default').strip().split(',') if style]
+        # Requested style(s), one for each layer. Empty entries denote the
+        # default style.
+        styles = [style if style else None for style in query.get('STYLES', 'default').strip().split(',')]
         style = styles[0] if len(styles) > 0 else None
         logging.debug("  requested style = '%s'", style)
 
@@ -347,22 +584,15 @@ class WMSServer(object):
             try:
                 init_time = parse_iso_datetime(init_time)
             except ValueError:
-                return self.create_service_exception(
+                raise ServiceException(
                     code="InvalidDimensionValue",
-                    text="DIM_INIT_TIME has wrong format (needs to be 2005-08-29T13:00:00Z)",
-                    version=version)
+                    text="DIM_INIT_TIME has wrong format (needs to be 2005-08-29T13:00:00Z)")
         logging.debug("  requested initialisation time = '%s'", init_time)
 
-        # Forecast valid time.
-        valid_time = query.get('TIME')
-        if valid_time is not None:
-            try:
-                valid_time = parse_iso_datetime(valid_time)
-            except ValueError:
-                return self.create_service_exception(
-                    code="InvalidDimensionValue",
-                    text="TIME has wrong format (needs to be 2005-08-29T13:00:00Z)",
-                    version=version)
+        # Forecast valid time. Animations may be requested for a list
+        # "time1,time2,..." or a range "start/end[/period]" of valid times.
+        valid_times, time_range = _parse_time(query.get('TIME'))
+        valid_time = time_range[0] if time_range is not None else valid_times[0] if valid_times else None
         logging.debug("  requested (valid) time = '%s'", valid_time)
 
         # Coordinate reference system.
@@ -370,15 +600,13 @@ class WMSServer(object):
         is_yx = version == "1.3.0" and crs.startswith("epsg") and int(crs[5:]) in axisorder_yx
 
         # Allow to request vertical sections via GetMap, if the specified CRS is of type "VERT:??".
-        msg = None
         if crs.startswith('vert:logp'):
             mode = "getvsec"
         else:
             try:
                 get_projection_params(crs)
             except ValueError:
-                return self.create_service_exception(
-                    code="InvalidSRS", text=f"The requested CRS '{crs}' is not supported.", version=version)
+                raise ServiceException(code="InvalidSRS", text=f"The requested CRS '{crs}' is not supported.")
         logging.debug("  requested coordinate reference system = '%s'", crs)
 
         # Create a frameless figure (WMS) or one with title and legend
@@ -393,41 +621,42 @@ class WMSServer(object):
         # Return format (image/png, text/xml, etc.).
         return_format = query.get('FORMAT', 'image/png').lower()
         logging.debug("  requested return format = '%s'", return_format)
-        if return_format not in ["image/png", "text/xml"]:
-            return self.create_service_exception(
-                code="InvalidFORMAT",
-                text=f"unsupported FORMAT: '{return_format}'",
-                version=version)
-
-        # 3) Check GetMap/GetVSec-specific parameters and produce
-        #    the image with the corresponding section driver.
-        # =======================================================
+        # Vertical sections may also be returned as data in binary formats,
+        # maps of several valid times as animation.
+        if return_format not in ["image/png", "text/xml"] and not (
+                mode == "getvsec" and return_format in VSEC_DATA_FORMATS) and not (
+                mode == "getmap" and return_format in ANIMATION_FORMATS):
+            raise ServiceException(code="InvalidFORMAT", text=f"unsupported FORMAT: '{return_format}'")
+        if return_format not in ANIMATION_FORMATS and (time_range is not None or len(valid_times or []) > 1):
+            raise ServiceException(
+                code="InvalidDimensionValue",
+                text=f"Several TIME values require an animation FORMAT ({', '.join(ANIMATION_FORMATS)})")
+
+        # 3) Check GetMap/GetVSec-specific parameters.
+        # ============================================
         if mode == "getmap":
-            # Check requested layer.
-            if (dataset not in self.hsec_layer_registry) or (layer not in self.hsec_layer_registry[dataset]):
-                return self.create_service_exception(
-                    code="LayerNotDefined",
-                    text=f"Invalid LAYER '{dataset}.{layer}' requested",
-                    version=version)
-
-            # Check if the layer requires time information and if they are given.
-            if self.hsec_layer_registry[dataset][layer].uses_inittime_dimension() and init_time is None:
-                return self.create_service_exception(
-                    code="MissingDimensionValue",
-                    text="INIT_TIME not specified (use the DIM_INIT_TIME keyword)",
-                    version=version)
-            if self.hsec_layer_registry[dataset][layer].uses_validtime_dimension() and valid_time is None:
-                return self.create_service_exception(
-                    code="MissingDimensionValue",
-                    text="TIME not specified",
-                    version=version)
-
-            # Check if the requested coordinate system is supported.
-            if not self.hsec_layer_registry[dataset][layer].support_epsg_code(crs):
-                return self.create_service_exception(
-                    code="InvalidSRS",
-                    text=f"The requested CRS '{crs}' is not supported.",
-                    version=version)
+            # Check requested layers. Layers drawn onto one map have to be of
+            # the same dataset.
+            overlays = []
+            for index, name in enumerate(layers[1:], start=1):
+                if not name.startswith(f"{dataset}."):
+                    raise ServiceException(
+                        code="LayerNotDefined", text=f"Layer '{name}' is not of dataset '{dataset}'")
+                overlays.append((name[len(dataset) + 1:], styles[index] if index < len(styles) else None))
+            for name in [layer] + [_x[0] for _x in overlays]:
+                if (dataset not in self.hsec_layer_registry) or (name not in self.hsec_layer_registry[dataset]):
+                    raise ServiceException(code="LayerNotDefined", text=f"Invalid LAYER '{dataset}.{name}' requested")
+
+                # Check if the layer requires time information and if they are given.
+                if self.hsec_layer_registry[dataset][name].uses_inittime_dimension() and init_time is None:
+                    raise ServiceException(
+                        code="MissingDimensionValue", text="INIT_TIME not specified (use the DIM_INIT_TIME keyword)")
+                if self.hsec_layer_registry[dataset][name].uses_validtime_dimension() and valid_time is None:
+                    raise ServiceException(code="MissingDimensionValue", text="TIME not specified")
+
+                # Check if the requested coordinate system is supported.
+                if not self.hsec_layer_registry[dataset][name].support_epsg_code(crs):
+                    raise ServiceException(code="InvalidSRS", text=f"The requested CRS '{crs}' is not supported.")
 
             # Bounding box.
             try:
@@ -438,100 +667,531 @@ class WMSServer(object):
                     bbox = [float(v) for v in query.get('BBOX', '-180,-90,180,90').split(',')]
 
             except ValueError:
-                return self.create_service_exception(text=f"Invalid BBOX: {query.get('BBOX')}", version=version)
+                raise ServiceException(text=f"Invalid BBOX: {query.get('BBOX')}")
 
-            # Vertical level, if applicable.
+            # Vertical level, if applicable. Surface layers drawn together
+            # with layers of other level types ignore the level.
             level = query.get('ELEVATION')
             level = float(level) if level is not None else None
-            layer_datatypes = self.hsec_layer_registry[dataset][layer].required_datatypes()
+            layer_datatypes = set()
+            for name in [layer] + [_x[0] for _x in overlays]:
+                layer_datatypes.update(self.hsec_layer_registry[dataset][name].required_datatypes())
             if any(_x in layer_datatypes for _x in ["pl", "al", "ml", "tl", "pv"]) and level is None:
                 # Use the default value.
                 level = -1
             elif ("sfc" in layer_datatypes) and \
                     all(_x not in layer_datatypes for _x in ["pl", "al", "ml", "tl", "pv"]) and \
                     level is not None:
-                return self.create_service_exception(
-                    text=f"ELEVATION argument not applicable for layer '{layer}'. Please omit this argument.",
-                    version=version)
-
-            plot_driver = self.hsec_drivers[dataset]
-            try:
-                plot_driver.set_plot_parameters(self.hsec_layer_registry[dataset][layer], bbox=bbox, level=level,
-                                                crs=crs, init_time=init_time, valid_time=valid_time, style=style,
-                                                figsize=figsize, noframe=noframe, transparent=transparent,
-                                                return_format=return_format)
-                image = plot_driver.plot()
-            except (IOError, ValueError) as ex:
-                logging.error("ERROR: %s %s", type(ex), ex)
-                logging.debug("%s", traceback.format_exc())
-                msg = "The data corresponding to your request is not available. Please check the " \
-                      "times and/or levels you have specified.\n\n" \
-                      f"Error message: '{ex}'"
-                return self.create_service_exception(text=msg, version=version)
+                raise ServiceException(
+                    text=f"ELEVATION argument not applicable for layer '{layer}'. Please omit this argument.")
+
+            params = dict(bbox=bbox, level=level, crs=crs, init_time=init_time, valid_time=valid_time, style=style,
+                          figsize=figsize, noframe=noframe, transparent=transparent, return_format=return_format)
+            if overlays:
+                params["overlays"] = tuple(overlays)
+
+            # Valid times of the frames of an animation.
+            if return_format in ANIMATION_FORMATS:
+                if time_range is not None:
+                    valid_times = self._get_valid_times(
+                        dataset, [layer] + [_x[0] for _x in overlays], init_time, *time_range)
+                if not valid_times:
+                    raise ServiceException(
+                        code="InvalidDimensionValue", text="No valid times available in the requested TIME range")
+                max_frames = mss_wms_settings.__dict__.get("animation_max_frames", 48)
+                if len(valid_times) > max_frames:
+                    raise ServiceException(
+                        code="InvalidDimensionValue", text=f"Animations are limited to {max_frames} valid times")
+                params.update(valid_time=valid_times[0], valid_times=tuple(valid_times))
 
         elif mode == "getvsec":
             # Vertical secton path.
             path = query.get("PATH")
             if path is None:
-                return self.create_service_exception(text="PATH not specified", version=version)
+                raise ServiceException(text="PATH not specified")
             try:
                 path = [float(v) for v in path.split(',')]
                 path = [[lat, lon] for lat, lon in zip(path[0::2], path[1::2])]
             except ValueError:
-                return self.create_service_exception(text=f"Invalid PATH: {path}", version=version)
+                raise ServiceException(text=f"Invalid PATH: {path}")
             logging.debug("VSEC PATH: %s", path)
 
             # Check requested layers.
             if (dataset not in self.vsec_layer_registry) or (layer not in self.vsec_layer_registry[dataset]):
-                return self.create_service_exception(
-                    code="LayerNotDefined",
-                    text=f"Invalid LAYER '{dataset}.{layer}' requested",
-                    version=version)
+                raise ServiceException(code="LayerNotDefined", text=f"Invalid LAYER '{dataset}.{layer}' requested")
 
             # Check if the layer requires time information and if they are given.
             if self.vsec_layer_registry[dataset][layer].uses_inittime_dimension():
                 if init_time is None:
-                    return self.create_service_exception(
-                        code="MissingDimensionValue",
-                        text="INIT_TIME not specified (use the DIM_INIT_TIME keyword)",
-                        version=version)
+                    raise ServiceException(
+                        code="MissingDimensionValue", text="INIT_TIME not specified (use the DIM_INIT_TIME keyword)")
                 if valid_time is None:
-                    return self.create_service_exception(code="MissingDimensionValue",
-                                                         text="TIME not specified",
-                                                         version=version)
+                    raise ServiceException(code="MissingDimensionValue", text="TIME not specified")
 
             # Bounding box (num interp. points, p_bot, num labels, p_top).
             try:
                 bbox = [float(v) for v in query.get("BBOX", "101,1050,10,180").split(",")]
             except ValueError:
-                return self.create_service_exception(text=f"Invalid BBOX: {query.get('BBOX')}", version=version)
+                raise ServiceException(text=f"Invalid BBOX: {query.get('BBOX')}")
+
+            params = dict(vsec_path=path, vsec_numpoints=bbox[0], vsec_path_connection="greatcircle",
+                          vsec_numlabels=bbox[2], init_time=init_time, valid_time=valid_time, style=style,
+                          bbox=bbox, figsize=figsize, noframe=noframe, transparent=transparent,
+                          return_format=return_format)
+        else:
+            raise ServiceException(text=f"Request type '{mode}' is not valid.")
+
+        return mode, dataset, layer, params
+
+    def _get_valid_times(self, dataset, layers, init_time, start, end, period=None, mode="getmap"):
+        """Returns the valid times between <start> and <end> available for
+           all map <layers> (vertical section layers for mode "getvsec"), only
+           every <period> from <start> if given.
+        """
+        registry = self.hsec_layer_registry if mode == "getmap" else self.vsec_layer_registry
+        valid_times = None
+        for name in layers:
+            plot_object = registry[dataset][name]
+            for vartype, var, _ in plot_object.required_datafields:
+                times = set(plot_object.driver.get_valid_times(var, vartype, init_time))
+                valid_times = times if valid_times is None else valid_times & times
+        valid_times = [_x for _x in sorted(valid_times or []) if start <= _x <= end]
+        if period is not None:
+            valid_times = [_x for _x in valid_times if (_x - start) % period == datetime.timedelta(0)]
+        return valid_times
+
+    def get_plot_key(self, mode, dataset, layer, params):
+        """Returns a canonical key identifying the image produced for the given
+           request parameters together with the modification time of the data
+           files it depends on.
+
+        The key changes whenever one of the underlying data files is modified
+        and is thus suitable for caching and as ETag. (None, None) is returned
+        if the data files cannot be determined.
+        """
+        if mode == "getmap":
+            plot_objects = [self.hsec_layer_registry[dataset][_x] for _x in
+                            [layer] + [_y[0] for _y in params.get("overlays", [])]]
+        else:
+            plot_objects = [self.vsec_layer_registry[dataset][layer]]
+        data_access = plot_objects[0].driver.data_access
+        try:
+            filenames = set(
+                data_access.get_filename(var, vartype, params["init_time"], valid_time, fullpath=True)
+                for valid_time in params.get("valid_times", [params["valid_time"]])
+                for plot_object in plot_objects for vartype, var, _ in plot_object.required_datafields)
+            mtimes = sorted((_x, os.path.getmtime(_x)) for _x in filenames)
+        except (IOError, OSError, ValueError) as ex:
+            logging.debug("Could not determine data files: %s %s", type(ex), ex)
+            return None, None
+        canonical = (mode, dataset, layer, sorted((_x, _canonicalise(params[_x])) for _x in params), mtimes)
+        key = hashlib.sha1(repr(canonical).encode("utf-8")).hexdigest()
+        return key, max((_x[1] for _x in mtimes), default=None)
+
+    def render(self, mode, dataset, layer, params, tiles=None):
+        """Produces the image for the given request parameters (see
+           parse_plot_query). If <tiles> is given as (columns, rows), the
+           image is sliced into tiles (see slice_png). For animations, the
+           list of images of the valid times is returned.
+
+        Each call renders with its own driver and layer instance, so that
+        concurrent requests do not interfere. Open datasets are shared with
+        the registered drivers.
+        """
+        if mode == "getmap":
+            driver = self.hsec_drivers[dataset]
+            layer_object = self.hsec_layer_registry[dataset][layer]
+            kwargs = {"points_per_pixel": driver.points_per_pixel}
+        else:
+            driver = self.vsec_drivers[dataset]
+            layer_object = self.vsec_layer_registry[dataset][layer]
+            kwargs = {"section_cache": driver.section_cache}
+        plot_driver = type(driver)(
+            driver.data_access, dataset_pool=driver.dataset_pool, field_cache=driver.field_cache, **kwargs)
+        plot_object = type(layer_object)(driver=plot_driver)
+        if "overlays" in params:
+            registry = self.hsec_layer_registry[dataset]
+            params = dict(params, overlays=[
+                (type(registry[_x])(driver=plot_driver), _y) for _x, _y in params["overlays"]])
+        valid_times = params.get("valid_times")
+        params = {_x: params[_x] for _x in params if _x != "valid_times"}
+        try:
+            plot_driver.set_plot_parameters(plot_object, **params)
+            if valid_times is not None:
+                return plot_driver.plot_frames(valid_times)
+            image = plot_driver.plot()
+        finally:
+            plot_driver.release_dataset()
+        if tiles is not None:
+            image = slice_png(image, *tiles, compress_level=mss_wms_settings.__dict__.get("png_compress_level", 6))
+        return image
+
+    def produce_plot(self, query, mode, if_none_match=None):
+        """
+        Handler for a GetMap and GetVSec requests. Produces a plot with
+        the parameters specified in the URL.
+
+        Returns a tuple (image, return_format, headers). <image> is None if
+        the key of the requested image is contained in <if_none_match>, i.e.
+        the client already has a current copy.
 
-            plot_driver = self.vsec_drivers[dataset]
+        Identical requests arriving while the image is rendered receive the
+        same image (see SingleFlight).
+        """
+        version = query.get("VERSION", "1.1.1")
+        with metrics.collect() as request_metrics:
             try:
-                plot_driver.set_plot_parameters(plot_object=self.vsec_layer_registry[dataset][layer],
-                                                vsec_path=path,
-                                                vsec_numpoints=bbox[0],
-                                                vsec_path_connection="greatcircle",
-                                                vsec_numlabels=bbox[2],
-                                                init_time=init_time,
-                                                valid_time=valid_time,
-                                                style=style,
-                                                bbox=bbox,
-                                                figsize=figsize,
-                                                noframe=noframe,
-                                                transparent=transparent,
-                                                return_format=return_format)
-                image = plot_driver.plot()
+                with metrics.phase("parse"):
+                    mode, dataset, layer, params = self.parse_plot_query(query, mode)
+            except ServiceException as ex:
+                request_metrics.record(mode, "", "invalid")
+                return self.create_service_exception(code=ex.code, text=ex.text, version=version) + ({},)
+            layers = ",".join(f"{dataset}.{_x}" for _x in [layer] + [_y[0] for _y in params.get("overlays", [])])
+            status = "error"
+            try:
+                image, return_format, headers, status = self._produce_plot(
+                    mode, dataset, layer, params, if_none_match, request_metrics)
             except (IOError, ValueError) as ex:
                 logging.error("ERROR: %s %s", type(ex), ex)
+                logging.debug("%s", traceback.format_exc())
                 msg = "The data corresponding to your request is not available. Please check the " \
-                      "times and/or path you have specified.\n\n" \
-                      f"Error message: {ex}"
-                return self.create_service_exception(text=msg, version=version)
+                      f"times and/or {'levels' if mode == 'getmap' else 'path'} you have specified.\n\n" \
+                      f"Error message: '{ex}'"
+                return self.create_service_exception(text=msg, version=version) + ({},)
+            finally:
+                request_metrics.record(mode, layers, status)
 
         # 4) Return the produced image.
         # =============================
-        return image, return_format
+        return image, return_format, headers
+
+    def _produce_plot(self, mode, dataset, layer, params, if_none_match, request_metrics):
+        """Returns the image of a parsed request as tuple (image, return_format,
+           headers, status), with <status> telling how the image was obtained
+           for the metrics (see produce_plot).
+        """
+        return_format = params["return_format"]
+
+        key, last_modified = self.get_plot_key(mode, dataset, layer, params)
+        headers = {}
+        if key is not None:
+            headers["ETag"] = quote_etag(key)
+            if last_modified is not None:
+                headers["Last-Modified"] = http_date(last_modified)
+            if if_none_match is not None and key in if_none_match:
+                logging.debug("client copy of '%s' is current", key)
+                return None, return_format, headers, "not_modified"
+            if self.image_cache is not None:
+                entry = self.image_cache.get(key)
+                metrics.count_cache("image", entry is not None)
+                if entry is not None:
+                    logging.debug("Loaded '%s' from image cache", key)
+                    return entry[0], entry[1], headers, "cached"
+
+        rendered = []
+
+        def produce():
+            rendered.append(True)
+            if "valid_times" in params:
+                image = self._render_animation(dataset, layer, params, request_metrics)
+            elif self.render_pool is not None:
+                image, values = self.render_pool.submit(
+                    _render, mode, dataset, layer, params, data_state=self._data_state.get(dataset)).result()
+                request_metrics.update(values)
+            else:
+                image = self.render(mode, dataset, layer, params)
+            if isinstance(image, str):
+                image = image.encode("utf-8")
+            if key is not None and self.image_cache is not None:
+                self.image_cache.put(key, image, return_format, last_modified)
+            return image
+
+        if key is not None and self.single_flight is not None:
+            image = self.single_flight.do(key, produce)
+        else:
+            image = produce()
+        return image, return_format, headers, "ok" if rendered else "coalesced"
+
+    def _render_animation(self, dataset, layer, params, request_metrics):
+        """Renders the frames of an animated map and returns the animation.
+
+        With a render pool, each worker renders a consecutive part of the
+        valid times onto one figure.
+        """
+        valid_times = params["valid_times"]
+        if self.render_pool is None:
+            frames = self.render("getmap", dataset, layer, params)
+        else:
+            size = -(-len(valid_times) // self.render_processes)
+            futures = [self.render_pool.submit(
+                _render, "getmap", dataset, layer, dict(params, valid_time=part[0], valid_times=part),
+                data_state=self._data_state.get(dataset))
+                for part in [valid_times[_i:_i + size] for _i in range(0, len(valid_times), size)]]
+            frames = []
+            for future in futures:
+                part, values = future.result()
+                request_metrics.update(values)
+                frames.extend(part)
+        return encode_animation(
+            frames, params["return_format"], names=[f"{_x:%Y%m%dT%H%M%SZ}.png" for _x in valid_times],
+            duration=mss_wms_settings.__dict__.get("animation_frame_duration", 500))
+
+    def produce_tile(self, query, tile_matrix_set, zoom, column, row, if_none_match=None):
+        """
+        Handler for tile requests. Produces the tile <column>, <row> of zoom
+        level <zoom> of <tile_matrix_set> (see tiles.TILE_MATRIX_SETS) with
+        the GetMap parameters (LAYERS, STYLES, TIME, ...) given in <query>.
+
+        The tile is rendered together with its neighbours as one metatile,
+        whose tiles are all kept in the tile cache. Returns a tuple (image,
+        return_format, headers) as produce_plot().
+        """
+        with metrics.collect() as request_metrics:
+            try:
+                with metrics.phase("parse"):
+                    matrix_set = tiles.get_tile_matrix_set(tile_matrix_set)
+                    if matrix_set is None:
+                        raise ServiceException(
+                            code="InvalidParameterValue", text=f"Unknown tile matrix set '{tile_matrix_set}'")
+                    try:
+                        metatile = tiles.get_metatile(matrix_set, zoom, column, row, self.metatile_size)
+                        bbox = tiles.get_tile_bbox(matrix_set, zoom, *metatile)
+                    except (ValueError, OverflowError) as ex:
+                        raise ServiceException(code="TileOutOfRange", text=str(ex))
+                    query = CIMultiDict(query)
+                    query.update({
+                        "VERSION": "1.1.1", "SRS": matrix_set.crs, "FORMAT": "image/png",
+                        "BBOX": ",".join(repr(_x) for _x in bbox),
+                        "WIDTH": str(metatile[2] * tiles.TILE_SIZE), "HEIGHT": str(metatile[3] * tiles.TILE_SIZE)})
+                    mode, dataset, layer, params = self.parse_plot_query(query, "getmap")
+            except ServiceException as ex:
+                request_metrics.record("gettile", "", "invalid")
+                return self.create_service_exception(code=ex.code, text=ex.text, version="1.1.1") + ({},)
+            layers = ",".join(f"{dataset}.{_x}" for _x in [layer] + [_y[0] for _y in params.get("overlays", [])])
+            status = "error"
+            try:
+                image, return_format, headers, status = self._produce_tile(
+                    dataset, layer, params, metatile, (column - metatile[0], row - metatile[1]), if_none_match,
+                    request_metrics)
+            except (IOError, ValueError) as ex:
+                logging.error("ERROR: %s %s", type(ex), ex)
+                logging.debug("%s", traceback.format_exc())
+                msg = "The data corresponding to your request is not available. Please check the " \
+                      f"times and/or levels you have specified.\n\nError message: '{ex}'"
+                return self.create_service_exception(text=msg, version="1.1.1") + ({},)
+            finally:
+                request_metrics.record("gettile", layers, status)
+        return image, return_format, headers
+
+    def _produce_tile(self, dataset, layer, params, metatile, position, if_none_match, request_metrics):
+        """Returns the tile at <position> within <metatile> as tuple (image,
+           return_format, headers, status), see _produce_plot().
+        """
+        key, last_modified = self.get_plot_key("getmap", dataset, layer, params)
+        headers = {}
+        if key is not None:
+            tile_key = _get_tile_key(key, position)
+            headers["ETag"] = quote_etag(tile_key)
+            if last_modified is not None:
+                headers["Last-Modified"] = http_date(last_modified)
+            if if_none_match is not None and tile_key in if_none_match:
+                logging.debug("client copy of '%s' is current", tile_key)
+                return None, "image/png", headers, "not_modified"
+            entry = self.tile_cache.get(tile_key)
+            metrics.count_cache("tile", entry is not None)
+            if entry is not None:
+                logging.debug("Loaded '%s' from tile cache", tile_key)
+                return entry[0], entry[1], headers, "cached"
+
+        rendered = []
+
+        def produce():
+            rendered.append(True)
+            if self.render_pool is not None:
+                images, values = self.render_pool.submit(
+                    _render, "getmap", dataset, layer, params, metatile[2:],
+                    data_state=self._data_state.get(dataset)).result()
+                request_metrics.update(values)
+            else:
+                images = self.render("getmap", dataset, layer, params, tiles=metatile[2:])
+            if key is not None:
+                for tile_position, image in images.items():
+                    self.tile_cache.put(_get_tile_key(key, tile_position), image, "image/png", last_modified)
+            return images
+
+        if key is not None and self.single_flight is not None:
+            # Requests for all tiles of a metatile wait for one rendering.
+            images = self.single_flight.do(f"metatile/{key}", produce)
+        else:
+            images = produce()
+        return images[position], "image/png", headers, "ok" if rendered else "coalesced"
+
+    def parse_feature_info_query(self, query):
+        """Interprets the parameters of a GetFeatureInfo request.
+
+        The location is given either directly by LAT and LON or, as by WMS
+        clients, by the pixel I, J (X, Y for version 1.1.1) of a map of BBOX,
+        WIDTH, HEIGHT and CRS. Returns a tuple (dataset, layers, params).
+        Raises a ServiceException for invalid requests.
+        """
+        version = query.get("VERSION", "1.1.1")
+        layers = [_x for _x in query.get("QUERY_LAYERS", query.get("LAYERS", "")).strip().split(",") if _x]
+        if not layers or layers[0].find(".") <= 0:
+            raise ServiceException(code="LayerNotDefined", text="QUERY_LAYERS not specified")
+        dataset = layers[0].split(".")[0]
+        layers = [_x[len(dataset) + 1:] if _x.startswith(f"{dataset}.") else _x for _x in layers]
+        for name in layers:
+            if (dataset not in self.hsec_layer_registry) or (name not in self.hsec_layer_registry[dataset]):
+                raise ServiceException(code="LayerNotDefined", text=f"Invalid LAYER '{dataset}.{name}' requested")
+            if not self.hsec_layer_registry[dataset][name].queryable:
+                raise ServiceException(code="LayerNotQueryable", text=f"LAYER '{dataset}.{name}' is not queryable")
+        plot_object = self.hsec_layer_registry[dataset][layers[0]]
+
+        info_format = query.get("INFO_FORMAT", "application/json").lower()
+        if info_format != "application/json":
+            raise ServiceException(code="InvalidFormat", text=f"unsupported INFO_FORMAT: '{info_format}'")
+
+        init_time = query.get("DIM_INIT_TIME")
+        if init_time is not None:
+            try:
+                init_time = parse_iso_datetime(init_time)
+            except ValueError:
+                raise ServiceException(
+                    code="InvalidDimensionValue",
+                    text="DIM_INIT_TIME has wrong format (needs to be 2005-08-29T13:00:00Z)")
+        elif plot_object.uses_inittime_dimension():
+            # Default to the latest forecast.
+            init_times = plot_object.get_init_times()
+            if not init_times:
+                raise ServiceException(code="MissingDimensionValue", text="No INIT_TIME available")
+            init_time = init_times[-1]
+
+        # All valid times of the forecast, unless restricted by TIME.
+        valid_times, time_range = _parse_time(query.get("TIME"))
+        if time_range is not None:
+            valid_times = self._get_valid_times(dataset, layers, init_time, *time_range)
+
+        try:
+            level = query.get("ELEVATION")
+            level = float(level) if level is not None else None
+            if "LAT" in query or "LON" in query:
+                lat, lon = float(query.get("LAT")), float(query.get("LON"))
+            else:
+                crs = query.get("CRS" if version == "1.3.0" else "SRS", "EPSG:4326").lower()
+                is_yx = version == "1.3.0" and crs.startswith("epsg") and int(crs[5:]) in axisorder_yx
+                bbox = [float(_x) for _x in query.get("BBOX", "-180,-90,180,90").split(",")]
+                if is_yx:
+                    bbox = (bbox[1], bbox[0], bbox[3], bbox[2])
+                width, height = float(query.get("WIDTH", 900)), float(query.get("HEIGHT", 600))
+                i, j = [float(query.get(_x)) for _x in (("I", "J") if version == "1.3.0" else ("X", "Y"))]
+                # Location of the centre of the pixel.
+                location = plot_object.get_lonlat(bbox, crs, (i + 0.5) / width, (j + 0.5) / height)
+                if location is None:
+                    raise ServiceException(code="InvalidPoint", text="The requested pixel is not on the map")
+                lon, lat = location
+        except (TypeError, ValueError):
+            raise ServiceException(code="InvalidPoint", text="Location not specified (use LAT/LON or I/J)")
+        if not (-90 <= lat <= 90):
+            raise ServiceException(code="InvalidPoint", text=f"Invalid LAT: {lat}")
+
+        params = dict(lat=lat, lon=lon, level=level, init_time=init_time, valid_times=valid_times)
+        return dataset, layers, params
+
+    def get_feature_info(self, query):
+        """
+        Handler for GetFeatureInfo requests. Returns the values of the data
+        fields of the queried layers at a location as time series of all
+        valid times of the forecast (or those given by TIME) as JSON
+        document. Fields on vertical levels are given at ELEVATION or, if
+        omitted, as profiles on all levels.
+
+        Only the grid points surrounding the location are read from the data
+        files (see HorizontalSectionDriver.get_point_values). Returns a tuple
+        (document, return_format).
+        """
+        version = query.get("VERSION", "1.1.1")
+        with metrics.collect() as request_metrics:
+            try:
+                with metrics.phase("parse"):
+                    dataset, layers, params = self.parse_feature_info_query(query)
+            except ServiceException as ex:
+                request_metrics.record("getfeatureinfo", "", "invalid")
+                return self.create_service_exception(code=ex.code, text=ex.text, version=version)
+            status = "error"
+            try:
+                required_datafields = []
+                for name in layers:
+                    required_datafields.extend(_x for _x in self.hsec_layer_registry[dataset][name].required_datafields
+                                               if _x not in required_datafields)
+                fields = self.hsec_drivers[dataset].get_point_values(required_datafields, **params)
+                status = "ok"
+            except (IOError, ValueError) as ex:
+                logging.error("ERROR: %s %s", type(ex), ex)
+                logging.debug("%s", traceback.format_exc())
+                msg = "The data corresponding to your request is not available. Please check the " \
+                      f"location, times and/or levels you have specified.\n\nError message: '{ex}'"
+                return self.create_service_exception(text=msg, version=version)
+            finally:
+                request_metrics.record("getfeatureinfo", ",".join(f"{dataset}.{_x}" for _x in layers), status)
+
+        def to_list(values):
+            # Missing values are given as null.
+            return np.where(np.ma.getmaskarray(values), None, np.ma.getdata(values).astype(object)).tolist()
+
+        result = {
+            "latitude": params["lat"],
+            "longitude": params["lon"],
+            "init_time": params["init_time"].strftime("%Y-%m-%dT%H:%M:%SZ") if params["init_time"] else None,
+            "level": params["level"],
+            "fields": {vartype: {name: {
+                "units": field["units"],
+                "valid_times": [_x.strftime("%Y-%m-%dT%H:%M:%SZ") for _x in field["valid_times"]],
+                "levels": field["levels"],
+                "values": to_list(field["values"])} for name, field in fields_of_type.items()}
+                for vartype, fields_of_type in fields.items()},
+        }
+        return json.dumps(result).encode("utf-8"), "application/json"
+
+
+def _get_tile_key(key, position):
+    """Returns the key of the tile at <position> of the metatile with <key>.
+    """
+    return hashlib.sha1(f"{key}/{position[0]}/{position[1]}".encode("utf-8")).hexdigest()
+
+
+def _create_render_pool(processes):
+    """Returns a pool of <processes> worker processes rendering images.
+
+    The workers are spawned, as a forked child would inherit the locks held
+    by other threads of the server at that moment, e.g. NETCDF_LOCK. Each
+    worker builds its own server when importing this module.
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn"), initializer=_init_render_process)
+
+
+def _init_render_process():
+    """Prepares a worker process of a render pool, which renders the images
+       itself instead of passing them on to a pool of its own.
+    """
+    if server.render_pool is not None:
+        server.render_pool.shutdown(wait=False)
+        server.render_pool = None
+
+
+def _render(mode, dataset, layer, params, tiles=None, data_state=None):
+    """Renders an image in a worker process of the render pool. Returns the
+       image and the metrics of the rendering.
+
+    <data_state> is the state of the data of <dataset> the request was
+    parsed with. Workers refresh their data on their own, so they catch up
+    first if the requesting server has already seen other data.
+    """
+    if data_state is not None and data_state != server._data_state.get(dataset):
+        server.refresh_data()
+    with metrics.collect() as request_metrics:
+        image = server.render(mode, dataset, layer, params, tiles=tiles)
+    return image, request_metrics.to_dict()
 
 
 server = WMSServer()
@@ -556,17 +1216,27 @@ def application():
         url = request.url
         server_url = urllib.parse.urljoin(url, urllib.parse.urlparse(url).path)
 
+        extra_headers = {}
         if (request_type in ('getcapabilities', 'capabilities') and
                 request_service == 'wms' and request_version in ('1.1.1', '1.3.0', '')):
             return_data, return_format = server.get_capabilities(query, server_url)
         elif request_type in ('getmap', 'getvsec') and request_version in ('1.1.1', '1.3.0', ''):
-            return_data, return_format = server.produce_plot(query, request_type)
+            return_data, return_format, extra_headers = server.produce_plot(
+                query, request_type, if_none_match=request.if_none_match)
+        elif request_type == 'getfeatureinfo' and request_version in ('1.1.1', '1.3.0', ''):
+            return_data, return_format = server.get_feature_info(query)
         else:
             logging.debug("Request type '%s' is not valid.", request)
             raise RuntimeError("Request type is not valid.")
 
-        res = make_response(return_data, 200)
-        response_headers = [('Content-type', return_format), ('Content-Length', str(len(return_data)))]
+        if return_data is None:
+            # The client already has a current copy of the image.
+            res = make_response("", 304)
+            response_headers = []
+        else:
+            res = make_response(return_data, 200)
+            response_headers = [('Content-type', return_format), ('Content-Length', str(len(return_data)))]
+        response_headers.extend(extra_headers.items())
         for response_header in response_headers:
             res.headers[response_header[0]] = response_header[1]
 
@@ -576,3 +1246,45 @@ def application():
         error_message = f"{type(ex)}: {ex}\n"
         logging.error("Unexpected error: %s", error_message)
         return redirect('/index', 307)
+
+
+@app.route('/tiles/<tile_matrix_set>/<layers>/<int:zoom>/<int:column>/<int:row>.png')
+@conditional_decorator(auth.login_required, mss_wms_settings.__dict__.get('enable_basic_http_authentication', False))
+def tile_endpoint(tile_matrix_set, layers, zoom, column, row):
+    """Returns a tile of the map layers <layers> in the XYZ/WMTS REST scheme.
+       Further GetMap parameters (STYLES, TIME, DIM_INIT_TIME, ELEVATION,
+       TRANSPARENT) are given as query parameters.
+    """
+    query = CIMultiDict(request.args)
+    query["LAYERS"] = layers
+    try:
+        return_data, return_format, headers = server.produce_tile(
+            query, tile_matrix_set, zoom, column, row, if_none_match=request.if_none_match)
+    except Exception as ex:
+        error_message = f"{type(ex)}: {ex}\n"
+        logging.error("Unexpected error: %s", error_message)
+        logging.debug("%s", traceback.format_exc())
+        return_data, return_format = server.create_service_exception(
+            text="The tile could not be produced. Please check the parameters of your request.\n\n"
+                 f"Error message: '{ex}'", version="1.1.1")
+        headers = {}
+    if return_data is None:
+        res = make_response("", 304)
+    else:
+        res = make_response(return_data, 200 if return_format == "image/png" else 400)
+        res.headers["Content-type"] = return_format
+    for name, value in headers.items():
+        res.headers[name] = value
+    return res
+
+
+@app.route('/metrics')
+@conditional_decorator(auth.login_required, mss_wms_settings.__dict__.get('enable_basic_http_authentication', False))
+def metrics_endpoint():
+    """Returns the metrics of this server process in the Prometheus text format.
+    """
+    if not mss_wms_settings.__dict__.get("enable_metrics", False):
+        abort(404)
+    res = make_response(metrics.REGISTRY.render(), 200)
+    res.headers["Content-type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return res
@@ -35,8 +35,6 @@ import numpy as np
 import os
 import pint
 from fs import open_fs, errors
-from scipy.interpolate import interp1d
-from scipy.ndimage import map_coordinates
 
 try:
     import mpl_toolkits.basemap.pyproj as pyproj
@@ -406,36 +404,193 @@ def get_projection_params(proj):
     return proj_params
 
 
-def interpolate_vertsec(data3D, data3D_lats, data3D_lons, lats, lons):
+def _get_enclosing_indices(grid, values):
+    """Returns the indices of the grid points of <grid> enclosing each of
+       <values>, the weights of the upper ones and whether the values are
+       outside of the grid.
+
+    The grid may be in any order, e.g. latitudes from north to south. The
+    enclosing grid points are neighbours in the sorted grid.
+    """
+    grid = np.asarray(grid, dtype=float)
+    order = np.argsort(grid, kind="stable")
+    position = np.interp(values, grid[order], np.arange(len(grid), dtype=float), left=np.nan, right=np.nan)
+    outside = np.isnan(position)
+    position = np.where(outside, 0, position)
+    lower = np.minimum(np.floor(position).astype(int), max(len(grid) - 2, 0))
+    upper = np.minimum(lower + 1, len(grid) - 1)
+    return order[lower], order[upper], position - lower, outside
+
+
+def get_vertsec_stencil(data3D_lats, data3D_lons, lats, lons):
+    """
+    Compute the indices and weights for the bilinear interpolation of fields on
+    the grid given by data3D_lats, data3D_lons to the points lats, lons.
+
+    data3D can be on an IRREGULAR lat/lon grid, whose coordinates may be in any
+    order. The stencil depends only on the coordinates, so that it can be
+    applied to any number of fields on the same grid by apply_vertsec_stencil().
+
+    Returns a tuple (lat_indices, lon_indices, weights, outside); the first
+    three have the shape (4, len(lats)) and list the four grid points
+    surrounding each point, outside flags points outside of the grid.
+    """
+    lat0, lat1, flat, lat_outside = _get_enclosing_indices(data3D_lats, lats)
+    lon0, lon1, flon, lon_outside = _get_enclosing_indices(data3D_lons, lons)
+    outside = lat_outside | lon_outside
+    lat_indices = np.array([lat0, lat0, lat1, lat1])
+    lon_indices = np.array([lon0, lon1, lon0, lon1])
+    weights = np.array([(1 - flat) * (1 - flon), (1 - flat) * flon, flat * (1 - flon), flat * flon])
+    return lat_indices, lon_indices, weights, outside
+
+
+def apply_vertsec_stencil(data3D, stencil):
     """
     Interpolate curtain[z,pos] (curtain[level,pos]) from data3D[z,y,x]
-    (data3D[level,lat,lon]).
+    (data3D[level,lat,lon]) with a stencil computed by get_vertsec_stencil().
+
+    All levels are interpolated at once. Points outside of the grid and points
+    depending on masked values are masked.
+    """
+    lat_indices, lon_indices, weights, outside = stencil
+    values = data3D[:, lat_indices, lon_indices]
+    curtain = np.einsum("lkp,kp->lp", np.ma.getdata(values).astype(float), weights)
+    curtain[:, outside] = np.nan
+    mask = ~np.isfinite(curtain)
+    if np.ma.is_masked(values):
+        mask |= (np.ma.getmaskarray(values) & (weights > 0)).any(axis=1)
+    return np.ma.masked_array(curtain, mask)
+
 
-    This method is based on scipy.ndimage.map_coordinates().
+def interpolate_vertsec(data3D, data3D_lats, data3D_lons, lats, lons):
+    """
+    Interpolate curtain[z,pos] (curtain[level,pos]) from data3D[z,y,x]
+    (data3D[level,lat,lon]) by bilinear interpolation.
 
     data3D can be on an IRREGULAR lat/lon grid, coordinates given by lats, lons.
     The lats, lons arrays can have arbitrary order, they do not have to be uniform.
     """
-    # Create an empty field to accommodate the curtain.
-    curtain = np.zeros([data3D.shape[0], len(lats)])
-
-    # Transform lat/lon values to array index space. This is necessary to use
-    # scipy.ndimage.map_coordinates().
-    interp_lat = interp1d(data3D_lats, np.arange(len(data3D_lats)), bounds_error=False)
-    ind_lats = interp_lat(lats)
-    interp_lon = interp1d(data3D_lons, np.arange(len(data3D_lons)), bounds_error=False)
-    ind_lons = interp_lon(lons)
-    ind_coords = np.array([ind_lats, ind_lons])
-
-    # One horizontal interpolation for each model level. The order
-    # parameter controls the degree of the splines used, i.e. order=1
-    # stands for linear interpolation.
-    for ml in range(data3D.shape[0]):
-        data = data3D[ml, :, :]
-        curtain[ml, :] = map_coordinates(data, ind_coords, order=1)
-
-    curtain[:, np.isnan(ind_lats) | np.isnan(ind_lons)] = np.nan
-    return np.ma.masked_invalid(curtain)
+    return apply_vertsec_stencil(data3D, get_vertsec_stencil(data3D_lats, data3D_lons, lats, lons))
+
+
+def get_index_window(lats, lons, extent, halo=1):
+    """
+    Determine the indices of a lat/lon grid required to cover a region.
+
+    Arguments:
+    lats -- strictly increasing latitudes of the grid
+    lons -- longitudes of the grid in storage order, which may wrap around
+            (e.g. 0..360 shifted to -180..180)
+    extent -- region given as (lonmin, latmin, lonmax, latmax) in degree
+    halo -- number of additional grid cells on each side of the region
+
+    Returns a tuple (lat_slice, lon_slices). The data covering the region is
+    obtained by concatenating the longitude slices of the latitude slice along
+    the longitude axis. Regions crossing the boundary of a global grid are
+    served by two longitude slices.
+    """
+    lonmin, latmin, lonmax, latmax = extent
+    lons = np.asarray(lons)
+    nlat, nlon = len(lats), len(lons)
+
+    start = max(np.searchsorted(lats, latmin, side="right") - 1 - halo, 0)
+    stop = min(np.searchsorted(lats, latmax, side="left") + 1 + halo, nlat)
+    lat_slice = slice(int(start), int(stop))
+
+    if nlon < 2 or lonmax - lonmin >= 360:
+        return lat_slice, [slice(0, nlon)]
+    spacing = np.abs(((lons[1] - lons[0]) + 180) % 360 - 180)
+    cyclic = nlon * spacing >= 360 - 1e-6 * spacing
+    inside = ((lons - lonmin) % 360) <= lonmax - lonmin
+    # Always include the grid points closest to the region boundaries, even
+    # if the region is smaller than a grid cell.
+    for lon in (lonmin, lonmax):
+        inside[np.argmin(np.abs((lons - lon + 180) % 360 - 180))] = True
+    for _ in range(halo):
+        if cyclic:
+            inside = inside | np.roll(inside, 1) | np.roll(inside, -1)
+        else:
+            grown = inside.copy()
+            grown[1:] |= inside[:-1]
+            grown[:-1] |= inside[1:]
+            inside = grown
+    if inside.all():
+        return lat_slice, [slice(0, nlon)]
+
+    indices = np.nonzero(inside)[0]
+    gaps = np.nonzero(np.diff(indices) > 1)[0]
+    starts = [indices[0]] + list(indices[gaps + 1])
+    stops = list(indices[gaps] + 1) + [indices[-1] + 1]
+    lon_slices = [slice(int(_start), int(_stop)) for _start, _stop in zip(starts, stops)]
+    if cyclic and len(lon_slices) > 1 and lon_slices[0].start == 0 and lon_slices[-1].stop == nlon:
+        # The region crosses the boundary of the grid.
+        lon_slices = [lon_slices[-1]] + lon_slices[:-1]
+    return lat_slice, lon_slices
+
+
+def get_point_stencil(lats, lons, lat, lon):
+    """
+    Determine the grid points surrounding a location and their weights for
+    bilinear interpolation.
+
+    Arguments:
+    lats -- strictly increasing latitudes of the grid
+    lons -- longitudes of the grid in storage order, which may wrap around
+            (e.g. 0..360 shifted to -180..180)
+    lat, lon -- location in degree
+
+    Returns a tuple (lat_indices, lon_indices, weights) with the indices of
+    the two latitudes and longitudes enclosing the location and the 2x2
+    weights of the corresponding grid points. The longitude indices are not
+    adjacent for locations crossing the boundary of a global grid. Raises a
+    ValueError for locations outside of the grid.
+    """
+    lons = np.asarray(lons)
+    nlat, nlon = len(lats), len(lons)
+    if nlat < 2 or nlon < 2 or not lats[0] <= lat <= lats[-1]:
+        raise ValueError(f"location {lat}, {lon} is outside of the data domain")
+    lat_index = int(min(max(np.searchsorted(lats, lat, side="right") - 1, 0), nlat - 2))
+    lat_weight = (lat - lats[lat_index]) / (lats[lat_index + 1] - lats[lat_index])
+
+    spacing = np.abs(((lons[1] - lons[0]) + 180) % 360 - 180)
+    cyclic = nlon * spacing >= 360 - 1e-6 * spacing
+    # Index of the closest grid point west of the location.
+    offsets = (lon - lons) % 360
+    lon_index = int(np.argmin(offsets))
+    if lon_index == nlon - 1 and not cyclic:
+        if offsets[lon_index] > 1e-6 * spacing:
+            raise ValueError(f"location {lat}, {lon} is outside of the data domain")
+        lon_index -= 1
+    next_index = (lon_index + 1) % nlon
+    lon_weight = offsets[lon_index] / ((lons[next_index] - lons[lon_index]) % 360)
+
+    weights = np.outer([1 - lat_weight, lat_weight], [1 - lon_weight, lon_weight])
+    return (lat_index, lat_index + 1), (lon_index, next_index), weights
+
+
+def block_average(data, factor):
+    """
+    Average blocks of factor x factor values of the last two axes of <data>.
+
+    Blocks at the upper ends of the axes are smaller if their size is not a
+    multiple of <factor>. Masked and NaN values are ignored; blocks without
+    valid values are masked. A masked array is returned only if the result
+    contains masked values.
+    """
+    valid = np.isfinite(np.ma.getdata(data)) & ~np.ma.getmaskarray(data)
+    values = np.where(valid, np.ma.getdata(data), 0.)
+    counts = valid.astype(float)
+    for axis in (-2, -1):
+        indices = np.arange(0, data.shape[axis], factor)
+        values = np.add.reduceat(values, indices, axis=axis)
+        counts = np.add.reduceat(counts, indices, axis=axis)
+    mask = counts == 0
+    result = values / np.where(mask, 1, counts)
+    if np.issubdtype(np.asarray(data).dtype, np.floating):
+        result = result.astype(np.asarray(data).dtype)
+    if mask.any():
+        return np.ma.masked_array(result, mask)
+    return result
 
 
 def latlon_points(p1, p2, numpoints=100, connection='linear'):